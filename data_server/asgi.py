@@ -0,0 +1,251 @@
+"""ASGI entry point of the data server, for serving many slow clients at once.
+
+Requests for whole datasets and for the metadata file are handled on the
+event loop: datasets are read from the shared DatasetCache without blocking,
+only cache misses wait on a thread, and bodies are sent in chunks that each
+wait for the client to keep up. Every other request is passed to the Flask
+app in main.py on a thread, so both modes serve the same API.
+
+Run with:
+    uvicorn --app-dir data_server asgi:app
+or, with several processes:
+    gunicorn -k uvicorn.workers.UvicornWorker --chdir data_server asgi:app
+"""
+import asyncio
+import io
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Optional
+
+from flask import Request, Response
+from werkzeug.exceptions import HTTPException
+from werkzeug.wrappers import Response as WerkzeugResponse
+
+import main
+from data_server import metrics
+
+# Size of the chunks response bodies are sent in. Each chunk is only sent once
+# the client has read enough of the previous ones, so slow clients don't
+# cause whole responses to be buffered.
+CHUNK_BYTES = 64 * 1024
+# Routes whose unfiltered responses are built from the DatasetCache on the
+# event loop.
+ASYNC_ROUTES = ['/dataset', '/metadata']
+
+# Fetches datasets on cache misses and runs the requests handled by the Flask
+# app. Slow clients don't hold these threads, so there can be few of them.
+executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('ASGI_THREADS', 32)))
+
+
+def make_environ(scope: dict, body: bytes) -> dict:
+    """Returns the WSGI environ of the request described by an ASGI HTTP
+    scope."""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin1'),
+        'PATH_INFO': scope['path'].encode().decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        key = name.decode('latin1').upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_' + key
+        value = value.decode('latin1')
+        environ[key] = (environ[key] + ',' + value if key in environ
+                        else value)
+    return environ
+
+
+async def read_body(receive) -> bytes:
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return body
+        body += message.get('body', b'')
+        if not message.get('more_body', False):
+            return body
+
+
+async def watch_disconnect(receive, disconnected: asyncio.Event):
+    """Sets disconnected once the client goes away."""
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+    disconnected.set()
+
+
+async def send_start(send, status: int, headers):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(name.lower().encode('latin1'), value.encode('latin1'))
+                    for name, value in headers],
+    })
+
+
+async def send_body(send, body: bytes, disconnected: asyncio.Event,
+                    more_body=False) -> int:
+    """Sends body in chunks of CHUNK_BYTES, stopping early if the client
+    disconnects.
+
+    more_body: Whether more of the body will be sent after this.
+
+    Returns: The number of bytes sent."""
+    view = memoryview(body)
+    sent = 0
+    while not disconnected.is_set():
+        chunk = view[sent:sent + CHUNK_BYTES]
+        sent += len(chunk)
+        await send({'type': 'http.response.body', 'body': bytes(chunk),
+                    'more_body': more_body or sent < len(body)})
+        if sent >= len(body):
+            break
+    return sent
+
+
+async def get_dataset(table_id: str):
+    """Returns the given dataset from the cache, waiting for it on a thread
+    if it has to be fetched. Concurrent misses for the same dataset share a
+    single fetch, like in DatasetCache.getDataset."""
+    dataset = main.cache.get_fresh_dataset(table_id)
+    if dataset is None:
+        loop = asyncio.get_running_loop()
+        dataset = await loop.run_in_executor(
+            executor, main.cache.getDataset, main.GCS_BUCKET, table_id)
+    return dataset
+
+
+def get_metadata_filename() -> str:
+    filename = os.environ.get('METADATA_FILENAME')
+    if not filename:
+        raise RuntimeError('METADATA_FILENAME is not set.')
+    return filename
+
+
+def is_async_request(req: Request) -> bool:
+    """Returns whether req is a valid request for a whole dataset or the
+    metadata file, which is served on the event loop."""
+    if req.method != 'GET' or req.path not in ASYNC_ROUTES:
+        return False
+    if req.path == '/metadata':
+        return True
+    return (main.get_dataset_request_error(req) is None and
+            not any(param in req.args for param in main.INDEXED_PARAMS))
+
+
+async def serve_async(req: Request, send, disconnected: asyncio.Event):
+    """Serves a request for which is_async_request is true."""
+    start = time.perf_counter()
+    metrics.IN_FLIGHT_REQUESTS.inc()
+    status = 500
+    dataset_label = ''
+    sent = 0
+    response: WerkzeugResponse
+    try:
+        try:
+            if req.path == '/metadata':
+                table_id = get_metadata_filename()
+            else:
+                table_id = req.args['name']
+            dataset = await get_dataset(table_id)
+        except Exception as err:
+            logging.error(err)
+            response = Response('Internal server error: {}'.format(err), 500)
+        else:
+            if req.path == '/metadata':
+                response = main.make_metadata_response(dataset, req)
+            else:
+                dataset_label = table_id
+                try:
+                    response = main.make_get_dataset_response(dataset, req)
+                except HTTPException as err:
+                    # E.g. 416 Range Not Satisfiable.
+                    response = err.get_response(req.environ)
+                if isinstance(response, tuple):
+                    response = Response(*response)
+        # The Flask app gets this header from flask_cors.
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        status = response.status_code
+        await send_start(send, status, response.get_wsgi_headers(req.environ))
+        # get_app_iter drops the body of 304 responses and slices that of 206
+        # responses. Joining its single chunk doesn't copy it.
+        body = b''.join(response.get_app_iter(req.environ))
+        sent = await send_body(send, body, disconnected)
+    finally:
+        metrics.record_request(req.path, str(status), dataset_label, sent,
+                               start)
+
+
+async def serve_wsgi(environ: dict, send, disconnected: asyncio.Event):
+    """Serves a request with the Flask app, on a thread. The response body is
+    read from the app one chunk at a time, also on a thread."""
+    loop = asyncio.get_running_loop()
+    started: List[Any] = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [int(status.split(' ', 1)[0]), headers]
+
+    body = await loop.run_in_executor(executor, main.app, environ,
+                                      start_response)
+    try:
+        await send_start(send, *started)
+        chunks = iter(body)
+        while not disconnected.is_set():
+            chunk: Optional[bytes] = await loop.run_in_executor(
+                executor, next, chunks, None)
+            if chunk is None:
+                await send({'type': 'http.response.body', 'body': b''})
+                break
+            if chunk:
+                await send_body(send, chunk, disconnected, more_body=True)
+    finally:
+        if hasattr(body, 'close'):
+            await loop.run_in_executor(executor, body.close)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope: dict, receive, send):
+    """The ASGI app."""
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    environ = make_environ(scope, await read_body(receive))
+    disconnected = asyncio.Event()
+    watcher = asyncio.ensure_future(watch_disconnect(receive, disconnected))
+    try:
+        req = Request(environ)
+        if is_async_request(req):
+            await serve_async(req, send, disconnected)
+        else:
+            await serve_wsgi(environ, send, disconnected)
+    finally:
+        watcher.cancel()
@@ -0,0 +1,47 @@
+"""Measures the time to serve a /dataset request that hits the DatasetCache.
+
+Usage, from the data_server directory:
+    python benchmarks/bench_cache_hits.py [--rows 100000] [--requests 50]
+"""
+import argparse
+import os
+import sys
+import time
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import app  # noqa: E402
+from synthetic_data import county_time_series_ndjson  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--requests', type=int, default=50)
+    args = parser.parse_args()
+
+    data = county_time_series_ndjson(args.rows)
+    url = '/dataset?name=bench-by_race_county_time_series.json'
+    client = app.test_client()
+    with mock.patch('main.GCS_BUCKET', 'bench'), \
+            mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+                       return_value=data):
+        # Fill the cache.
+        client.get(url).get_data()
+
+        timings = []
+        for _ in range(args.requests):
+            start = time.perf_counter()
+            body = client.get(url).get_data()
+            timings.append(time.perf_counter() - start)
+
+    timings.sort()
+    print(f'{args.rows} rows, {len(data) / 2**20:.1f}MiB NDJSON, '
+          f'{len(body) / 2**20:.1f}MiB response')
+    print(f'cache hit p50: {timings[len(timings) // 2] * 1000:.2f}ms '
+          f'p95: {timings[int(len(timings) * 0.95)] * 1000:.2f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""Measures the latency of downloading a dataset on a cache miss, against a
+local fake GCS server, with and without the shared client in gcs_utils.
+
+Usage, from the data_server directory:
+    python benchmarks/bench_gcs_miss.py [--rows 1000] [--requests 50]
+                                        [--latency-ms 5]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from google.cloud import storage  # noqa: E402
+
+from data_server import gcs_utils  # noqa: E402
+from fake_gcs import FakeGcsServer  # noqa: E402
+from synthetic_data import state_ndjson  # noqa: E402
+
+BUCKET = 'bench'
+FILENAME = 'bench-by_race_state.json'
+
+
+def download_with_new_client(gcs_bucket: str, filename: str) -> bytes:
+    """How gcs_utils.download_blob_as_bytes used to download blobs."""
+    client = storage.Client()
+    bucket = client.get_bucket(gcs_bucket)
+    blob = bucket.blob(filename)
+    return blob.download_as_bytes()
+
+
+def run(server: FakeGcsServer, download, num_requests: int):
+    before = dict(server.stats)
+    timings = []
+    for _ in range(num_requests):
+        start = time.perf_counter()
+        download(BUCKET, FILENAME)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    stats = {key: value - before[key] for key, value in server.stats.items()}
+    return timings, stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--latency-ms', type=float, default=5)
+    args = parser.parse_args()
+
+    with FakeGcsServer(latency=args.latency_ms / 1000) as server:
+        server.put(BUCKET, FILENAME, state_ndjson(args.rows))
+        os.environ['STORAGE_EMULATOR_HOST'] = server.url
+        gcs_utils.reset_client()
+
+        for name, download in [('new client per miss', download_with_new_client),
+                               ('shared client', gcs_utils.download_blob_as_bytes)]:
+            timings, stats = run(server, download, args.requests)
+            print(f'{name}: p50 {timings[len(timings) // 2] * 1000:.2f}ms '
+                  f'p95 {timings[int(len(timings) * 0.95)] * 1000:.2f}ms, '
+                  f'{stats["requests"] / args.requests:.1f} API requests and '
+                  f'{stats["connections"] / args.requests:.2f} new connections '
+                  f'per miss')
+
+
+if __name__ == '__main__':
+    main()
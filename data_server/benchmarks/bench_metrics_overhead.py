@@ -0,0 +1,68 @@
+"""Measures the overhead of the request metrics on /dataset cache hits.
+
+Small datasets are used so that the cost of the metrics is as large as
+possible relative to the cost of serving the request. Requests alternate
+between the app with and without RequestMetricsMiddleware, to spread noise
+evenly between the two.
+
+Usage, from the data_server directory:
+    python benchmarks/bench_metrics_overhead.py [--rows 500] [--requests 5000]
+"""
+import argparse
+import os
+import sys
+import time
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import app  # noqa: E402
+from synthetic_data import state_ndjson  # noqa: E402
+
+
+def percentile(timings, fraction):
+    return timings[int(len(timings) * fraction)] * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=500)
+    parser.add_argument('--requests', type=int, default=5000)
+    args = parser.parse_args()
+
+    data = state_ndjson(args.rows)
+    url = '/dataset?name=bench-by_race_state.json'
+    client = app.test_client()
+    instrumented = app.wsgi_app
+    apps = {'with metrics': instrumented, 'without metrics': instrumented.app}
+    timings = {name: [] for name in apps}
+    with mock.patch('main.GCS_BUCKET', 'bench'), \
+            mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+                       return_value=data):
+        # Fill the cache and warm up both apps.
+        for wsgi_app in apps.values():
+            app.wsgi_app = wsgi_app
+            for _ in range(100):
+                client.get(url).get_data()
+
+        for _ in range(args.requests):
+            for name, wsgi_app in apps.items():
+                app.wsgi_app = wsgi_app
+                start = time.perf_counter()
+                client.get(url).get_data()
+                timings[name].append(time.perf_counter() - start)
+    app.wsgi_app = instrumented
+
+    print(f'{args.rows} rows, {len(data) / 2**10:.1f}KiB NDJSON')
+    for name, values in timings.items():
+        values.sort()
+        print(f'{name}: p50 {percentile(values, 0.5):.1f}us '
+              f'p95 {percentile(values, 0.95):.1f}us '
+              f'p99 {percentile(values, 0.99):.1f}us')
+    overhead = (percentile(timings['with metrics'], 0.5) -
+                percentile(timings['without metrics'], 0.5))
+    print(f'p50 overhead: {overhead:.1f}us')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""A minimal local stand-in for the GCS JSON API, serving in-memory objects.
+
+It implements just enough of the API for google.cloud.storage to get buckets
+and object metadata and to download objects. Point a storage.Client at it by
+setting STORAGE_EMULATOR_HOST to FakeGcsServer.url before creating the
+client.
+"""
+import base64
+import hashlib
+import json
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep connections alive between requests, like the real API.
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.stats['connections'] += 1
+
+    def _send(self, status: int, body: bytes, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, obj: dict):
+        self._send(status, json.dumps(obj).encode(),
+                   {'Content-Type': 'application/json'})
+
+    def do_GET(self):
+        server = self.server
+        server.stats['requests'] += 1
+        if server.latency:
+            time.sleep(server.latency)
+
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        parts = [urllib.parse.unquote(part) for part in url.path.split('/')]
+        if parts[1] == 'download':
+            parts = parts[1:]
+            query.setdefault('alt', ['media'])
+        # ['', 'storage', 'v1', 'b', bucket, 'o', object]
+        if parts[1:4] != ['storage', 'v1', 'b'] or len(parts) not in (5, 7):
+            self._send_json(404, {'error': {'code': 404,
+                                            'message': 'Not found'}})
+            return
+
+        bucket = parts[4]
+        if len(parts) == 5:
+            server.stats['bucket_requests'] += 1
+            self._send_json(200, {'kind': 'storage#bucket', 'name': bucket,
+                                  'id': bucket})
+            return
+
+        name = parts[6]
+        data = server.objects.get((bucket, name))
+        if data is None:
+            self._send_json(404, {'error': {'code': 404,
+                                            'message': f'No such object: '
+                                                       f'{bucket}/{name}'}})
+            return
+
+        md5 = base64.b64encode(hashlib.md5(data).digest()).decode()
+        generation = server.generations[(bucket, name)]
+        if query.get('alt') == ['media']:
+            server.stats['downloads'] += 1
+            self._send(200, data, {
+                'Content-Type': 'application/octet-stream',
+                'x-goog-hash': f'md5={md5}',
+                'x-goog-generation': str(generation),
+            })
+        else:
+            server.stats['metadata_requests'] += 1
+            self._send_json(200, {
+                'kind': 'storage#object', 'bucket': bucket, 'name': name,
+                'size': str(len(data)), 'md5Hash': md5,
+                'generation': str(generation),
+            })
+
+
+class _HttpServer(ThreadingHTTPServer):
+    """Holds the objects and request counts that the handlers share."""
+
+    def __init__(self, latency: float):
+        super().__init__(('127.0.0.1', 0), _Handler)
+        self.daemon_threads = True
+        self.latency = latency
+        # Maps (bucket, name) to the object's data and to its generation.
+        self.objects: Dict[Tuple[str, str], bytes] = {}
+        self.generations: Dict[Tuple[str, str], int] = {}
+        self.stats = {'connections': 0, 'requests': 0, 'bucket_requests': 0,
+                      'metadata_requests': 0, 'downloads': 0}
+
+
+class FakeGcsServer():
+    """Serves objects from memory on a local port, in a background thread."""
+
+    def __init__(self, latency: float = 0.0):
+        """latency: Seconds to wait before answering each request, to
+        simulate the round trip to GCS."""
+        self.httpd = _HttpServer(latency)
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def stats(self) -> dict:
+        return self.httpd.stats
+
+    def put(self, bucket: str, name: str, data: bytes):
+        key = (bucket, name)
+        self.httpd.objects[key] = data
+        self.httpd.generations[key] = self.httpd.generations.get(key, 0) + 1
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
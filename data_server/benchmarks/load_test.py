@@ -0,0 +1,357 @@
+"""Load test for the data server, against a local fake GCS server.
+
+Serves synthetic state, county and county time series datasets from a
+FakeGcsServer, starts the data server in a subprocess pointed at it, and
+drives it with concurrent clients making a weighted mix of /dataset
+requests. Reports latency percentiles and throughput per kind of dataset,
+the peak RSS of the server and its cache hit rate.
+
+Usage, from the data_server directory:
+    python benchmarks/load_test.py [--server werkzeug|gunicorn|uvicorn]
+                                   [--concurrency 16] [--duration 20]
+                                   [--mix state=60,county=30,time_series=10]
+
+Run with --help for all options. --json writes the results to a file, so
+runs before and after a change can be compared.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+from typing import List
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_SERVER_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, DATA_SERVER_DIR)
+
+from fake_gcs import FakeGcsServer  # noqa: E402
+from synthetic_data import (county_ndjson, county_time_series_ndjson,  # noqa: E402
+                            state_ndjson)
+
+BUCKET = 'bench'
+# Builds the contents of each kind of dataset, given a number of rows.
+GENERATORS = {
+    'state': state_ndjson,
+    'county': county_ndjson,
+    'time_series': county_time_series_ndjson,
+}
+# Default number of rows of each kind of dataset, similar to the sizes of the
+# tables the exporter writes.
+DEFAULT_ROWS = {'state': 500, 'county': 25000, 'time_series': 100000}
+
+
+def parse_weights(value: str) -> dict:
+    weights = {}
+    for item in value.split(','):
+        kind, weight = item.split('=')
+        if kind not in GENERATORS:
+            raise argparse.ArgumentTypeError(f'Unknown dataset kind {kind}')
+        weights[kind] = float(weight)
+    return weights
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def get_rss_bytes(pid: int) -> int:
+    """Returns the resident set size of pid and all of its descendants, read
+    from /proc. Returns 0 on platforms without /proc."""
+    total = 0
+    pids = [pid]
+    while pids:
+        pid = pids.pop()
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+            for task in os.listdir(f'/proc/{pid}/task'):
+                with open(f'/proc/{pid}/task/{task}/children') as f:
+                    pids.extend(int(child) for child in f.read().split())
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+    return total
+
+
+def start_server(args, port: int, gcs_url: str) -> subprocess.Popen:
+    env = dict(os.environ,
+               STORAGE_EMULATOR_HOST=gcs_url,
+               GCS_BUCKET=BUCKET,
+               CACHE_MAX_MB=str(args.cache_max_mb),
+               PYTHONUNBUFFERED='true')
+    if args.server == 'gunicorn':
+        command = ['gunicorn', '--bind', f'127.0.0.1:{port}',
+                   '--workers', str(args.workers),
+                   '--threads', str(args.threads), '--timeout', '0',
+                   '--log-level', 'warning', 'main:app']
+    elif args.server == 'uvicorn':
+        command = ['uvicorn', '--host', '127.0.0.1', '--port', str(port),
+                   '--workers', str(args.workers), '--log-level', 'warning',
+                   'asgi:app']
+    else:
+        command = [sys.executable, os.path.abspath(__file__),
+                   '--serve-port', str(port)]
+    process = subprocess.Popen(command, cwd=DATA_SERVER_DIR, env=env)
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'Server exited with code {process.returncode}')
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port,
+                                                    timeout=1)
+            connection.request('GET', '/')
+            connection.getresponse().read()
+            connection.close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('Server did not start within 30 seconds')
+
+
+def serve(port: int):
+    """Runs the app with werkzeug's threaded development server. Used as the
+    server subprocess when --server is werkzeug."""
+    import logging
+
+    from werkzeug.serving import run_simple
+
+    from main import app
+    # Don't log every request.
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    run_simple('127.0.0.1', port, app, threaded=True)
+
+
+def make_requests(args, port: int, datasets: dict, worker: int,
+                  deadline: float, results: list):
+    """Makes requests from one client until deadline, appending a tuple of
+    (kind, seconds, status, bytes) per request to results."""
+    rng = random.Random(args.seed + worker)
+    kinds = list(args.mix)
+    weights = [args.mix[kind] for kind in kinds]
+    headers = {'Accept-Encoding': args.accept_encoding}
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+    while time.monotonic() < deadline:
+        kind = rng.choices(kinds, weights)[0]
+        url = f'/dataset?name={rng.choice(datasets[kind])}'
+        if kind != 'state' and rng.random() < args.filtered_fraction:
+            url += '&fips_prefix=01'
+        start = time.perf_counter()
+        try:
+            connection.request('GET', url, headers=headers)
+            response = connection.getresponse()
+            status = response.status
+            if args.client_read_kbps:
+                body = read_slowly(response, args.client_read_kbps)
+            else:
+                body = response.read()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            connection = http.client.HTTPConnection('127.0.0.1', port,
+                                                    timeout=120)
+            body = b''
+            status = 0
+        results.append((kind, time.perf_counter() - start, status, len(body)))
+    connection.close()
+
+
+def read_slowly(response, kbps: float) -> bytes:
+    """Reads the body of response at about kbps kilobytes per second, like a
+    client on a slow connection."""
+    chunks: List[bytes] = []
+    while True:
+        chunk = response.read(16 * 1024)
+        if not chunk:
+            return b''.join(chunks)
+        chunks.append(chunk)
+        time.sleep(len(chunk) / 1024 / kbps)
+
+
+def scrape_cache_stats(port: int) -> dict:
+    """Returns the data_server_cache_* metrics of the server, as a dict of
+    stat -> value. With several gunicorn workers, these only describe the
+    worker that handled the request."""
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    connection.request('GET', '/metrics')
+    text = connection.getresponse().read().decode()
+    connection.close()
+    stats = {}
+    for match in re.finditer(r'^data_server_cache_(\w+?)(?:_total)? (\S+)$',
+                             text, re.MULTILINE):
+        stats[match.group(1)] = float(match.group(2))
+    return stats
+
+
+def summarize(results: list, duration: float) -> dict:
+    summary = {}
+    kinds = sorted({kind for kind, _, _, _ in results})
+    for kind in kinds + ['all']:
+        rows = [row for row in results if kind in ('all', row[0])]
+        timings = sorted(seconds for _, seconds, status, _ in rows
+                         if status == 200)
+        nbytes = sum(size for _, _, _, size in rows)
+        summary[kind] = {
+            'requests': len(rows),
+            'errors': sum(1 for row in rows if row[2] != 200),
+            'requests_per_second': len(rows) / duration,
+            'mib_per_second': nbytes / duration / 2**20,
+            'p50_ms': percentile(timings, 0.5) * 1000,
+            'p95_ms': percentile(timings, 0.95) * 1000,
+            'p99_ms': percentile(timings, 0.99) * 1000,
+        }
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--server',
+                        choices=['werkzeug', 'gunicorn', 'uvicorn'],
+                        default='werkzeug',
+                        help='uvicorn serves the ASGI app in asgi.py')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='gunicorn or uvicorn worker processes')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='gunicorn threads per worker')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='number of concurrent clients')
+    parser.add_argument('--duration', type=float, default=20,
+                        help='seconds to run the load for')
+    parser.add_argument('--warmup', type=float, default=0,
+                        help='seconds of load to run before measuring')
+    parser.add_argument('--mix', type=parse_weights,
+                        default=parse_weights('state=60,county=30,'
+                                              'time_series=10'),
+                        help='relative weight of each kind of dataset')
+    parser.add_argument('--datasets', type=int, default=4,
+                        help='number of distinct datasets of each kind')
+    for kind, rows in DEFAULT_ROWS.items():
+        parser.add_argument(f'--{kind.replace("_", "-")}-rows', type=int,
+                            default=rows, dest=f'{kind}_rows')
+    parser.add_argument('--filtered-fraction', type=float, default=0.0,
+                        help='fraction of county requests filtered by fips')
+    parser.add_argument('--accept-encoding', default='gzip')
+    parser.add_argument('--client-read-kbps', type=float, default=0,
+                        help='if set, clients read responses at this rate')
+    parser.add_argument('--gcs-latency-ms', type=float, default=20)
+    parser.add_argument('--cache-max-mb', type=int, default=2048)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='file to write the results to')
+    parser.add_argument('--serve-port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_port is not None:
+        serve(args.serve_port)
+        return
+
+    with FakeGcsServer(latency=args.gcs_latency_ms / 1000) as gcs:
+        datasets = {}
+        for kind in args.mix:
+            data = GENERATORS[kind](getattr(args, f'{kind}_rows'))
+            datasets[kind] = [f'bench-{kind}-{i}.json'
+                              for i in range(args.datasets)]
+            for name in datasets[kind]:
+                gcs.put(BUCKET, name, data)
+            print(f'{kind}: {args.datasets} x {len(data) / 2**20:.2f}MiB')
+
+        port = free_port()
+        server = start_server(args, port, gcs.url)
+        try:
+            idle_rss = get_rss_bytes(server.pid)
+            peak_rss = [idle_rss]
+            stopped = threading.Event()
+
+            def sample_rss():
+                while not stopped.wait(0.2):
+                    peak_rss[0] = max(peak_rss[0], get_rss_bytes(server.pid))
+
+            sampler = threading.Thread(target=sample_rss, daemon=True)
+            sampler.start()
+
+            for phase, duration in [('warmup', args.warmup),
+                                    ('measure', args.duration)]:
+                if duration <= 0:
+                    continue
+                if phase == 'measure':
+                    stats_before = scrape_cache_stats(port)
+                results = []
+                deadline = time.monotonic() + duration
+                start = time.monotonic()
+                clients = [threading.Thread(
+                    target=make_requests,
+                    args=(args, port, datasets, i, deadline, results))
+                    for i in range(args.concurrency)]
+                for client in clients:
+                    client.start()
+                for client in clients:
+                    client.join()
+                elapsed = time.monotonic() - start
+
+            stopped.set()
+            sampler.join()
+            stats = scrape_cache_stats(port)
+            final_rss = get_rss_bytes(server.pid)
+        finally:
+            server.terminate()
+            server.wait()
+
+    cache = {key: stats.get(key, 0) - stats_before.get(key, 0)
+             for key in ['hits', 'misses', 'coalesced', 'revalidations',
+                         'evictions']}
+    lookups = cache['hits'] + cache['misses']
+    report = {
+        'config': {key: value for key, value in vars(args).items()
+                   if key not in ('json', 'serve_port')},
+        'latency': summarize(results, elapsed),
+        'rss_mib': {'idle': idle_rss / 2**20, 'peak': peak_rss[0] / 2**20,
+                    'final': final_rss / 2**20},
+        'cache': dict(cache, hit_rate=cache['hits'] / lookups
+                      if lookups else 0.0,
+                      size_mib=stats.get('size_bytes', 0) / 2**20),
+        'gcs': dict(gcs.stats),
+    }
+
+    print(f'\n{args.server}, {args.concurrency} clients, '
+          f'{elapsed:.1f}s measured')
+    print(f'{"kind":<12}{"requests":>10}{"errors":>8}{"req/s":>10}'
+          f'{"MiB/s":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}')
+    for kind, row in report['latency'].items():
+        print(f'{kind:<12}{row["requests"]:>10}{row["errors"]:>8}'
+              f'{row["requests_per_second"]:>10.1f}'
+              f'{row["mib_per_second"]:>10.1f}{row["p50_ms"]:>10.2f}'
+              f'{row["p95_ms"]:>10.2f}{row["p99_ms"]:>10.2f}')
+    rss = report['rss_mib']
+    print(f'RSS: idle {rss["idle"]:.0f}MiB, peak {rss["peak"]:.0f}MiB, '
+          f'final {rss["final"]:.0f}MiB')
+    cache = report['cache']
+    print(f'Cache: hit rate {cache["hit_rate"]:.1%}, {cache["misses"]:.0f} '
+          f'misses, {cache["coalesced"]:.0f} coalesced, '
+          f'{cache["evictions"]:.0f} evictions, '
+          f'{cache["size_mib"]:.0f}MiB cached')
+    print(f'GCS: {report["gcs"]["downloads"]} downloads, '
+          f'{report["gcs"]["metadata_requests"]} metadata requests')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
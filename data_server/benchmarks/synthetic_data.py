@@ -0,0 +1,91 @@
+"""Synthetic NDJSON datasets shaped like the tables the exporter writes."""
+import json
+import random
+from typing import Set
+
+RACES = [('AIAN_NH', 'American Indian and Alaska Native (NH)'),
+         ('ASIAN_NH', 'Asian (NH)'),
+         ('BLACK_NH', 'Black or African American (NH)'),
+         ('HISP', 'Hispanic or Latino'),
+         ('NHPI_NH', 'Native Hawaiian and Pacific Islander (NH)'),
+         ('MULTI_OR_OTHER_STANDARD_NH', 'Two or more races & Unrepresented race (NH)'),
+         ('WHITE_NH', 'White (NH)'),
+         ('ALL', 'All')]
+
+
+def _county_fips(num_counties: int):
+    rng = random.Random(0)
+    state_fips = ['01', '02', '04', '05', '06', '08', '09', '10', '12', '13']
+    counties: Set[str] = set()
+    while len(counties) < num_counties:
+        counties.add(f'{rng.choice(state_fips)}{rng.randrange(1, 999):03d}')
+    return sorted(counties)
+
+
+def county_time_series_ndjson(num_rows: int) -> bytes:
+    """Returns num_rows of county level, by race time series data as NDJSON,
+    similar to cdc_restricted_data-by_race_county_processed_time_series."""
+    rng = random.Random(num_rows)
+    periods = [f'{year}-{month:02d}' for year in range(2020, 2023)
+               for month in range(1, 13)]
+    rows_per_county = len(periods) * len(RACES)
+    counties = _county_fips(max(1, num_rows // rows_per_county + 1))
+    lines = []
+    for county in counties:
+        for period in periods:
+            for race_id, race_name in RACES:
+                lines.append(json.dumps({
+                    'state_fips': county[:2],
+                    'state_name': f'State {county[:2]}',
+                    'county_fips': county,
+                    'county_name': f'County {county}',
+                    'race_category_id': race_id,
+                    'race_and_ethnicity': race_name,
+                    'time_period': period,
+                    'covid_cases_per_100k': round(rng.uniform(0, 5000), 1),
+                    'covid_deaths_per_100k': round(rng.uniform(0, 200), 1),
+                    'covid_cases_pct_share': round(rng.uniform(0, 100), 1),
+                    'covid_population_pct': round(rng.uniform(0, 100), 1),
+                }, separators=(',', ':')))
+                if len(lines) == num_rows:
+                    return '\n'.join(lines).encode() + b'\n'
+    return '\n'.join(lines).encode() + b'\n'
+
+
+def county_ndjson(num_rows: int) -> bytes:
+    """Returns num_rows of county level, by race data as NDJSON, similar to
+    acs_population-by_race_county."""
+    rng = random.Random(num_rows)
+    counties = _county_fips(max(1, num_rows // len(RACES) + 1))
+    lines = []
+    for i in range(num_rows):
+        county = counties[i // len(RACES)]
+        race_id, race_name = RACES[i % len(RACES)]
+        lines.append(json.dumps({
+            'state_fips': county[:2],
+            'state_name': f'State {county[:2]}',
+            'county_fips': county,
+            'county_name': f'County {county}',
+            'race_category_id': race_id,
+            'race_and_ethnicity': race_name,
+            'population': rng.randrange(100, 1000000),
+            'population_pct': round(rng.uniform(0, 100), 1),
+        }, separators=(',', ':')))
+    return '\n'.join(lines).encode() + b'\n'
+
+
+def state_ndjson(num_rows: int = 500) -> bytes:
+    """Returns num_rows of state level, by race data as NDJSON."""
+    rng = random.Random(num_rows)
+    lines = []
+    for i in range(num_rows):
+        race_id, race_name = RACES[i % len(RACES)]
+        lines.append(json.dumps({
+            'state_fips': f'{i // len(RACES) % 78:02d}',
+            'state_name': f'State {i // len(RACES)}',
+            'race_category_id': race_id,
+            'race_and_ethnicity': race_name,
+            'population': rng.randrange(1000, 10000000),
+            'population_pct': round(rng.uniform(0, 100), 1),
+        }, separators=(',', ':')))
+    return '\n'.join(lines).encode() + b'\n'
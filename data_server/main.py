@@ -1,15 +1,81 @@
+import hashlib
+import json
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 
-from flask import Flask, Response, request
+from flask import Flask, Request, Response, request
 from flask_cors import CORS
 from werkzeug.datastructures import Headers
 
+from data_server import columnar, metrics
+from data_server.cache_warmer import CacheWarmer, get_metadata_table_ids
+from data_server.dataset import Dataset
 from data_server.dataset_cache import DatasetCache
 
+# Url params of /dataset that select a subset of the rows of a dataset.
+ROW_FILTER_PARAMS = ['fips', 'fips_prefix', 'time_period']
+# Url params of /dataset that select a page of the rows matching the filters.
+PAGINATION_PARAMS = ['offset', 'limit']
+# Url params of /dataset whose responses are sliced out of a dataset using
+# its index, instead of serving its whole cached body.
+INDEXED_PARAMS = ROW_FILTER_PARAMS + ['columns'] + PAGINATION_PARAMS
+# Values of the format url param of /dataset.
+OUTPUT_FORMATS = ['json', 'arrow']
+# Max number of datasets that can be requested at once from /datasets.
+MAX_BATCH_SIZE = 20
+# Counters from DatasetCache.stats and CacheWarmer.stats. Their other stats
+# are exported as gauges.
+CACHE_COUNTER_STATS = ['hits', 'misses', 'coalesced', 'revalidations',
+                       'evictions', 'disk_hits', 'disk_evictions']
+
 app = Flask(__name__)
 CORS(app)
-cache = DatasetCache()
+cache = DatasetCache(
+    max_cache_bytes=int(os.environ.get('CACHE_MAX_MB', 2048)) * 1024 * 1024,
+    disk_cache_dir=os.environ.get('CACHE_DISK_DIR'),
+    max_disk_cache_bytes=(int(os.environ.get('CACHE_DISK_MAX_MB', 2048)) *
+                          1024 * 1024))
+# Bucket datasets are served from.
+GCS_BUCKET = os.environ.get('GCS_BUCKET')
+warmer = CacheWarmer(cache, GCS_BUCKET or '')
+# Fetches the datasets requested from /datasets concurrently.
+batch_executor = ThreadPoolExecutor(max_workers=MAX_BATCH_SIZE)
+
+app.wsgi_app = metrics.RequestMetricsMiddleware(  # type: ignore
+    app.wsgi_app, routes=['/', '/metadata', '/dataset', '/datasets',
+                          '/metrics'])
+for stat in cache.stats():
+    is_counter = stat in CACHE_COUNTER_STATS
+    metrics.REGISTRY.register(metrics.Callback(
+        'data_server_cache_{}{}'.format(stat, '_total' if is_counter else ''),
+        'DatasetCache {} stat.'.format(stat),
+        'counter' if is_counter else 'gauge',
+        lambda stat=stat: cache.stats()[stat]))
+for stat in warmer.stats():
+    metrics.REGISTRY.register(metrics.Callback(
+        'data_server_cache_warmer_{}_total'.format(stat),
+        'CacheWarmer {} stat.'.format(stat), 'counter',
+        lambda stat=stat: warmer.stats()[stat]))
+
+
+def get_table_ids_to_preload():
+    """Returns the datasets listed in CACHE_PRELOAD_DATASETS, plus those in
+    the metadata file if CACHE_PRELOAD_FROM_METADATA is true."""
+    table_ids = [table_id for table_id in
+                 os.environ.get('CACHE_PRELOAD_DATASETS', '').split(',')
+                 if table_id]
+    if os.environ.get('CACHE_PRELOAD_FROM_METADATA') == 'true':
+        metadata = cache.getDataset(GCS_BUCKET,
+                                    os.environ.get('METADATA_FILENAME'))
+        table_ids.extend(get_metadata_table_ids(metadata))
+    return table_ids
+
+
+if os.environ.get('CACHE_WARMER_ENABLED') == 'true':
+    if not GCS_BUCKET:
+        raise RuntimeError('GCS_BUCKET must be set to enable the cache warmer.')
+    warmer.start(get_table_ids_to_preload)
 
 
 @app.route('/', methods=['GET'])
@@ -17,62 +83,202 @@ def get_program_name():
     return 'Running data server.'
 
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Returns request, cache and GCS metrics in the Prometheus text format."""
+    return Response(metrics.REGISTRY.render(),
+                    mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/metadata', methods=['GET'])
 def get_metadata():
     """Downloads and returns metadata about available download files."""
     try:
-        metadata = cache.getDataset(os.environ.get('GCS_BUCKET'),
+        metadata = cache.getDataset(GCS_BUCKET,
                                     os.environ.get('METADATA_FILENAME'))
     except Exception as err:
         logging.error(err)
         return 'Internal server error: {}'.format(err), 500
-
-    def generate_response(data: bytes):
-        next_row = b'['
-        for row in data.splitlines():
-            yield next_row
-            next_row = row + b','
-        yield next_row.rstrip(b',') + b']'
-    headers = Headers()
-    headers.add('Content-Disposition', 'attachment',
-                filename=os.environ.get('METADATA_FILENAME'))
-    headers.add('Vary', 'Accept-Encoding')
-    return Response(generate_response(metadata), mimetype='application/json',
-                    headers=headers)
+    return make_metadata_response(metadata, request)
 
 
 @app.route('/dataset', methods=['GET'])
 def get_dataset():
     """Downloads and returns the requested dataset if it exists."""
-    dataset_name = request.args.get('name')
-    if dataset_name is None:
-        return 'Request missing required url param \'name\'', 400
+    error = get_dataset_request_error(request)
+    if error is not None:
+        return error
 
+    dataset_name = request.args['name']
     try:
-        dataset = cache.getDataset(os.environ.get('GCS_BUCKET'), dataset_name)
+        dataset = cache.getDataset(GCS_BUCKET, dataset_name)
     except Exception as err:
         logging.error(err)
         return 'Internal server error: {}'.format(err), 500
+    request.environ[metrics.DATASET_ENVIRON_KEY] = dataset_name
+    return make_get_dataset_response(dataset, request)
+
+
+@app.route('/datasets', methods=['GET'])
+def get_datasets():
+    """Downloads and returns several datasets in one response.
+
+    The response is a JSON object with a "datasets" object mapping the name of
+    each dataset to its rows, and an "errors" object mapping the name of each
+    dataset that couldn't be loaded to the error. CSV datasets are returned as
+    strings."""
+    dataset_names = list(dict.fromkeys(request.args.getlist('name')))
+    if not dataset_names:
+        return 'Request missing required url param \'name\'', 400
+    if len(dataset_names) > MAX_BATCH_SIZE:
+        return 'Request can include at most {} datasets'.format(
+            MAX_BATCH_SIZE), 400
+
+    futures = [batch_executor.submit(cache.getDataset, GCS_BUCKET, name)
+               for name in dataset_names]
+    datasets = {}
+    errors = {}
+    for name, future in zip(dataset_names, futures):
+        try:
+            datasets[name] = future.result()
+        except Exception as err:
+            logging.error(err)
+            errors[name] = 'Internal server error: {}'.format(err)
+
+    def generate_response():
+        # The bodies are written one after the other rather than copied into
+        # a single buffer.
+        separator = b''
+        yield b'{"datasets":{'
+        for name, dataset in datasets.items():
+            yield separator + json.dumps(name).encode() + b':'
+            if dataset.index is None:
+                yield json.dumps(dataset.body.decode()).encode()
+            else:
+                yield dataset.body
+            separator = b','
+        yield b'},"errors":' + json.dumps(errors).encode() + b'}'
 
-    def generate_response(data: bytes):
-        next_row = b'['
-        for row in dataset.splitlines():
-            yield next_row
-            next_row = row + b','
-        yield next_row.rstrip(b',') + b']'
     headers = Headers()
-    headers.add('Content-Disposition', 'attachment', filename=dataset_name)
+    headers.add('Vary', 'Accept-Encoding')
+    if not errors:
+        headers.add('Cache-Control', 'public, max-age=7200')
+    return Response(generate_response(), mimetype='application/json',
+                    headers=headers)
+
+
+def make_metadata_response(metadata: Dataset, req: Request):
+    """Returns the response to a /metadata request, given the metadata
+    Dataset."""
+    headers = Headers()
+    headers.add('Content-Disposition', 'attachment',
+                filename=os.environ.get('METADATA_FILENAME'))
+    headers.add('Vary', 'Accept-Encoding')
+    return make_dataset_response(metadata, headers, req)
+
+
+def get_dataset_request_error(req: Request):
+    """Returns an error response if the url params of a /dataset request are
+    invalid, and None otherwise."""
+    if req.args.get('name') is None:
+        return 'Request missing required url param \'name\'', 400
+    if req.args.get('format', 'json') not in OUTPUT_FORMATS:
+        return 'Url param \'format\' must be one of: {}'.format(
+            ', '.join(OUTPUT_FORMATS)), 400
+    for param in PAGINATION_PARAMS:
+        if not req.args.get(param, '0').isdigit():
+            return 'Url param \'{}\' must be a non-negative integer'.format(
+                param), 400
+    return None
+
+
+def make_get_dataset_response(dataset: Dataset, req: Request):
+    """Returns the response to a valid /dataset request, given the requested
+    Dataset."""
+    dataset_name = req.args['name']
+    output_format = req.args.get('format', 'json')
+    filename = dataset_name
+    if output_format == 'arrow':
+        if dataset.arrow is None:
+            return 'Dataset {} is not available in Arrow format'.format(
+                dataset_name), 400
+        filename = os.path.splitext(dataset_name)[0] + '.arrow'
+
+    headers = Headers()
+    headers.add('Content-Disposition', 'attachment', filename=filename)
     headers.add('Vary', 'Accept-Encoding')
     # Allow browsers to cache datasets for 2 hours, the same as the DatasetCache
     # TODO: If we want to make sure this stays in sync with the DatasetCache
     # TTL, move this to a constant that's shared between them.
     headers.add('Cache-Control', 'public, max-age=7200')
 
-    if dataset_name.endswith('.csv'):
-        return Response(dataset, mimetype='text/csv', headers=headers)
+    if any(param in req.args for param in INDEXED_PARAMS):
+        if dataset.index is None:
+            return 'Url params {} are only supported for JSON datasets'.format(
+                ', '.join(INDEXED_PARAMS)), 400
+        filters = {param: req.args[param] for param in ROW_FILTER_PARAMS
+                   if param in req.args}
+        columns = req.args.get('columns')
+        limit = req.args.get('limit')
+        return make_filtered_response(
+            dataset, filters,
+            columns.split(',') if columns is not None else None,
+            output_format, headers, req,
+            offset=int(req.args.get('offset', 0)),
+            limit=int(limit) if limit is not None else None)
 
-    return Response(generate_response(dataset), mimetype='application/json',
-                    headers=headers)
+    if output_format == 'arrow':
+        response = Response(dataset.arrow, mimetype=columnar.ARROW_MIMETYPE,
+                            headers=headers)
+        response.set_etag('{}-arrow'.format(dataset.md5))
+        return response.make_conditional(
+            req, accept_ranges=True, complete_length=len(dataset.arrow))
+    return make_dataset_response(dataset, headers, req)
+
+
+def make_dataset_response(dataset: Dataset, headers: Headers, req: Request):
+    """Returns a response with the body of dataset, using the best
+    compressed copy of it that the client accepts. Returns 304 Not Modified
+    instead if the client already has that copy, and 206 Partial Content
+    with only the requested bytes of that copy for Range requests."""
+    encoding = req.accept_encodings.best_match(dataset.encodings,
+                                               default='identity')
+    if encoding != 'identity':
+        headers.add('Content-Encoding', encoding)
+    body = dataset.encodings[encoding]
+    response = Response(body, mimetype=dataset.mimetype, headers=headers)
+    response.set_etag(dataset.etag(encoding))
+    return response.make_conditional(req, accept_ranges=True,
+                                     complete_length=len(body))
+
+
+def make_filtered_response(dataset: Dataset, filters: dict, columns,
+                           output_format: str, headers: Headers, req: Request,
+                           offset=0, limit=None):
+    """Returns a response with the rows of dataset matching filters, sliced
+    out of the cached body or Arrow stream using its index.
+
+    filters: Url params from ROW_FILTER_PARAMS and their values.
+    columns: List of columns to include in each row, or None for all.
+    output_format: One of OUTPUT_FORMATS.
+    offset: Number of matching rows to skip.
+    limit: Max number of matching rows to return, or None for all. The total
+           number of matching rows is returned in the X-Total-Count header
+           when paginating."""
+    rows = dataset.index.select(**filters)
+    if offset or limit is not None:
+        headers.add('X-Total-Count', str(len(rows)))
+        rows = rows[offset:offset + limit if limit is not None else None]
+    if output_format == 'arrow':
+        body = columnar.slice_arrow(dataset.arrow, rows, columns)
+        mimetype = columnar.ARROW_MIMETYPE
+    else:
+        body = dataset.index.slice_rows(dataset.body, rows, columns)
+        mimetype = dataset.mimetype
+    response = Response(body, mimetype=mimetype, headers=headers)
+    response.set_etag('{}-{}'.format(
+        dataset.md5, hashlib.md5(req.query_string).hexdigest()))
+    return response.make_conditional(req)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,296 @@
+import asyncio
+import gzip
+import json
+import os
+import threading
+from unittest import mock
+
+import google.cloud.exceptions
+import pytest
+
+import asgi
+from data_server import metrics
+from main import cache
+
+os.environ['METADATA_FILENAME'] = 'test_data.ndjson'
+
+test_data = (
+    b'{"state_fips":"01","county_fips":"01001","population":1}\n'
+    b'{"state_fips":"01","county_fips":"01003","population":2}\n'
+    b'{"state_fips":"02","county_fips":"02013","population":3}\n') * 20
+test_data_json = b'[' + b','.join(test_data.splitlines()) + b']'
+
+
+def get_test_data(gcs_bucket: str, filename: str):
+    """Returns test_data for every file. Meant to be used to patch
+    gcs_utils.download_blob_as_bytes."""
+    return test_data
+
+
+async def call_app(path: str, query_string=b'', headers=(),
+                   disconnect_after=None):
+    """Makes a GET request to the ASGI app and returns the messages it sent.
+
+    disconnect_after: If given, the client disconnects after receiving this
+                      many body messages."""
+    messages = []
+    disconnect = asyncio.Event()
+    requests = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+
+    async def receive():
+        if requests:
+            return requests.pop()
+        await disconnect.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        messages.append(message)
+        if (disconnect_after is not None and
+                len(messages) > disconnect_after):
+            disconnect.set()
+            # Give the app a chance to see the disconnect.
+            await asyncio.sleep(0)
+
+    scope = {'type': 'http', 'http_version': '1.1', 'method': 'GET',
+             'scheme': 'http', 'path': path, 'query_string': query_string,
+             'headers': [(name.encode(), value.encode())
+                         for name, value in headers],
+             'server': ('testserver', 80), 'client': ('127.0.0.1', 1234)}
+    await asgi.app(scope, receive, send)
+    return messages
+
+
+def get(path: str, query_string=b'', headers=()):
+    """Returns the status, headers and body of a GET request."""
+    messages = asyncio.run(call_app(path, query_string, headers))
+    assert messages[0]['type'] == 'http.response.start'
+    assert not messages[-1].get('more_body', False)
+    headers = {name.decode(): value.decode()
+               for name, value in messages[0]['headers']}
+    body = b''.join(message['body'] for message in messages[1:])
+    return messages[0]['status'], headers, body
+
+
+@pytest.fixture(autouse=True)
+def gcs_bucket():
+    """Serves datasets from the test bucket. main reads GCS_BUCKET when it is
+    imported, before it can be set here."""
+    with mock.patch('main.GCS_BUCKET', 'test'):
+        yield
+
+
+@pytest.fixture(autouse=True)
+def reset_cache():
+    """Clears the global cache and metrics before every test is run."""
+    cache.clear()
+    metrics.REGISTRY.clear()
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data)
+def testGetDataset(mock_func: mock.MagicMock):
+    status, headers, body = get('/dataset', b'name=test_dataset.json')
+    assert status == 200
+    assert body == test_data_json
+    assert headers['content-type'] == 'application/json'
+    assert headers['content-length'] == str(len(test_data_json))
+    assert (headers['content-disposition'] ==
+            'attachment; filename=test_dataset.json')
+    assert headers['cache-control'] == 'public, max-age=7200'
+    assert headers['access-control-allow-origin'] == '*'
+    mock_func.assert_called_once_with('test', 'test_dataset.json')
+
+    status, _, body = get('/dataset', b'name=test_dataset.json')
+    assert status == 200
+    assert body == test_data_json
+    mock_func.assert_called_once()
+    assert metrics.REQUESTS.get(('/dataset', '200')) == 2
+    assert metrics.RESPONSE_BYTES.get(
+        ('/dataset', 'test_dataset.json')) == 2 * len(test_data_json)
+    assert metrics.IN_FLIGHT_REQUESTS.get() == 0
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data)
+def testGetDataset_HitDoesNotUseThread(mock_func: mock.MagicMock):
+    get('/dataset', b'name=test_dataset.json')
+    with mock.patch.object(asgi.executor, 'submit') as submit:
+        status, _, body = get('/dataset', b'name=test_dataset.json')
+    assert status == 200
+    assert body == test_data_json
+    submit.assert_not_called()
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data)
+def testGetDataset_Gzip(mock_func: mock.MagicMock):
+    status, headers, body = get('/dataset', b'name=test_dataset.json',
+                                [('Accept-Encoding', 'gzip')])
+    assert status == 200
+    assert headers['content-encoding'] == 'gzip'
+    assert gzip.decompress(body) == test_data_json
+
+    status, _, body = get('/dataset', b'name=test_dataset.json',
+                          [('Accept-Encoding', 'gzip'),
+                           ('If-None-Match', headers['etag'])])
+    assert status == 304
+    assert body == b''
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data)
+def testGetDataset_Chunked(mock_func: mock.MagicMock):
+    with mock.patch.object(asgi, 'CHUNK_BYTES', 100):
+        messages = asyncio.run(call_app('/dataset', b'name=test_dataset.json'))
+    bodies = [message['body'] for message in messages[1:]]
+    assert len(bodies) == -(-len(test_data_json) // 100)
+    assert all(message['more_body'] for message in messages[1:-1])
+    assert b''.join(bodies) == test_data_json
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data)
+def testGetDataset_ClientDisconnects(mock_func: mock.MagicMock):
+    with mock.patch.object(asgi, 'CHUNK_BYTES', 100):
+        messages = asyncio.run(call_app('/dataset', b'name=test_dataset.json',
+                                        disconnect_after=2))
+    # The start message and two chunks were sent before the disconnect.
+    assert len(messages) == 3
+    assert metrics.RESPONSE_BYTES.get(('/dataset', 'test_dataset.json')) == 200
+    assert metrics.IN_FLIGHT_REQUESTS.get() == 0
+
+
+def testGetDataset_ConcurrentMissesShareFetch():
+    release = threading.Event()
+    calls = []
+
+    def slow_download(gcs_bucket: str, filename: str):
+        calls.append(filename)
+        release.wait()
+        return test_data
+
+    async def run():
+        requests = [asyncio.ensure_future(
+            call_app('/dataset', b'name=test_dataset.json'))
+            for _ in range(5)]
+        # Let all requests reach the cache before the download finishes.
+        while cache.stats()['misses'] < 5:
+            await asyncio.sleep(0.01)
+        release.set()
+        return await asyncio.gather(*requests)
+
+    with mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+                    side_effect=slow_download):
+        results = asyncio.run(run())
+    assert calls == ['test_dataset.json']
+    for messages in results:
+        assert messages[0]['status'] == 200
+        assert b''.join(m['body'] for m in messages[1:]) == test_data_json
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=google.cloud.exceptions.NotFound('File not found'))
+def testGetDataset_NotFound(mock_func: mock.MagicMock):
+    status, _, body = get('/dataset', b'name=not_a_dataset.json')
+    assert status == 500
+    assert b'Internal server error' in body
+    assert metrics.REQUESTS.get(('/dataset', '500')) == 1
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data)
+def testGetMetadata(mock_func: mock.MagicMock):
+    status, headers, body = get('/metadata')
+    assert status == 200
+    assert body == test_data_json
+    assert (headers['content-disposition'] ==
+            'attachment; filename=test_data.ndjson')
+    mock_func.assert_called_once_with('test', 'test_data.ndjson')
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes')
+def testGetMetadata_FilenameNotSet(mock_func: mock.MagicMock):
+    with mock.patch.dict(os.environ):
+        del os.environ['METADATA_FILENAME']
+        status, _, body = get('/metadata')
+    assert status == 500
+    assert b'METADATA_FILENAME is not set' in body
+    mock_func.assert_not_called()
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data)
+def testGetDataset_FilteredUsesFlaskApp(mock_func: mock.MagicMock):
+    status, headers, body = get('/dataset',
+                                b'name=test_dataset.json&fips=01001')
+    assert status == 200
+    assert headers['access-control-allow-origin'] == '*'
+    rows = json.loads(body)
+    assert len(rows) == 20
+    assert all(row['county_fips'] == '01001' for row in rows)
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data)
+def testGetDataset_Range(mock_func: mock.MagicMock):
+    status, headers, body = get('/dataset', b'name=test_dataset.json',
+                                [('Range', 'bytes=10-19')])
+    assert status == 206
+    assert body == test_data_json[10:20]
+    assert headers['content-length'] == '10'
+
+    status, _, _ = get('/dataset', b'name=test_dataset.json',
+                       [('Range', 'bytes=100000-')])
+    assert status == 416
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data)
+def testGetDataset_PaginatedUsesFlaskApp(mock_func: mock.MagicMock):
+    status, headers, body = get('/dataset',
+                                b'name=test_dataset.json&offset=2&limit=2')
+    assert status == 200
+    assert headers['x-total-count'] == '60'
+    assert [row['population'] for row in json.loads(body)] == [3, 1]
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data)
+def testGetDatasets_UsesFlaskApp(mock_func: mock.MagicMock):
+    status, _, body = get('/datasets', b'name=a.json&name=b.json')
+    assert status == 200
+    response = json.loads(body)
+    assert set(response['datasets']) == {'a.json', 'b.json'}
+    assert response['errors'] == {}
+
+
+def testGetDataset_InvalidParams():
+    status, _, body = get('/dataset')
+    assert status == 400
+    assert b'name' in body
+
+    status, _, _ = get('/dataset', b'name=a.json&format=xml')
+    assert status == 400
+
+
+def testGetProgramName():
+    assert get('/') == (200, mock.ANY, b'Running data server.')
+
+
+def testLifespan():
+    async def run():
+        messages = [{'type': 'lifespan.shutdown'},
+                    {'type': 'lifespan.startup'}]
+        sent = []
+
+        async def receive():
+            return messages.pop()
+
+        async def send(message):
+            sent.append(message['type'])
+
+        await asgi.app({'type': 'lifespan'}, receive, send)
+        return sent
+
+    assert asyncio.run(run()) == ['lifespan.startup.complete',
+                                  'lifespan.shutdown.complete']
@@ -1,15 +1,18 @@
+import gzip
+import hashlib
 import json
 import os
+import threading
 from unittest import mock
 
 import google.cloud.exceptions
 import pytest
 from flask.testing import FlaskClient
 
+from data_server import metrics
 from data_server.dataset_cache import DatasetCache
 from main import app, cache
 
-os.environ['GCS_BUCKET'] = 'test'
 os.environ['METADATA_FILENAME'] = 'test_data.ndjson'
 
 test_data = (
@@ -32,22 +35,42 @@ test_data_csv = (
     b'label1,label2,label3\nvalueA,valueB,valueC\nvalueD,valueE,valueF\n')
 
 
+# Large enough to be served compressed.
+test_data_large = test_data * 10
+test_data_large_json = b'[' + b','.join(test_data_large.splitlines()) + b']'
+
+
 def get_test_data(gcs_bucket: str, filename: str):
     """Returns the contents of filename as a bytes object. Meant to be used to
     patch gcs_utils.download_blob_as_bytes."""
     return test_data
 
 
+def get_test_data_large(gcs_bucket: str, filename: str):
+    """Returns the contents of a large filename as a bytes object. Meant to be
+    used to patch gcs_utils.download_blob_as_bytes."""
+    return test_data_large
+
+
 def get_test_data_csv(gcs_bucket: str, filename: str):
     """Returns the contents of filename.csv as a bytes object. Meant to be used to
     patch gcs_utils.download_blob_as_bytes."""
     return test_data_csv
 
 
+@pytest.fixture(autouse=True)
+def gcs_bucket():
+    """Serves datasets from the test bucket. main reads GCS_BUCKET when it is
+    imported, before it can be set here."""
+    with mock.patch('main.GCS_BUCKET', 'test'):
+        yield
+
+
 @pytest.fixture(autouse=True)
 def reset_cache():
-    """Clears the global cache before every test is run."""
+    """Clears the global cache and metrics before every test is run."""
     cache.clear()
+    metrics.REGISTRY.clear()
 
 
 @pytest.fixture
@@ -155,3 +178,402 @@ def testGetDataset_csvType(mock_func: mock.MagicMock, client: FlaskClient):
            'attachment; filename=test_dataset.csv')
     # Make sure that the response hasn't changed
     assert response.data == test_data_csv
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data_large)
+def testGetDataset_Gzip(mock_func: mock.MagicMock, client: FlaskClient):
+    response = client.get('/dataset?name=test_dataset',
+                          headers={'Accept-Encoding': 'gzip, deflate'})
+    assert response.status_code == 200
+    assert response.headers.get('Content-Encoding') == 'gzip'
+    assert response.headers.get('Vary') == 'Accept-Encoding'
+    assert int(response.headers.get('Content-Length')) == len(response.data)
+    assert len(response.data) < len(test_data_large_json)
+    assert gzip.decompress(response.data) == test_data_large_json
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data_large)
+def testGetDataset_Brotli(mock_func: mock.MagicMock, client: FlaskClient):
+    brotli = pytest.importorskip('brotli')
+    response = client.get('/dataset?name=test_dataset',
+                          headers={'Accept-Encoding': 'gzip, deflate, br'})
+    assert response.status_code == 200
+    assert response.headers.get('Content-Encoding') == 'br'
+    assert brotli.decompress(response.data) == test_data_large_json
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data_large)
+def testGetDataset_Uncompressed(mock_func: mock.MagicMock,
+                                client: FlaskClient):
+    response = client.get('/dataset?name=test_dataset',
+                          headers={'Accept-Encoding': 'gzip;q=0, identity'})
+    assert response.status_code == 200
+    assert response.headers.get('Content-Encoding') is None
+    assert response.data == test_data_large_json
+
+    response = client.get('/dataset?name=test_dataset')
+    assert response.headers.get('Content-Encoding') is None
+    assert response.data == test_data_large_json
+    mock_func.assert_called_once()
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data_large)
+def testGetMetadata_Gzip(mock_func: mock.MagicMock, client: FlaskClient):
+    response = client.get('/metadata', headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.headers.get('Content-Encoding') == 'gzip'
+    assert gzip.decompress(response.data) == test_data_large_json
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data)
+def testGetDataset_NotModified(mock_func: mock.MagicMock, client: FlaskClient):
+    response = client.get('/dataset?name=test_dataset')
+    etag = response.headers.get('ETag')
+    assert etag == '"{}"'.format(hashlib.md5(test_data).hexdigest())
+
+    response = client.get('/dataset?name=test_dataset',
+                          headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+    assert response.headers.get('ETag') == etag
+    assert response.headers.get('Cache-Control') == 'public, max-age=7200'
+    assert response.headers.get('Vary') == 'Accept-Encoding'
+
+    response = client.get('/dataset?name=test_dataset',
+                          headers={'If-None-Match': '"stale"'})
+    assert response.status_code == 200
+    assert response.data == test_data_json
+    mock_func.assert_called_once()
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data_large)
+def testGetDataset_EtagPerEncoding(mock_func: mock.MagicMock,
+                                   client: FlaskClient):
+    response = client.get('/dataset?name=test_dataset',
+                          headers={'Accept-Encoding': 'gzip'})
+    gzip_etag = response.headers.get('ETag')
+    assert gzip_etag == '"{}-gzip"'.format(
+        hashlib.md5(test_data_large).hexdigest())
+
+    # A gzip ETag doesn't match the uncompressed body.
+    response = client.get('/dataset?name=test_dataset',
+                          headers={'If-None-Match': gzip_etag})
+    assert response.status_code == 200
+    assert response.data == test_data_large_json
+
+    response = client.get('/dataset?name=test_dataset',
+                          headers={'Accept-Encoding': 'gzip',
+                                   'If-None-Match': gzip_etag})
+    assert response.status_code == 304
+
+
+test_data_county = (
+    b'{"county_fips":"06001","time_period":"2021-12","cases":1}\n'
+    b'{"county_fips":"06001","time_period":"2022-01","cases":2}\n'
+    b'{"county_fips":"01001","time_period":"2022-01","cases":3}\n')
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            return_value=test_data_county)
+def testGetDataset_Filtered(mock_func: mock.MagicMock, client: FlaskClient):
+    response = client.get(
+        '/dataset?name=test_county&fips_prefix=06&time_period=2022')
+    assert response.status_code == 200
+    assert response.headers.get('Access-Control-Allow-Origin') == '*'
+    assert response.data == (
+        b'[{"county_fips":"06001","time_period":"2022-01","cases":2}]')
+
+    response = client.get('/dataset?name=test_county&fips=01001')
+    assert json.loads(response.data) == [
+        {'county_fips': '01001', 'time_period': '2022-01', 'cases': 3}]
+
+    response = client.get('/dataset?name=test_county&fips=99999')
+    assert response.data == b'[]'
+    mock_func.assert_called_once()
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            return_value=test_data_county)
+def testGetDataset_Columns(mock_func: mock.MagicMock, client: FlaskClient):
+    response = client.get(
+        '/dataset?name=test_county&columns=time_period,cases&fips_prefix=06')
+    assert response.status_code == 200
+    assert json.loads(response.data) == [
+        {'time_period': '2021-12', 'cases': 1},
+        {'time_period': '2022-01', 'cases': 2}]
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            return_value=test_data_county)
+def testGetDataset_FilteredNotModified(mock_func: mock.MagicMock,
+                                       client: FlaskClient):
+    response = client.get('/dataset?name=test_county&fips_prefix=06')
+    etag = response.headers.get('ETag')
+    assert etag != client.get('/dataset?name=test_county').headers.get('ETag')
+
+    response = client.get('/dataset?name=test_county&fips_prefix=06',
+                          headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+    response = client.get('/dataset?name=test_county&fips_prefix=01',
+                          headers={'If-None-Match': etag})
+    assert response.status_code == 200
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data_csv)
+def testGetDataset_FilteredCsv(mock_func: mock.MagicMock,
+                               client: FlaskClient):
+    response = client.get('/dataset?name=test_dataset.csv&fips=06')
+    assert response.status_code == 400
+    assert b'only supported for JSON datasets' in response.data
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            return_value=test_data_county)
+def testGetDataset_Paginated(mock_func: mock.MagicMock, client: FlaskClient):
+    response = client.get('/dataset?name=test_county&offset=1&limit=1')
+    assert response.status_code == 200
+    assert response.headers.get('X-Total-Count') == '3'
+    assert json.loads(response.data) == [
+        {'county_fips': '06001', 'time_period': '2022-01', 'cases': 2}]
+
+    response = client.get('/dataset?name=test_county&offset=1')
+    assert [row['cases'] for row in json.loads(response.data)] == [2, 3]
+
+    # Pages are taken from the rows matching the filters.
+    response = client.get(
+        '/dataset?name=test_county&fips_prefix=06&offset=1&limit=5')
+    assert response.headers.get('X-Total-Count') == '2'
+    assert [row['cases'] for row in json.loads(response.data)] == [2]
+
+    response = client.get('/dataset?name=test_county&offset=10')
+    assert response.data == b'[]'
+    mock_func.assert_called_once()
+
+
+def testGetDataset_PaginationInvalid(client: FlaskClient):
+    response = client.get('/dataset?name=test_county&offset=-1')
+    assert response.status_code == 400
+    assert b'offset' in response.data
+
+    response = client.get('/dataset?name=test_county&limit=ten')
+    assert response.status_code == 400
+    assert b'limit' in response.data
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data_large)
+def testGetDataset_Range(mock_func: mock.MagicMock, client: FlaskClient):
+    response = client.get('/dataset?name=test_dataset',
+                          headers={'Accept-Encoding': 'identity'})
+    assert response.headers.get('Accept-Ranges') == 'bytes'
+    etag = response.headers.get('ETag')
+
+    response = client.get('/dataset?name=test_dataset',
+                          headers={'Accept-Encoding': 'identity',
+                                   'Range': 'bytes=0-9'})
+    assert response.status_code == 206
+    assert response.data == test_data_large_json[:10]
+    assert (response.headers.get('Content-Range') ==
+            'bytes 0-9/{}'.format(len(test_data_large_json)))
+
+    # Resume a download from where it stopped.
+    response = client.get('/dataset?name=test_dataset',
+                          headers={'Accept-Encoding': 'identity',
+                                   'Range': 'bytes=10-', 'If-Range': etag})
+    assert response.status_code == 206
+    assert response.data == test_data_large_json[10:]
+
+    # The dataset changed since the download started, so send all of it.
+    response = client.get('/dataset?name=test_dataset',
+                          headers={'Accept-Encoding': 'identity',
+                                   'Range': 'bytes=10-',
+                                   'If-Range': '"old-etag"'})
+    assert response.status_code == 200
+    assert response.data == test_data_large_json
+
+    response = client.get('/dataset?name=test_dataset',
+                          headers={'Accept-Encoding': 'identity',
+                                   'Range': 'bytes=100000-'})
+    assert response.status_code == 416
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data_large)
+def testGetDataset_RangeGzip(mock_func: mock.MagicMock, client: FlaskClient):
+    full = client.get('/dataset?name=test_dataset',
+                      headers={'Accept-Encoding': 'gzip'}).data
+    response = client.get('/dataset?name=test_dataset',
+                          headers={'Accept-Encoding': 'gzip',
+                                   'Range': 'bytes=5-'})
+    assert response.status_code == 206
+    assert response.headers.get('Content-Encoding') == 'gzip'
+    # Ranges are of the compressed body.
+    assert response.data == full[5:]
+
+
+def get_test_data_by_name(gcs_bucket: str, filename: str):
+    """Returns different contents depending on filename. Meant to be used to
+    patch gcs_utils.download_blob_as_bytes."""
+    if filename == 'not_found':
+        raise google.cloud.exceptions.NotFound('File not found')
+    if filename.endswith('.csv'):
+        return test_data_csv
+    if filename == 'county':
+        return test_data_county
+    return test_data
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data_by_name)
+def testGetDatasets(mock_func: mock.MagicMock, client: FlaskClient):
+    response = client.get(
+        '/datasets?name=test_dataset&name=county&name=test.csv&name=county')
+    assert response.status_code == 200
+    assert response.headers.get('Access-Control-Allow-Origin') == '*'
+    assert response.headers.get('Cache-Control') == 'public, max-age=7200'
+    body = json.loads(response.data)
+    assert list(body['datasets']) == ['test_dataset', 'county', 'test.csv']
+    assert body['datasets']['test_dataset'] == json.loads(test_data_json)
+    assert body['datasets']['county'][0]['county_fips'] == '06001'
+    assert body['datasets']['test.csv'] == test_data_csv.decode()
+    assert body['errors'] == {}
+    assert mock_func.call_count == 3
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data_by_name)
+def testGetDatasets_PartialFailure(mock_func: mock.MagicMock,
+                                   client: FlaskClient):
+    response = client.get('/datasets?name=not_found&name=test_dataset')
+    assert response.status_code == 200
+    assert response.headers.get('Cache-Control') is None
+    body = json.loads(response.data)
+    assert list(body['datasets']) == ['test_dataset']
+    assert body['errors'] == {
+        'not_found': 'Internal server error: 404 File not found'}
+
+
+def testGetDatasets_InvalidParams(client: FlaskClient):
+    response = client.get('/datasets')
+    assert response.status_code == 400
+    assert b'Request missing required url param \'name\'' in response.data
+
+    response = client.get('/datasets?' + '&'.join(
+        'name=dataset{}'.format(i) for i in range(21)))
+    assert response.status_code == 400
+
+
+def testGetDatasets_FetchesConcurrently(client: FlaskClient):
+    # Each download waits for the other one to start, which only succeeds if
+    # they run at the same time.
+    barrier = threading.Barrier(2, timeout=5)
+
+    def download(gcs_bucket: str, filename: str):
+        barrier.wait()
+        return test_data
+
+    with mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+                    side_effect=download):
+        response = client.get('/datasets?name=dataset1&name=dataset2')
+    assert response.status_code == 200
+    assert json.loads(response.data)['errors'] == {}
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            return_value=test_data_county)
+def testGetDataset_Arrow(mock_func: mock.MagicMock, client: FlaskClient):
+    pa = pytest.importorskip('pyarrow')
+    response = client.get('/dataset?name=test_county.json&format=arrow')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/vnd.apache.arrow.stream'
+    assert (response.headers.get('Content-Disposition') ==
+            'attachment; filename=test_county.arrow')
+    table = pa.ipc.open_stream(response.data).read_all()
+    assert table.to_pylist() == [json.loads(row) for row in
+                                 test_data_county.splitlines()]
+
+    etag = response.headers.get('ETag')
+    response = client.get('/dataset?name=test_county.json&format=arrow',
+                          headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    mock_func.assert_called_once()
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            return_value=test_data_county)
+def testGetDataset_ArrowFiltered(mock_func: mock.MagicMock,
+                                 client: FlaskClient):
+    pa = pytest.importorskip('pyarrow')
+    response = client.get('/dataset?name=test_county.json&format=arrow'
+                          '&fips_prefix=06&columns=time_period,cases')
+    assert response.status_code == 200
+    table = pa.ipc.open_stream(response.data).read_all()
+    assert table.to_pylist() == [{'time_period': '2021-12', 'cases': 1},
+                                 {'time_period': '2022-01', 'cases': 2}]
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data_csv)
+def testGetDataset_ArrowUnavailable(mock_func: mock.MagicMock,
+                                    client: FlaskClient):
+    response = client.get('/dataset?name=test_dataset.csv&format=arrow')
+    assert response.status_code == 400
+    assert b'not available in Arrow format' in response.data
+
+    response = client.get('/dataset?name=test_dataset.csv&format=xml')
+    assert response.status_code == 400
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data)
+def testGetMetrics(mock_func: mock.MagicMock, client: FlaskClient):
+    # The test client only sends the body of a response once it is read.
+    assert client.get('/dataset?name=test_dataset').data == test_data_json
+    assert client.get('/dataset?name=test_dataset').data == test_data_json
+    assert b'missing' in client.get('/dataset').data
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    lines = response.data.decode().splitlines()
+    assert ('data_server_requests_total{route="/dataset",status="200"} 2'
+            in lines)
+    assert ('data_server_requests_total{route="/dataset",status="400"} 1'
+            in lines)
+    assert ('data_server_request_seconds_count{route="/dataset",'
+            'dataset="test_dataset"} 2' in lines)
+    assert ('data_server_response_bytes_total{route="/dataset",'
+            'dataset="test_dataset"} ' + str(2 * len(test_data_json))
+            in lines)
+    # Only the request for /metrics itself is in progress.
+    assert 'data_server_in_flight_requests 1' in lines
+    assert 'data_server_gcs_download_seconds_count 1' in lines
+    assert ('data_server_gcs_download_bytes_total ' + str(len(test_data))
+            in lines)
+    assert 'data_server_cache_hits_total 1' in lines
+    assert 'data_server_cache_misses_total 1' in lines
+    assert 'data_server_cache_entries 1' in lines
+    assert 'data_server_cache_warmer_preloaded_total 0' in lines
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=google.cloud.exceptions.NotFound('File not found'))
+def testGetMetrics_UnknownDatasetNotLabelled(mock_func: mock.MagicMock,
+                                             client: FlaskClient):
+    assert b'Internal server error' in client.get(
+        '/dataset?name=not_a_dataset').data
+
+    lines = client.get('/metrics').data.decode().splitlines()
+    assert ('data_server_requests_total{route="/dataset",status="500"} 1'
+            in lines)
+    assert ('data_server_request_seconds_count{route="/dataset",'
+            'dataset=""} 1' in lines)
+    assert not any('not_a_dataset' in line for line in lines)
@@ -0,0 +1,255 @@
+"""Compares the ways of splitting a county-level table into per-state files,
+against local stand-ins for BigQuery and GCS that add a fixed latency to every
+request.
+
+The query mode runs one query per state, each of which scans the whole table.
+The single_scan mode reads the table once and partitions it in memory. The
+streaming mode runs one query per state like the query mode, but writes rows
+to GCS as they are fetched. The benchmark also checks that all modes write
+byte-identical files.
+
+With --memory, the peak memory allocated while splitting the table is traced
+for each mode, which makes every mode slower. The uploaded files are kept on
+disk so they aren't counted.
+
+Usage, from the exporter directory:
+    python benchmarks/bench_county_split.py [--counties 3200] [--periods 36]
+                                            [--bq-latency-ms 1000]
+                                            [--upload-latency-ms 100]
+                                            [--memory]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+from google.cloud import bigquery  # type: ignore
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+def make_county_table(num_counties: int, num_periods: int) -> pd.DataFrame:
+    """Returns a county-level, by race time series table."""
+    rng = np.random.default_rng(0)
+    state_fips = rng.choice(main.STATE_LEVEL_FIPS_LIST, num_counties)
+    county_fips = [f'{state}{i % 1000:03d}' for i, state in enumerate(state_fips)]
+    races = ['AIAN_NH', 'ASIAN_NH', 'BLACK_NH', 'HISP', 'NHPI_NH',
+             'MULTI_OR_OTHER_STANDARD_NH', 'WHITE_NH', 'ALL']
+    periods = [f'{2020 + i // 12}-{i % 12 + 1:02d}' for i in range(num_periods)]
+    index = pd.MultiIndex.from_product([county_fips, periods, races],
+                                       names=['county_fips', 'time_period',
+                                              'race_category_id'])
+    table_df = index.to_frame(index=False)
+    table_df.insert(0, 'state_fips', table_df['county_fips'].str[:2])
+    num_rows = len(table_df)
+    table_df['covid_cases_per_100k'] = rng.uniform(0, 5000, num_rows).round(1)
+    table_df['covid_deaths_per_100k'] = rng.uniform(0, 200, num_rows).round(1)
+    table_df['covid_population_pct'] = rng.uniform(0, 100, num_rows).round(1)
+    # Some suppressed values, which are written as null.
+    table_df.loc[table_df.index % 7 == 0, 'covid_deaths_per_100k'] = None
+    return table_df
+
+
+class FakeRowIterator():
+    def __init__(self, get_df, latency: float):
+        self.get_df = get_df
+        self.latency = latency
+
+    def to_dataframe(self):
+        time.sleep(self.latency)
+        return self.get_df()
+
+
+class FakePageIterator():
+    # The columns of the table already have the dtypes of query results.
+    schema: list = []
+
+    def __init__(self, table_df: pd.DataFrame, positions, page_size: int,
+                 latency: float):
+        self.table_df = table_df
+        self.positions = positions
+        self.page_size = page_size
+        self.latency = latency
+
+    def to_dataframe_iterable(self, dtypes):
+        """Yields the pages of the results, fetching page_size rows at a
+        time."""
+        time.sleep(self.latency)
+        for start in range(0, len(self.positions), self.page_size):
+            yield self.table_df.iloc[self.positions[start:start + self.page_size]]
+
+
+class FakeQueryJob(FakeRowIterator):
+    def __init__(self, table_df: pd.DataFrame, positions, latency: float):
+        super().__init__(
+            lambda: table_df.iloc[positions].reset_index(drop=True), latency)
+        self.table_df = table_df
+        self.positions = positions
+
+    def result(self, page_size: int):
+        return FakePageIterator(self.table_df, self.positions, page_size,
+                                self.latency)
+
+
+class FakeBigQueryClient():
+    """Answers the per-state county_fips LIKE queries and reads of the whole
+    table from an in-memory DataFrame. Every query scans the whole table."""
+
+    def __init__(self, table_df: pd.DataFrame, latency: float):
+        self.table_df = table_df
+        self.latency = latency
+        self.requests = 0
+
+    def query(self, query: str):
+        self.requests += 1
+        fips = query.split("LIKE '")[1][:2]
+        county_fips = self.table_df['county_fips']
+        matches = (county_fips.str.len() == 5) & (county_fips.str[:2] == fips)
+        return FakeQueryJob(self.table_df, np.flatnonzero(matches), self.latency)
+
+    def list_rows(self, table):
+        self.requests += 1
+        return FakeRowIterator(self.table_df.copy, self.latency)
+
+
+class FakeBlobWriter():
+    """Writes to a local file in chunks of chunk_size, each of which is
+    uploaded with the latency of the bucket."""
+
+    def __init__(self, path: str, chunk_size: int, latency: float):
+        self.file = open(path, 'wb')
+        self.chunk_size = chunk_size
+        self.latency = latency
+        self.buffer = bytearray()
+
+    def write(self, data: bytes):
+        self.buffer += data
+        if len(self.buffer) >= self.chunk_size:
+            self.upload(self.buffer[:self.chunk_size])
+            del self.buffer[:self.chunk_size]
+
+    def upload(self, chunk):
+        time.sleep(self.latency)
+        self.file.write(chunk)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.upload(self.buffer)
+        self.file.close()
+
+
+class FakeBlob():
+    def __init__(self, bucket, name: str):
+        self.bucket = bucket
+        self.name = name
+        self.path = os.path.join(bucket.directory, name)
+
+    def upload_from_string(self, data, content_type=None):
+        time.sleep(self.bucket.latency)
+        with open(self.path, 'w') as blob_file:
+            blob_file.write(data)
+
+    def open(self, mode, chunk_size, content_type=None):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        return FakeBlobWriter(self.path, chunk_size, self.bucket.latency)
+
+    def patch(self):
+        time.sleep(self.bucket.latency)
+
+    def delete(self):
+        time.sleep(self.bucket.latency)
+        os.remove(self.path)
+
+
+class FakeBucket():
+    def __init__(self, directory: str, latency: float):
+        self.directory = directory
+        self.latency = latency
+
+    def blob(self, name: str):
+        return FakeBlob(self, name)
+
+    def copy_blob(self, blob, destination_bucket, new_name: str):
+        time.sleep(self.latency)
+        shutil.copyfile(blob.path, os.path.join(destination_bucket.directory, new_name))
+
+    def read_files(self):
+        # Temporary blobs are deleted by the time the files are read, leaving
+        # only their empty directories.
+        files = {}
+        for name in os.listdir(self.directory):
+            if os.path.isdir(os.path.join(self.directory, name)):
+                continue
+            with open(os.path.join(self.directory, name)) as blob_file:
+                files[name] = blob_file.read()
+        return files
+
+
+def run(table_df, args, split_mode: str):
+    bq_client = FakeBigQueryClient(table_df, args.bq_latency_ms / 1000)
+    table = bigquery.Table('my-project.my-dataset.by_race_county_time_series')
+    with tempfile.TemporaryDirectory() as directory:
+        bucket = FakeBucket(directory, args.upload_latency_ms / 1000)
+        with mock.patch('main.prepare_bucket', return_value=bucket):
+            if args.memory:
+                tracemalloc.start()
+            start = time.perf_counter()
+            error = main.export_split_county_tables(bq_client, table, 'my-bucket',
+                                                    split_mode=split_mode)
+            elapsed = time.perf_counter() - start
+            peak = None
+            if args.memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+        if error is not None:
+            raise RuntimeError(error)
+        return elapsed, peak, bq_client.requests, bucket.read_files()
+
+
+def benchmark():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--counties', type=int, default=3200)
+    parser.add_argument('--periods', type=int, default=36)
+    parser.add_argument('--bq-latency-ms', type=float, default=1000,
+                        help='round trip and job overhead of each BigQuery '
+                             'request')
+    parser.add_argument('--upload-latency-ms', type=float, default=100)
+    parser.add_argument('--memory', action='store_true',
+                        help='trace the peak memory of each mode')
+    args = parser.parse_args()
+
+    table_df = make_county_table(args.counties, args.periods)
+    print(f'{len(table_df)} rows, {len(main.STATE_LEVEL_FIPS_LIST)} states')
+
+    results = {}
+    for split_mode in main.COUNTY_SPLIT_MODES:
+        elapsed, peak, requests, files = run(table_df, args, split_mode)
+        results[split_mode] = files
+        size = sum(len(data) for data in files.values())
+        line = (f'{split_mode}: {elapsed:.2f}s, {requests} BigQuery requests, '
+                f'{len(files)} files, {size / 2**20:.1f}MiB')
+        if peak is not None:
+            line += f', peak memory {peak / 2**20:.1f}MiB'
+        print(line)
+
+    identical = True
+    for split_mode in ['single_scan', 'streaming']:
+        mode_identical = results['query'] == results[split_mode]
+        print(f'query and {split_mode} files byte-identical: {mode_identical}')
+        identical = identical and mode_identical
+    if not identical:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -1,18 +1,76 @@
+import gzip
+import json
 import logging
 import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 #
+import pandas as pd
 from flask import Flask, request
-from google.cloud import bigquery, storage
+from google.cloud import bigquery, exceptions, storage
 
 
 app = Flask(__name__)
 
+# Ways of splitting county-level tables by state, set with the
+# COUNTY_SPLIT_MODE env variable. "query" runs one query per state,
+# "single_scan" reads the table once and partitions it in memory, and
+# "streaming" runs one query per state and streams its rows to GCS without
+# holding them all in memory.
+COUNTY_SPLIT_MODES = ['query', 'single_scan', 'streaming']
+# Max number of state files uploaded at once in single_scan and streaming mode.
+MAX_CONCURRENT_UPLOADS = 8
+# Number of rows fetched from BigQuery at once in streaming mode.
+STREAMING_PAGE_SIZE = 10000
+# pandas dtypes that QueryJob.to_dataframe gives columns of these BigQuery
+# types, which are set on each page of rows in streaming mode so it writes the
+# same JSON as the other modes. Other columns are inferred as objects by both.
+QUERY_RESULT_DTYPES = {
+    'INTEGER': 'Int64', 'INT64': 'Int64',
+    'FLOAT': 'float64', 'FLOAT64': 'float64',
+    'BOOLEAN': 'boolean', 'BOOL': 'boolean',
+    'TIMESTAMP': 'datetime64[ns, UTC]',
+    'DATETIME': 'datetime64[ns]',
+    'DATE': 'dbdate',
+}
+# Size of the chunks of the resumable uploads in streaming mode, which must be
+# a multiple of 256KiB. At most one chunk per upload is held in memory.
+UPLOAD_CHUNK_BYTES = 4 * 1024 * 1024
+# Prefix of the names of the blobs files are uploaded to in streaming mode
+# before they are copied to their own names, which no dataset name starts with.
+TEMP_BLOB_PREFIX = 'tmp/'
+# Formats each table and county-level file can also be exported in, besides
+# uncompressed newline delimited JSON, set with the comma separated
+# EXTRA_EXPORT_FORMATS env variable. Maps each to the extension of its files,
+# which replaces .json. Gzipped files don't set their Content-Encoding, so GCS
+# serves their compressed bytes as they are.
+EXTRA_EXPORT_FORMATS = {'json_gzip': '.json.gz', 'parquet': '.parquet'}
+# Default max number of tables exported at once, which can be overridden with
+# the MAX_CONCURRENT_TABLE_EXPORTS env variable.
+DEFAULT_MAX_CONCURRENT_TABLE_EXPORTS = 4
+# Key of the exported blob metadata recording the fingerprint of the table it
+# was exported from, so unchanged tables can be skipped.
+FINGERPRINT_METADATA_KEY = 'export_fingerprint'
+# Keys of the exported blob metadata recording the table a blob was exported
+# from, its number of rows, and the table's columns as a JSON list. They are
+# read back to build the dataset manifest.
+TABLE_METADATA_KEY = 'export_table'
+ROW_COUNT_METADATA_KEY = 'export_row_count'
+COLUMNS_METADATA_KEY = 'export_columns'
+# Suffix of the name of the manifest blob written for each dataset, after the
+# dataset name.
+MANIFEST_SUFFIX = '-manifest.json'
+
 
 @app.route('/', methods=['POST'])
 def export_dataset_tables():
     """Exports the tables in the given dataset to GCS.
 
-       Request form must include the dataset name."""
+       Request form must include the dataset name. Tables that haven't changed
+       since they were last exported are skipped, unless the request form sets
+       force to true."""
     data = request.get_json()
 
     if data.get('dataset_name') is None:
@@ -26,6 +84,18 @@ def export_dataset_tables():
     project_id = os.environ.get('PROJECT_ID')
     export_bucket = os.environ.get('EXPORT_BUCKET')
     dataset_id = f'{project_id}.{dataset_name}'
+    split_mode = os.environ.get('COUNTY_SPLIT_MODE', 'query')
+    if split_mode not in COUNTY_SPLIT_MODES:
+        return (f'Invalid COUNTY_SPLIT_MODE {split_mode}, must be one of {COUNTY_SPLIT_MODES}', 500)
+    extra_formats = [export_format for export_format in
+                     os.environ.get('EXTRA_EXPORT_FORMATS', '').split(',') if export_format]
+    invalid_formats = [export_format for export_format in extra_formats
+                       if export_format not in EXTRA_EXPORT_FORMATS]
+    if invalid_formats:
+        return (f'Invalid EXTRA_EXPORT_FORMATS {invalid_formats}, must be in {list(EXTRA_EXPORT_FORMATS)}', 500)
+    if split_mode == 'streaming' and 'parquet' in extra_formats:
+        return ('COUNTY_SPLIT_MODE streaming can\'t export parquet files', 500)
+    force = data.get('force') is True
 
     bq_client = bigquery.Client()
     dataset = bq_client.get_dataset(dataset_id)
@@ -51,37 +121,226 @@ def export_dataset_tables():
     if not tables:
         return (f'Dataset has no tables with "{demographic}" in the table_id.', 500)
 
-    for table in tables:
-        # split up county-level tables by state and export those individually
-        if not has_multi_demographics(table.table_id):
-            export_split_county_tables(bq_client, table, export_bucket)
-
-        # export the full table
-        dest_uri = f'gs://{export_bucket}/{dataset_name}-{table.table_id}.json'
-        table_ref = dataset.table(table.table_id)
-        try:
-            export_table(bq_client, table_ref, dest_uri,
-                         'NEWLINE_DELIMITED_JSON')
+    max_workers = int(os.environ.get('MAX_CONCURRENT_TABLE_EXPORTS',
+                                     DEFAULT_MAX_CONCURRENT_TABLE_EXPORTS))
+    bucket = prepare_bucket(export_bucket)
 
-        except Exception as err:
-            logging.error(err)
-            return (f'Error exporting table {table.table_id} to {dest_uri}:\n{err}', 500)
+    def export(table):
+        start = time.monotonic()
+        error = export_table_with_splits(bq_client, dataset, dataset_name, table,
+                                         export_bucket, bucket,
+                                         split_mode=split_mode, extra_formats=extra_formats,
+                                         force=force)
+        return error, time.monotonic() - start
+
+    # Tables are exported concurrently: their extract jobs run in BigQuery at
+    # the same time, and one failing doesn't stop the others.
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(export, tables))
+
+    errors = []
+    for table, (error, seconds) in zip(tables, results):
+        logging.info(f'Exported table {table.table_id} in {seconds:.1f}s')
+        if error is not None:
+            errors.append(f'{error} ({seconds:.1f}s)')
+
+    # The manifest lists every file of the dataset, including those exported
+    # by earlier requests, so it is rewritten even if some tables failed.
+    try:
+        export_manifest(bucket, dataset_name)
+    except Exception as err:
+        logging.error(err)
+        errors.append(f'Error writing manifest of dataset {dataset_name}:\n{err}')
+
+    if errors:
+        return (f'Error exporting {len(errors)} of {len(tables)} tables:\n' +
+                '\n'.join(errors), 500)
 
     return ('', 204)
 
 
-def export_table(bq_client, table_ref, dest_uri, dest_fmt):
-    """ Run the extract job to export the given table to the given destination and wait for completion"""
-    job_config = bigquery.ExtractJobConfig(destination_format=dest_fmt)
-    extract_job = bq_client.extract_table(
+def export_table_with_splits(bq_client, dataset, dataset_name, table, export_bucket,
+                             bucket, split_mode='query', extra_formats=(), force=False):
+    """ Export the given table, and split it up by state if it is county-level.
+    The extract jobs run in BigQuery while the table is being split. The table
+    and its county-level files are also exported in each of extra_formats.
+
+    The table's row count and columns are stored in the metadata of the
+    exported blob for the manifest. Its fingerprint is stored there too once
+    everything was exported, and the export is skipped if the fingerprint
+    hasn't changed since, unless force is True.
+
+        RETURNS:
+        error message if the table or its county-level files couldn't be
+        exported, otherwise None """
+
+    blob_name = f'{dataset_name}-{table.table_id}.json'
+    dest_uri = f'gs://{export_bucket}/{blob_name}'
+    table_ref = dataset.table(table.table_id)
+    try:
+        table_info = bq_client.get_table(table_ref)
+        fingerprint = get_table_fingerprint(table_info, extra_formats)
+        if not force and get_blob_fingerprint(bucket, blob_name) == fingerprint:
+            logging.info(f'Skipping {table.table_id}, which is unchanged since it was last exported')
+            return None
+    except Exception as err:
+        # Export the table anyway, just without recording its fingerprint.
+        logging.error(err)
+        table_info = None
+        fingerprint = None
+
+    extra_blob_names = [f'{dataset_name}-{table.table_id}{EXTRA_EXPORT_FORMATS[export_format]}'
+                        for export_format in extra_formats]
+    extract_jobs = []
+    for export_format, name in zip(['json'] + list(extra_formats), [blob_name] + extra_blob_names):
+        dest_uri = f'gs://{export_bucket}/{name}'
+        try:
+            extract_jobs.append((start_export_table(bq_client, table_ref, dest_uri,
+                                                    *get_extract_format(export_format)),
+                                 dest_uri))
+        except Exception as err:
+            logging.error(err)
+            return f'Error exporting table {table.table_id} to {dest_uri}:\n{err}'
+
+    # split up county-level tables by state and export those individually
+    split_error = None
+    if not has_multi_demographics(table.table_id):
+        split_error = export_split_county_tables(bq_client, table, export_bucket,
+                                                 split_mode=split_mode,
+                                                 extra_formats=extra_formats)
+
+    # Errors splitting the table are reported along with the table's own.
+    split_error_message = split_error[0] if split_error is not None else None
+    for extract_job, dest_uri in extract_jobs:
+        try:
+            extract_job.result()
+            logging.info(f'Exported {table_ref.table_id} to {dest_uri}')
+        except Exception as err:
+            logging.error(err)
+            error = f'Error exporting table {table.table_id} to {dest_uri}:\n{err}'
+            return error if split_error_message is None else f'{split_error_message}\n{error}'
+
+    if table_info is None:
+        return split_error_message
+    metadata = get_blob_manifest_metadata(
+        table.table_id, table_info.num_rows, [field.name for field in table_info.schema])
+    try:
+        for name in extra_blob_names:
+            set_blob_metadata(bucket, name, metadata)
+        # Only skip the table next time if the county-level files were exported too.
+        if split_error is None:
+            metadata = {**metadata, FINGERPRINT_METADATA_KEY: fingerprint}
+        set_blob_metadata(bucket, blob_name, metadata)
+    except Exception as err:
+        logging.error(err)
+    return split_error_message
+
+
+def get_table_fingerprint(table, extra_formats=()):
+    """ Returns a string that changes whenever the contents of the table change,
+    made of its last modified time and its number of rows, or when it is
+    exported in different extra formats. """
+    fingerprint = f'{table.modified.isoformat()}/{table.num_rows}'
+    if extra_formats:
+        fingerprint += '/' + '+'.join(sorted(extra_formats))
+    return fingerprint
+
+
+def get_blob_fingerprint(bucket, blob_name):
+    """ Returns the fingerprint stored on the given blob, or None if the blob
+    doesn't exist or has no fingerprint. """
+    blob = bucket.get_blob(blob_name)
+    if blob is None or blob.metadata is None:
+        return None
+    return blob.metadata.get(FINGERPRINT_METADATA_KEY)
+
+
+def set_blob_metadata(bucket, blob_name, metadata):
+    blob = bucket.blob(blob_name)
+    blob.metadata = metadata
+    blob.patch()
+
+
+def get_blob_manifest_metadata(table_id, row_count, columns=None):
+    """ Returns the blob metadata recording what the manifest lists about the
+    blob. County-level files don't record columns, which are their table's. """
+    metadata = {TABLE_METADATA_KEY: table_id, ROW_COUNT_METADATA_KEY: str(row_count)}
+    if columns is not None:
+        metadata[COLUMNS_METADATA_KEY] = json.dumps(columns)
+    return metadata
+
+
+def get_manifest(bucket, dataset_name):
+    """ Describe every blob exported from the given dataset, from the blobs'
+    GCS properties and the metadata recorded on them when they were exported.
+
+        RETURNS:
+        dict with the dataset name and a list of files, each with its name,
+        table, row_count, size_bytes, md5_hash, columns and generation.
+        row_count, table and columns are None for blobs exported before they
+        were recorded. """
+
+    blobs = [blob for blob in bucket.list_blobs(prefix=f'{dataset_name}-')
+             if blob.name != f'{dataset_name}{MANIFEST_SUFFIX}']
+
+    table_columns = {}
+    for blob in blobs:
+        metadata = blob.metadata or {}
+        if COLUMNS_METADATA_KEY in metadata:
+            table_columns[metadata.get(TABLE_METADATA_KEY)] = json.loads(
+                metadata[COLUMNS_METADATA_KEY])
+
+    files = []
+    for blob in sorted(blobs, key=lambda blob: blob.name):
+        metadata = blob.metadata or {}
+        table_id = metadata.get(TABLE_METADATA_KEY)
+        row_count = metadata.get(ROW_COUNT_METADATA_KEY)
+        files.append({
+            'name': blob.name,
+            'table': table_id,
+            'row_count': int(row_count) if row_count is not None else None,
+            'size_bytes': blob.size,
+            'md5_hash': blob.md5_hash,
+            'columns': table_columns.get(table_id),
+            'generation': blob.generation,
+        })
+    return {'dataset': dataset_name, 'files': files}
+
+
+def export_manifest(bucket, dataset_name):
+    """ Write the manifest of the given dataset to `{dataset_name}-manifest.json`. """
+    manifest = get_manifest(bucket, dataset_name)
+    bucket.blob(f'{dataset_name}{MANIFEST_SUFFIX}').upload_from_string(
+        json.dumps(manifest, indent=2), content_type='application/json')
+    logging.info(f'Wrote manifest of {len(manifest["files"])} files of dataset {dataset_name}')
+
+
+def get_extract_format(export_format):
+    """ Returns the destination format and compression of the extract job
+    exporting a table as 'json' or one of EXTRA_EXPORT_FORMATS. """
+    if export_format == 'json_gzip':
+        return 'NEWLINE_DELIMITED_JSON', 'GZIP'
+    if export_format == 'parquet':
+        return 'PARQUET', None
+    return 'NEWLINE_DELIMITED_JSON', None
+
+
+def start_export_table(bq_client, table_ref, dest_uri, dest_fmt, compression=None):
+    """ Start the extract job to export the given table to the given destination, without waiting for it"""
+    job_config = bigquery.ExtractJobConfig(destination_format=dest_fmt,
+                                           compression=compression)
+    return bq_client.extract_table(
         table_ref, dest_uri, location='US', job_config=job_config)
-    extract_job.result()
-    logging.info(f'Exported {table_ref.table_id} to {dest_uri}')
 
 
-def export_split_county_tables(bq_client, table, export_bucket):
+def export_split_county_tables(bq_client, table, export_bucket, split_mode='query',
+                               extra_formats=()):
     """ Split county-level table by parent state FIPS,
-    and export as individual blobs to the given destination and wait for completion"""
+    and export as individual blobs to the given destination and wait for completion
+
+    split_mode: one of COUNTY_SPLIT_MODES
+    extra_formats: EXTRA_EXPORT_FORMATS each state's file is also exported in,
+                   which can't include parquet in streaming mode"""
 
     table_name = get_table_name(table)
     if "county" not in table_name:
@@ -91,6 +350,13 @@ def export_split_county_tables(bq_client, table, export_bucket):
         f'Exporting county-level data from {table_name} into additional files, split by state/territory.')
     bucket = prepare_bucket(export_bucket)
 
+    if split_mode == 'single_scan':
+        return export_split_county_tables_single_scan(bq_client, table, bucket,
+                                                      extra_formats)
+    if split_mode == 'streaming':
+        return export_split_county_tables_streaming(bq_client, table, bucket,
+                                                    extra_formats)
+
     for fips in STATE_LEVEL_FIPS_LIST:
         state_file_name = f'{table.dataset_id}-{table.table_id}-{fips}.json'
         query = f"""
@@ -104,8 +370,42 @@ def export_split_county_tables(bq_client, table, export_bucket):
             state_df = get_query_results_as_df(bq_client, query)
             nd_json = state_df.to_json(orient="records",
                                        lines=True)
-            export_nd_json_to_blob(blob, nd_json)
+            metadata = get_blob_manifest_metadata(table.table_id, len(state_df))
+            export_nd_json_to_blob(blob, nd_json, metadata)
+            export_df_in_extra_formats(bucket, state_file_name, state_df, nd_json,
+                                       metadata, extra_formats)
+
+        except Exception as err:
+            logging.error(err)
+            return (
+                f'Error splitting county-level table {table_name} into {state_file_name}:\n {err}',
+                500
+            )
+
 
+def export_split_county_tables_single_scan(bq_client, table, bucket, extra_formats=()):
+    """ Read the whole county-level table once, partition its rows by the
+    first two digits of county_fips, and upload the per-state files
+    concurrently. Produces the same files as running one query per state. """
+
+    table_name = get_table_name(table)
+    try:
+        table_df = get_table_as_df(bq_client, table)
+    except Exception as err:
+        logging.error(err)
+        return (f'Error reading county-level table {table_name}:\n {err}', 500)
+
+    state_dfs = split_df_by_state_fips(table_df)
+
+    def export_state(fips):
+        state_file_name = f'{table.dataset_id}-{table.table_id}-{fips}.json'
+        try:
+            blob = prepare_blob(bucket, state_file_name)
+            nd_json = state_dfs[fips].to_json(orient="records", lines=True)
+            metadata = get_blob_manifest_metadata(table.table_id, len(state_dfs[fips]))
+            export_nd_json_to_blob(blob, nd_json, metadata)
+            export_df_in_extra_formats(bucket, state_file_name, state_dfs[fips], nd_json,
+                                       metadata, extra_formats)
         except Exception as err:
             logging.error(err)
             return (
@@ -113,6 +413,74 @@ def export_split_county_tables(bq_client, table, export_bucket):
                 500
             )
 
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_UPLOADS) as executor:
+        errors = [error for error in executor.map(export_state, STATE_LEVEL_FIPS_LIST)
+                  if error is not None]
+    if errors:
+        return errors[0]
+
+
+def export_split_county_tables_streaming(bq_client, table, bucket, extra_formats=()):
+    """ Run one query per state like the query mode, but write the rows of
+    each to its blob as they are fetched, one page at a time, through a
+    resumable upload. Memory use is bounded by STREAMING_PAGE_SIZE and
+    UPLOAD_CHUNK_BYTES per concurrent upload, whatever the size of the table.
+    The gzipped file is written in the same pass when extra_formats includes
+    json_gzip. """
+
+    table_name = get_table_name(table)
+
+    def export_state(fips):
+        state_file_name = f'{table.dataset_id}-{table.table_id}-{fips}.json'
+        query = f"""
+            SELECT *
+            FROM {table_name}
+            WHERE county_fips LIKE '{fips}___'
+            """
+        try:
+            blob = prepare_blob(bucket, state_file_name)
+            gzip_blob = None
+            if 'json_gzip' in extra_formats:
+                gzip_blob = prepare_blob(bucket, get_extra_format_file_name(
+                    state_file_name, 'json_gzip'))
+            page_dfs = get_query_results_as_pages(bq_client, query)
+            row_count = export_pages_as_nd_json_to_blob(bucket, blob, page_dfs, gzip_blob)
+            # The row count is only known once the upload is done.
+            for exported_blob in [blob, gzip_blob]:
+                if exported_blob is not None:
+                    exported_blob.metadata = get_blob_manifest_metadata(table.table_id, row_count)
+                    exported_blob.patch()
+        except Exception as err:
+            logging.error(err)
+            return (
+                f'Error splitting county-level table {table_name} into {state_file_name}:\n {err}',
+                500
+            )
+
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_UPLOADS) as executor:
+        errors = [error for error in executor.map(export_state, STATE_LEVEL_FIPS_LIST)
+                  if error is not None]
+    if errors:
+        return errors[0]
+
+
+def split_df_by_state_fips(table_df):
+    """ Partition the rows of a county-level table by parent state FIPS.
+
+        ARGS:
+        table_df: DataFrame with a county_fips column
+
+        RETURNS:
+        dict of each state FIPS in STATE_LEVEL_FIPS_LIST to a DataFrame of the
+        rows whose county_fips matches `LIKE '{fips}___'`, in their original order """
+
+    county_fips = table_df['county_fips']
+    is_county = county_fips.str.len() == 5
+    state_fips = county_fips.str[:2].where(is_county)
+    groups = dict(list(table_df.groupby(state_fips, sort=False)))
+    return {fips: groups.get(fips, table_df.iloc[0:0])
+            for fips in STATE_LEVEL_FIPS_LIST}
+
 
 def has_multi_demographics(table_id: str):
     """ Determines if a table has more than one demographic breakdown
@@ -144,6 +512,21 @@ def get_query_results_as_df(bq_client, query):
     return query_job.to_dataframe()
 
 
+def get_query_results_as_pages(bq_client, query):
+    # Pages of rows are fetched one at a time as they are iterated over, each
+    # as a DataFrame with the dtypes of get_query_results_as_df.
+    rows = bq_client.query(query).result(page_size=STREAMING_PAGE_SIZE)
+    dtypes = {field.name: QUERY_RESULT_DTYPES[field.field_type]
+              for field in rows.schema if field.field_type in QUERY_RESULT_DTYPES}
+    return rows.to_dataframe_iterable(dtypes=dtypes)
+
+
+def get_table_as_df(bq_client, table):
+    # Reads the table directly, through the BigQuery Storage API when it is
+    # installed, without running a query job.
+    return bq_client.list_rows(table).to_dataframe()
+
+
 def prepare_bucket(export_bucket):
     storage_client = storage.Client()  # Storage API request
     return storage_client.get_bucket(export_bucket)
@@ -153,11 +536,109 @@ def prepare_blob(bucket, state_file_name):
     return bucket.blob(state_file_name)
 
 
-def export_nd_json_to_blob(blob, nd_json):
+def export_nd_json_to_blob(blob, nd_json, metadata=None):
+    blob.metadata = metadata
     blob.upload_from_string(
         nd_json, content_type='application/octet-stream')
 
 
+def get_extra_format_file_name(file_name, export_format):
+    """ Returns the name of the file exported in export_format alongside the
+    given .json file. """
+    return file_name[:-len('.json')] + EXTRA_EXPORT_FORMATS[export_format]
+
+
+def export_df_in_extra_formats(bucket, file_name, df, nd_json, metadata, extra_formats):
+    """ Upload the rows of df, already serialized as nd_json, in each of
+    extra_formats alongside the .json file with the given name. Gzipped files
+    don't record their modification time, so they only change when their
+    rows do. """
+    for export_format in extra_formats:
+        if export_format == 'json_gzip':
+            data = gzip.compress(nd_json.encode(), mtime=0)
+        else:
+            data = df.to_parquet(index=False)
+        blob = prepare_blob(bucket, get_extra_format_file_name(file_name, export_format))
+        blob.metadata = metadata
+        blob.upload_from_string(data, content_type='application/octet-stream')
+
+
+def export_pages_as_nd_json_to_blob(bucket, blob, page_dfs, gzip_blob=None):
+    """ Write pages of rows to the blob as newline delimited JSON, with a
+    resumable upload that sends UPLOAD_CHUNK_BYTES at a time. Each page is
+    serialized with DataFrame.to_json, so the file is the same as the one
+    written from a DataFrame of all the rows. If gzip_blob is given, the same
+    JSON is gzipped and written to it in the same pass.
+
+    Closing a blob's writer finalizes its upload, even when an exception is
+    being raised, so the rows are written to temporary blobs first. They are
+    only copied to blob and gzip_blob once every page has been written, which
+    leaves the previous export in place if reading or writing a page fails.
+
+        RETURNS:
+        number of rows written """
+    temp_blob = get_temp_blob(bucket, blob)
+    temp_gzip_blob = get_temp_blob(bucket, gzip_blob) if gzip_blob is not None else None
+    try:
+        row_count = write_pages_as_nd_json_to_blob(temp_blob, page_dfs, temp_gzip_blob)
+        bucket.copy_blob(temp_blob, bucket, blob.name)
+        if gzip_blob is not None:
+            bucket.copy_blob(temp_gzip_blob, bucket, gzip_blob.name)
+    finally:
+        for written_blob in [temp_blob, temp_gzip_blob]:
+            if written_blob is not None:
+                delete_temp_blob(written_blob)
+    return row_count
+
+
+def get_temp_blob(bucket, blob):
+    return bucket.blob(f'{TEMP_BLOB_PREFIX}{uuid.uuid4().hex}/{blob.name}')
+
+
+def delete_temp_blob(temp_blob):
+    try:
+        temp_blob.delete()
+    except exceptions.NotFound:
+        # Its upload failed before it was started.
+        pass
+
+
+def write_pages_as_nd_json_to_blob(blob, page_dfs, gzip_blob=None):
+    """ Write pages of rows to the blob, and gzipped to gzip_blob if it is
+    given, for export_pages_as_nd_json_to_blob.
+
+        RETURNS:
+        number of rows written """
+    row_count = 0
+    with ExitStack() as stack:
+        blob_files = [stack.enter_context(blob.open(
+            'wb', chunk_size=UPLOAD_CHUNK_BYTES, content_type='application/octet-stream'))]
+        if gzip_blob is not None:
+            gzip_blob_file = stack.enter_context(gzip_blob.open(
+                'wb', chunk_size=UPLOAD_CHUNK_BYTES, content_type='application/octet-stream'))
+            blob_files.append(stack.enter_context(
+                gzip.GzipFile(fileobj=gzip_blob_file, mode='wb', mtime=0)))
+
+        def write(nd_json):
+            data = nd_json.encode()
+            for blob_file in blob_files:
+                blob_file.write(data)
+
+        # Some versions of pandas don't end the last line with a newline, in
+        # which case it is added before the next page.
+        needs_newline = False
+        for page_df in page_dfs:
+            if page_df.empty:
+                continue
+            nd_json = page_df.to_json(orient="records", lines=True)
+            write('\n' + nd_json if needs_newline else nd_json)
+            needs_newline = not nd_json.endswith('\n')
+            row_count += len(page_df)
+        if row_count == 0:
+            write(pd.DataFrame().to_json(orient="records", lines=True))
+    return row_count
+
+
 if __name__ == "__main__":
     app.run(debug=True, host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
 
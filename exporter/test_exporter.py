@@ -1,13 +1,19 @@
 from unittest import mock
 from unittest.mock import Mock
 import pytest
+import datetime
+import gzip
+import io
+import json
 import os
+import threading
 import google.cloud.exceptions
 from flask.testing import FlaskClient
 from google.cloud import bigquery  # type: ignore
 import pandas as pd
 
-from main import app, STATE_LEVEL_FIPS_LIST, get_table_name, has_multi_demographics
+from main import (app, STATE_LEVEL_FIPS_LIST, export_split_county_tables, get_table_name,
+                  has_multi_demographics)
 
 # UNIT TESTS
 
@@ -45,11 +51,13 @@ def client():
 
 # TEST FULL FILE EXTRACT CALLS
 
-@mock.patch('main.export_split_county_tables')
+@mock.patch('main.prepare_bucket')
+@mock.patch('main.export_split_county_tables', return_value=None)
 @mock.patch('google.cloud.bigquery.Client')
 def testExportDatasetTables(
     mock_bq_client: mock.MagicMock,
     mock_split_county: mock.MagicMock,
+    mock_prepare_bucket: mock.MagicMock,
     client: FlaskClient
 ):
     # Set up mocks
@@ -69,11 +77,13 @@ def testExportDatasetTables(
     assert mock_split_county.call_count == 3
 
 
-@mock.patch('main.export_split_county_tables')
+@mock.patch('main.prepare_bucket')
+@mock.patch('main.export_split_county_tables', return_value=None)
 @mock.patch('google.cloud.bigquery.Client')
 def testExportDatasetTables_InvalidInput(
     mock_bq_client: mock.MagicMock,
     mock_split_county: mock.MagicMock,
+    mock_prepare_bucket: mock.MagicMock,
     client: FlaskClient
 ):
     response = client.post('/', json={})
@@ -81,11 +91,13 @@ def testExportDatasetTables_InvalidInput(
     assert mock_split_county.call_count == 0
 
 
-@mock.patch('main.export_split_county_tables')
+@mock.patch('main.prepare_bucket')
+@mock.patch('main.export_split_county_tables', return_value=None)
 @mock.patch('google.cloud.bigquery.Client')
 def testExportDatasetTables_NoTables(
     mock_bq_client: mock.MagicMock,
     mock_split_county: mock.MagicMock,
+    mock_prepare_bucket: mock.MagicMock,
     client: FlaskClient
 ):
     # Set up mocks
@@ -102,11 +114,13 @@ def testExportDatasetTables_NoTables(
     assert mock_split_county.call_count == 0
 
 
-@mock.patch('main.export_split_county_tables')
+@mock.patch('main.prepare_bucket')
+@mock.patch('main.export_split_county_tables', return_value=None)
 @mock.patch('google.cloud.bigquery.Client')
 def testExportDatasetTables_ExtractJobFailure(
     mock_bq_client: mock.MagicMock,
     mock_split_county: mock.MagicMock,
+    mock_prepare_bucket: mock.MagicMock,
     client: FlaskClient
 ):
     # Set up mocks
@@ -124,7 +138,329 @@ def testExportDatasetTables_ExtractJobFailure(
     response = client.post('/', json=payload)
 
     assert response.status_code == 500
+    # a failing table doesn't stop the others from being exported
+    assert mock_split_county.call_count == 3
+    assert mock_bq_instance.extract_table.call_count == 3
+    assert b'Error exporting 3 of 3 tables' in response.data
+    for table in TEST_TABLES[1:]:
+        assert f'Error exporting table {table.table_id}'.encode() in response.data
+
+
+@mock.patch('main.prepare_bucket')
+@mock.patch('main.export_split_county_tables', return_value=None)
+@mock.patch('google.cloud.bigquery.Client')
+def testExportDatasetTables_PartialFailure(
+    mock_bq_client: mock.MagicMock,
+    mock_split_county: mock.MagicMock,
+    mock_prepare_bucket: mock.MagicMock,
+    client: FlaskClient
+):
+    mock_bq_instance = mock_bq_client.return_value
+    mock_bq_instance.list_tables.return_value = TEST_TABLES
+
+    def extract_table(table_ref, dest_uri, location, job_config):
+        mock_extract_job = Mock()
+        if dest_uri.endswith('t3-age.json'):
+            mock_extract_job.result.side_effect = (
+                google.cloud.exceptions.InternalServerError('Internal'))
+        return mock_extract_job
+    mock_bq_instance.extract_table.side_effect = extract_table
+
+    payload = {
+        'dataset_name': 'my-dataset',
+        'demographic': 'age'
+    }
+    response = client.post('/', json=payload)
+
+    assert response.status_code == 500
+    assert mock_bq_instance.extract_table.call_count == 3
+    assert b'Error exporting 1 of 3 tables' in response.data
+    assert b'Error exporting table t3-age to gs://my-bucket/my-dataset-t3-age.json' in response.data
+    assert b't2-age' not in response.data
+
+
+@mock.patch('main.prepare_bucket')
+@mock.patch('main.export_split_county_tables', return_value=None)
+@mock.patch('google.cloud.bigquery.Client')
+def testExportDatasetTables_Concurrent(
+    mock_bq_client: mock.MagicMock,
+    mock_split_county: mock.MagicMock,
+    mock_prepare_bucket: mock.MagicMock,
+    client: FlaskClient
+):
+    mock_bq_instance = mock_bq_client.return_value
+    mock_bq_instance.list_tables.return_value = TEST_TABLES
+
+    # each extract job only finishes once all 3 have been started, which would
+    # block forever if the tables were exported one after another
+    all_started = threading.Barrier(3, timeout=10)
+    mock_extract_job = Mock()
+    mock_extract_job.result.side_effect = lambda: all_started.wait()
+    mock_bq_instance.extract_table.return_value = mock_extract_job
+
+    payload = {
+        'dataset_name': 'my-dataset',
+        'demographic': 'age'
+    }
+    response = client.post('/', json=payload)
+
+    assert response.status_code == 204
+    assert mock_extract_job.result.call_count == 3
+
+
+@mock.patch.dict(os.environ, {'EXTRA_EXPORT_FORMATS': 'json_gzip,parquet'})
+@mock.patch('main.prepare_bucket')
+@mock.patch('main.export_split_county_tables', return_value=None)
+@mock.patch('google.cloud.bigquery.Client')
+def testExportDatasetTables_ExtraFormats(
+    mock_bq_client: mock.MagicMock,
+    mock_split_county: mock.MagicMock,
+    mock_prepare_bucket: mock.MagicMock,
+    client: FlaskClient
+):
+    mock_bq_instance = mock_bq_client.return_value
+    mock_bq_instance.list_tables.return_value = TEST_TABLES
+
+    payload = {
+        'dataset_name': 'my-dataset',
+        'demographic': 't2-age'
+    }
+    response = client.post('/', json=payload)
+
+    assert response.status_code == 204
+    extracts = {call[0][1]: call[1]['job_config']
+                for call in mock_bq_instance.extract_table.call_args_list}
+    assert sorted(extracts) == ['gs://my-bucket/my-dataset-t2-age.json',
+                                'gs://my-bucket/my-dataset-t2-age.json.gz',
+                                'gs://my-bucket/my-dataset-t2-age.parquet']
+    gzip_config = extracts['gs://my-bucket/my-dataset-t2-age.json.gz']
+    assert gzip_config.destination_format == 'NEWLINE_DELIMITED_JSON'
+    assert gzip_config.compression == 'GZIP'
+    assert extracts['gs://my-bucket/my-dataset-t2-age.parquet'].destination_format == 'PARQUET'
+    assert mock_split_county.call_args[1]['extra_formats'] == ['json_gzip', 'parquet']
+
+
+@mock.patch.dict(os.environ, {'EXTRA_EXPORT_FORMATS': 'csv'})
+@mock.patch('main.prepare_bucket')
+@mock.patch('main.export_split_county_tables', return_value=None)
+@mock.patch('google.cloud.bigquery.Client')
+def testExportDatasetTables_InvalidExtraFormat(
+    mock_bq_client: mock.MagicMock,
+    mock_split_county: mock.MagicMock,
+    mock_prepare_bucket: mock.MagicMock,
+    client: FlaskClient
+):
+    response = client.post('/', json={'dataset_name': 'my-dataset'})
+
+    assert response.status_code == 500
+    assert b'Invalid EXTRA_EXPORT_FORMATS' in response.data
+    assert mock_bq_client.return_value.extract_table.call_count == 0
+
+
+def _get_table(table_ref):
+    """Returns the same unchanging table for every table_ref."""
+    table = Mock()
+    table.modified = datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc)
+    table.num_rows = 100
+    table.schema = [bigquery.SchemaField('county_fips', 'STRING'),
+                    bigquery.SchemaField('some_condition_per_100k', 'FLOAT')]
+    return table
+
+
+@mock.patch('main.prepare_bucket')
+@mock.patch('main.export_split_county_tables', return_value=None)
+@mock.patch('google.cloud.bigquery.Client')
+def testExportDatasetTables_Incremental(
+    mock_bq_client: mock.MagicMock,
+    mock_split_county: mock.MagicMock,
+    mock_prepare_bucket: mock.MagicMock,
+    client: FlaskClient
+):
+    mock_bq_instance = mock_bq_client.return_value
+    mock_bq_instance.list_tables.return_value = TEST_TABLES
+    mock_bq_instance.get_table.side_effect = _get_table
+
+    # a fake bucket that keeps the metadata patched onto its blobs
+    blob_metadata = {}
+    mock_bucket = mock_prepare_bucket.return_value
+
+    def blob(name):
+        mock_blob = Mock()
+        mock_blob.metadata = None
+        mock_blob.patch.side_effect = lambda: blob_metadata.update({name: mock_blob.metadata})
+        return mock_blob
+    mock_bucket.blob.side_effect = blob
+    mock_bucket.get_blob.side_effect = lambda name: (
+        Mock(metadata=blob_metadata[name]) if name in blob_metadata else None)
+
+    payload = {
+        'dataset_name': 'my-dataset',
+        'demographic': 'age'
+    }
+    response = client.post('/', json=payload)
+
+    assert response.status_code == 204
+    assert mock_bq_instance.extract_table.call_count == 3
+    assert blob_metadata['my-dataset-t2-age.json'] == {
+        'export_fingerprint': '2022-01-01T00:00:00+00:00/100',
+        'export_table': 't2-age',
+        'export_row_count': '100',
+        'export_columns': '["county_fips", "some_condition_per_100k"]'}
+
+    # nothing changed, so nothing is exported again
+    mock_bq_instance.extract_table.reset_mock()
+    mock_split_county.reset_mock()
+    response = client.post('/', json=payload)
+
+    assert response.status_code == 204
+    assert mock_bq_instance.extract_table.call_count == 0
+    assert mock_split_county.call_count == 0
+
+    # only the changed table is exported again
+    blob_metadata['my-dataset-t3-age.json'] = {'export_fingerprint': 'outdated'}
+    response = client.post('/', json=payload)
+
+    assert response.status_code == 204
+    assert mock_bq_instance.extract_table.call_count == 1
     assert mock_split_county.call_count == 1
+    assert mock_bq_instance.extract_table.call_args[0][1] == 'gs://my-bucket/my-dataset-t3-age.json'
+
+    # force exports every table
+    mock_bq_instance.extract_table.reset_mock()
+    response = client.post('/', json={**payload, 'force': True})
+
+    assert response.status_code == 204
+    assert mock_bq_instance.extract_table.call_count == 3
+
+
+@mock.patch('main.prepare_bucket')
+@mock.patch('main.export_split_county_tables', return_value=None)
+@mock.patch('google.cloud.bigquery.Client')
+def testExportDatasetTables_IncrementalSplitFailure(
+    mock_bq_client: mock.MagicMock,
+    mock_split_county: mock.MagicMock,
+    mock_prepare_bucket: mock.MagicMock,
+    client: FlaskClient
+):
+    mock_bq_instance = mock_bq_client.return_value
+    mock_bq_instance.list_tables.return_value = TEST_TABLES
+    mock_bq_instance.get_table.side_effect = _get_table
+    mock_split_county.side_effect = lambda bq_client, table, bucket, **kwargs: (
+        (f'Error splitting county-level table {table.table_id}', 500)
+        if table.table_id == 't3-age' else None)
+
+    blob_metadata = {}
+    mock_bucket = mock_prepare_bucket.return_value
+
+    def blob(name):
+        mock_blob = Mock()
+        mock_blob.patch.side_effect = lambda: blob_metadata.update({name: mock_blob.metadata})
+        return mock_blob
+    mock_bucket.blob.side_effect = blob
+
+    payload = {
+        'dataset_name': 'my-dataset',
+        'demographic': 'age'
+    }
+    response = client.post('/', json=payload)
+
+    # the failure is reported, and the table isn't skipped next time if its
+    # county-level files weren't exported
+    assert response.status_code == 500
+    assert 'Error exporting 1 of 3 tables' in response.data.decode()
+    assert 'Error splitting county-level table t3-age' in response.data.decode()
+    fingerprinted_blobs = [name for name, metadata in blob_metadata.items()
+                           if 'export_fingerprint' in metadata]
+    assert sorted(fingerprinted_blobs) == ['my-dataset-t2-age.json', 'my-dataset-t4-age.json']
+    assert blob_metadata['my-dataset-t3-age.json']['export_row_count'] == '100'
+
+
+def _manifest_blob(name, metadata, size):
+    blob = Mock(size=size, md5_hash=f'md5-of-{name}', generation=1, metadata=metadata)
+    blob.name = name
+    return blob
+
+
+@mock.patch('main.prepare_bucket')
+@mock.patch('main.export_split_county_tables', return_value=None)
+@mock.patch('google.cloud.bigquery.Client')
+def testExportDatasetTables_Manifest(
+    mock_bq_client: mock.MagicMock,
+    mock_split_county: mock.MagicMock,
+    mock_prepare_bucket: mock.MagicMock,
+    client: FlaskClient
+):
+    mock_bq_instance = mock_bq_client.return_value
+    mock_bq_instance.list_tables.return_value = TEST_TABLES
+    mock_bucket = mock_prepare_bucket.return_value
+    mock_bucket.list_blobs.return_value = [
+        _manifest_blob('my-dataset-t4-age.json', {
+            'export_table': 't4-age', 'export_row_count': '3',
+            'export_columns': '["county_fips", "some_condition_per_100k"]'}, 300),
+        _manifest_blob('my-dataset-t4-age-01.json', {
+            'export_table': 't4-age', 'export_row_count': '2'}, 200),
+        _manifest_blob('my-dataset-t1-sex.json', None, 100),
+        _manifest_blob('my-dataset-manifest.json', None, 1000),
+    ]
+    uploads = {}
+
+    def blob(name):
+        mock_blob = Mock()
+        mock_blob.upload_from_string.side_effect = (
+            lambda data, content_type: uploads.update({name: data}))
+        return mock_blob
+    mock_bucket.blob.side_effect = blob
+
+    payload = {
+        'dataset_name': 'my-dataset',
+        'demographic': 'age'
+    }
+    response = client.post('/', json=payload)
+
+    assert response.status_code == 204
+    assert mock_bucket.list_blobs.call_args[1] == {'prefix': 'my-dataset-'}
+    manifest = json.loads(uploads['my-dataset-manifest.json'])
+    columns = ['county_fips', 'some_condition_per_100k']
+    assert manifest == {
+        'dataset': 'my-dataset',
+        'files': [
+            # exported before row counts were recorded
+            {'name': 'my-dataset-t1-sex.json', 'table': None, 'row_count': None,
+             'size_bytes': 100, 'md5_hash': 'md5-of-my-dataset-t1-sex.json',
+             'columns': None, 'generation': 1},
+            # county-level files have the columns of their table
+            {'name': 'my-dataset-t4-age-01.json', 'table': 't4-age', 'row_count': 2,
+             'size_bytes': 200, 'md5_hash': 'md5-of-my-dataset-t4-age-01.json',
+             'columns': columns, 'generation': 1},
+            {'name': 'my-dataset-t4-age.json', 'table': 't4-age', 'row_count': 3,
+             'size_bytes': 300, 'md5_hash': 'md5-of-my-dataset-t4-age.json',
+             'columns': columns, 'generation': 1},
+        ]
+    }
+
+
+@mock.patch('main.prepare_bucket')
+@mock.patch('main.export_split_county_tables', return_value=None)
+@mock.patch('google.cloud.bigquery.Client')
+def testExportDatasetTables_ManifestFailure(
+    mock_bq_client: mock.MagicMock,
+    mock_split_county: mock.MagicMock,
+    mock_prepare_bucket: mock.MagicMock,
+    client: FlaskClient
+):
+    mock_bq_instance = mock_bq_client.return_value
+    mock_bq_instance.list_tables.return_value = TEST_TABLES
+    mock_prepare_bucket.return_value.list_blobs.side_effect = (
+        google.cloud.exceptions.InternalServerError('Internal'))
+
+    payload = {
+        'dataset_name': 'my-dataset',
+        'demographic': 'age'
+    }
+    response = client.post('/', json=payload)
+
+    assert response.status_code == 500
+    assert b'Error writing manifest of dataset my-dataset' in response.data
 
 
 # TEST ADDITIONAL COUNTY-LEVEL DATASET SPLIT FUNCTIONS
@@ -193,3 +529,330 @@ def testExportSplitCountyTables(
         table = TEST_TABLES[3]
         expected_file_name = f'{table.dataset_id}-{table.table_id}-{fips}.json'
         assert state_file_name == expected_file_name
+
+
+_test_table_df = pd.DataFrame({
+    'county_fips': ["01001", "02013", "01003", "0100", None, "72001"],
+    'some_condition_per_100k': [None, 1.5, 2, 3, 4, 5],
+})
+
+
+def _get_query_results_as_df(bq_client, query):
+    """Runs the per-state county_fips LIKE query against _test_table_df."""
+    fips = query.split("LIKE '")[1][:2]
+    county_fips = _test_table_df['county_fips']
+    return _test_table_df[(county_fips.str.len() == 5) &
+                          (county_fips.str[:2] == fips)]
+
+
+@mock.patch('main.export_nd_json_to_blob')
+@mock.patch('main.prepare_blob', side_effect=lambda bucket, name: name)
+@mock.patch('main.prepare_bucket')
+@mock.patch('main.get_table_as_df', return_value=_test_table_df)
+@mock.patch('main.get_query_results_as_df', side_effect=_get_query_results_as_df)
+def testExportSplitCountyTables_SingleScan(
+        mock_query_df: mock.MagicMock,
+        mock_table_df: mock.MagicMock,
+        mock_prepare_bucket: mock.MagicMock,
+        mock_prepare_blob: mock.MagicMock,
+        mock_export: mock.MagicMock,
+):
+    table = TEST_TABLES[3]
+
+    export_split_county_tables(mock.Mock(), table, 'my-bucket')
+    per_query_files = {call[0][0]: call[0][1] for call in mock_export.call_args_list}
+    per_query_metadata = {call[0][0]: call[0][2] for call in mock_export.call_args_list}
+    assert mock_query_df.call_count == NUM_STATES_AND_TERRITORIES
+    mock_export.reset_mock()
+
+    export_split_county_tables(mock.Mock(), table, 'my-bucket', split_mode='single_scan')
+    single_scan_files = {call[0][0]: call[0][1] for call in mock_export.call_args_list}
+    single_scan_metadata = {call[0][0]: call[0][2] for call in mock_export.call_args_list}
+
+    # the table is read once instead of queried once per state/terr
+    assert mock_table_df.call_count == 1
+    assert mock_query_df.call_count == NUM_STATES_AND_TERRITORIES
+
+    # the same files are written with identical contents
+    assert len(single_scan_files) == NUM_STATES_AND_TERRITORIES
+    assert single_scan_files == per_query_files
+    assert single_scan_files[f'{table.dataset_id}-{table.table_id}-01.json'] == (
+        '{"county_fips":"01001","some_condition_per_100k":null}\n'
+        '{"county_fips":"01003","some_condition_per_100k":2.0}\n')
+    # states without counties get the same (empty) file as from an empty query
+    assert single_scan_files[f'{table.dataset_id}-{table.table_id}-06.json'] == '\n'
+
+    # with the same row counts recorded for the manifest
+    assert single_scan_metadata == per_query_metadata
+    assert single_scan_metadata[f'{table.dataset_id}-{table.table_id}-01.json'] == {
+        'export_table': table.table_id, 'export_row_count': '2'}
+
+
+@mock.patch('main.export_nd_json_to_blob')
+@mock.patch('main.prepare_blob', side_effect=lambda bucket, name: name)
+@mock.patch('main.prepare_bucket')
+@mock.patch('main.get_table_as_df', return_value=_test_table_df)
+def testExportSplitCountyTables_SingleScanUploadFailure(
+        mock_table_df: mock.MagicMock,
+        mock_prepare_bucket: mock.MagicMock,
+        mock_prepare_blob: mock.MagicMock,
+        mock_export: mock.MagicMock,
+):
+    mock_export.side_effect = google.cloud.exceptions.InternalServerError('Internal')
+
+    response = export_split_county_tables(
+        mock.Mock(), TEST_TABLES[3], 'my-bucket', split_mode='single_scan')
+
+    assert response[1] == 500
+    assert 'Error splitting county-level table' in response[0]
+
+
+class _FakeBlobFile(io.BytesIO):
+    """Keeps what was written to it in `files` once it is closed."""
+
+    def __init__(self, files, name):
+        super().__init__()
+        self.files = files
+        self.name = name
+
+    def close(self):
+        self.files[self.name] = self.getvalue()
+        super().close()
+
+
+def _fake_blob_files(mock_bucket, files, blob_metadata=None):
+    """Makes the mocked bucket's blobs keep what is written to them in
+    `files`, and their metadata in `blob_metadata` once it is patched, and
+    makes it copy and delete them."""
+    def blob(name):
+        mock_blob = Mock()
+        mock_blob.name = name
+        mock_blob.open.side_effect = lambda mode, **kwargs: _FakeBlobFile(files, name)
+
+        def delete():
+            if name not in files:
+                raise google.cloud.exceptions.NotFound(name)
+            del files[name]
+        mock_blob.delete.side_effect = delete
+        if blob_metadata is not None:
+            mock_blob.patch.side_effect = lambda: blob_metadata.update({name: mock_blob.metadata})
+        return mock_blob
+    mock_bucket.blob.side_effect = blob
+    mock_bucket.copy_blob.side_effect = (
+        lambda blob, bucket, new_name: files.update({new_name: files[blob.name]}))
+
+
+def _get_query_results_as_pages(bq_client, query):
+    """Runs the per-state county_fips LIKE query against _test_table_df, and
+    returns its rows one per page."""
+    state_df = _get_query_results_as_df(bq_client, query)
+    return (state_df.iloc[i:i + 1] for i in range(len(state_df)))
+
+
+@mock.patch('main.prepare_bucket')
+@mock.patch('main.get_query_results_as_pages', side_effect=_get_query_results_as_pages)
+def testExportSplitCountyTables_Streaming(
+        mock_query_pages: mock.MagicMock,
+        mock_prepare_bucket: mock.MagicMock,
+):
+    table = TEST_TABLES[3]
+    files = {}
+    mock_bucket = mock_prepare_bucket.return_value
+
+    blob_metadata = {}
+    _fake_blob_files(mock_bucket, files, blob_metadata)
+
+    response = export_split_county_tables(mock.Mock(), table, 'my-bucket',
+                                          split_mode='streaming')
+
+    assert response is None
+    assert mock_query_pages.call_count == NUM_STATES_AND_TERRITORIES
+    assert len(files) == NUM_STATES_AND_TERRITORIES
+    assert files[f'{table.dataset_id}-{table.table_id}-01.json'] == (
+        b'{"county_fips":"01001","some_condition_per_100k":null}\n'
+        b'{"county_fips":"01003","some_condition_per_100k":2.0}\n')
+    assert files[f'{table.dataset_id}-{table.table_id}-72.json'] == (
+        b'{"county_fips":"72001","some_condition_per_100k":5.0}\n')
+    # states without counties get the same file as from an empty query
+    assert files[f'{table.dataset_id}-{table.table_id}-06.json'] == b'\n'
+    # row counts are recorded for the manifest once each upload is done
+    assert blob_metadata[f'{table.dataset_id}-{table.table_id}-01.json'] == {
+        'export_table': table.table_id, 'export_row_count': '2'}
+    assert blob_metadata[f'{table.dataset_id}-{table.table_id}-06.json'] == {
+        'export_table': table.table_id, 'export_row_count': '0'}
+
+
+@mock.patch('main.prepare_bucket')
+@mock.patch('main.get_query_results_as_pages', side_effect=_get_query_results_as_pages)
+def testExportSplitCountyTables_StreamingUploadFailure(
+        mock_query_pages: mock.MagicMock,
+        mock_prepare_bucket: mock.MagicMock,
+):
+    mock_bucket = mock_prepare_bucket.return_value
+    mock_bucket.blob.return_value.open.side_effect = (
+        google.cloud.exceptions.InternalServerError('Internal'))
+
+    response = export_split_county_tables(
+        mock.Mock(), TEST_TABLES[3], 'my-bucket', split_mode='streaming')
+
+    assert response[1] == 500
+    assert 'Error splitting county-level table' in response[0]
+
+
+@mock.patch('main.prepare_bucket')
+@mock.patch('main.get_query_results_as_pages')
+def testExportSplitCountyTables_StreamingPageFailure(
+        mock_query_pages: mock.MagicMock,
+        mock_prepare_bucket: mock.MagicMock,
+):
+    table = TEST_TABLES[3]
+    file_name = f'{table.dataset_id}-{table.table_id}-01'
+    files = {f'{file_name}.json': b'previous export\n',
+             f'{file_name}.json.gz': gzip.compress(b'previous export\n')}
+    previous_files = dict(files)
+    mock_bucket = mock_prepare_bucket.return_value
+    _fake_blob_files(mock_bucket, files)
+
+    def failing_pages(bq_client, query):
+        yield _get_query_results_as_df(bq_client, query)
+        raise google.cloud.exceptions.InternalServerError('Internal')
+    mock_query_pages.side_effect = failing_pages
+
+    response = export_split_county_tables(mock.Mock(), table, 'my-bucket',
+                                          split_mode='streaming', extra_formats=['json_gzip'])
+
+    assert response[1] == 500
+    # the truncated uploads are thrown away, leaving the previous files as they were
+    mock_bucket.copy_blob.assert_not_called()
+    assert files == previous_files
+
+
+@mock.patch('main.prepare_bucket')
+@mock.patch('main.get_query_results_as_df', side_effect=_get_query_results_as_df)
+def testExportSplitCountyTables_ExtraFormats(
+        mock_query_df: mock.MagicMock,
+        mock_prepare_bucket: mock.MagicMock,
+):
+    table = TEST_TABLES[3]
+    uploads = {}
+    mock_bucket = mock_prepare_bucket.return_value
+
+    def blob(name):
+        mock_blob = Mock()
+        mock_blob.upload_from_string.side_effect = (
+            lambda data, content_type: uploads.update({name: data}))
+        return mock_blob
+    mock_bucket.blob.side_effect = blob
+
+    response = export_split_county_tables(mock.Mock(), table, 'my-bucket',
+                                          extra_formats=['json_gzip', 'parquet'])
+
+    assert response is None
+    assert len(uploads) == 3 * NUM_STATES_AND_TERRITORIES
+    file_name = f'{table.dataset_id}-{table.table_id}-01'
+    assert gzip.decompress(uploads[f'{file_name}.json.gz']).decode() == uploads[f'{file_name}.json']
+    state_df = pd.read_parquet(io.BytesIO(uploads[f'{file_name}.parquet']))
+    pd.testing.assert_frame_equal(
+        state_df, _get_query_results_as_df(None, "LIKE '01").reset_index(drop=True))
+
+
+@mock.patch('main.prepare_bucket')
+@mock.patch('main.get_query_results_as_pages', side_effect=_get_query_results_as_pages)
+def testExportSplitCountyTables_StreamingGzip(
+        mock_query_pages: mock.MagicMock,
+        mock_prepare_bucket: mock.MagicMock,
+):
+    table = TEST_TABLES[3]
+    files = {}
+    mock_bucket = mock_prepare_bucket.return_value
+
+    _fake_blob_files(mock_bucket, files)
+
+    response = export_split_county_tables(mock.Mock(), table, 'my-bucket',
+                                          split_mode='streaming', extra_formats=['json_gzip'])
+
+    assert response is None
+    # the rows are only queried once for both files
+    assert mock_query_pages.call_count == NUM_STATES_AND_TERRITORIES
+    assert len(files) == 2 * NUM_STATES_AND_TERRITORIES
+    file_name = f'{table.dataset_id}-{table.table_id}-01'
+    assert gzip.decompress(files[f'{file_name}.json.gz']) == files[f'{file_name}.json']
+
+
+_test_query_schema = [
+    bigquery.SchemaField('county_fips', 'STRING'),
+    bigquery.SchemaField('county_name', 'STRING'),
+    bigquery.SchemaField('population', 'INTEGER'),
+    bigquery.SchemaField('some_condition_per_100k', 'FLOAT'),
+    bigquery.SchemaField('is_estimate', 'BOOLEAN'),
+    bigquery.SchemaField('updated_at', 'TIMESTAMP'),
+    bigquery.SchemaField('time_period', 'DATE'),
+]
+
+# Rows of a query's results as the BigQuery API returns them.
+_test_query_api_rows = [
+    ['01001', 'Autauga/Elmore', '55869', '0.30000000000000004', 'true',
+     '1600000000123456', '2021-01-01'],
+    ['01003', None, None, None, None, None, None],
+    ['01005', 'Barbour "County"', '24686', '123456789.123456789', 'false',
+     '1600000000000000', '2020-02-01'],
+    ['01007', 'Bibb', '22394', '1e-12', 'true', '1612137600000000', '2021-02-01'],
+    ['01009', 'Blount', '57826', '2.5', None, '1612137600000000', '2021-02-01'],
+]
+
+
+class _FakeQueryJob():
+    """Returns _test_query_api_rows through the BigQuery client library, the
+    way a query job does."""
+
+    def _get_rows(self, page_size):
+        def api_request(method, path, query_params=None, **kwargs):
+            start = int((query_params or {}).get('pageToken', 0))
+            end = start + page_size
+            response = {'rows': [{'f': [{'v': value} for value in row]}
+                                 for row in _test_query_api_rows[start:end]],
+                        'totalRows': str(len(_test_query_api_rows))}
+            if end < len(_test_query_api_rows):
+                response['pageToken'] = str(end)
+            return response
+        return bigquery.table.RowIterator(Mock(project='my-project'), api_request, 'path',
+                                          _test_query_schema, page_size=page_size)
+
+    def to_dataframe(self):
+        return self._get_rows(page_size=len(_test_query_api_rows)).to_dataframe()
+
+    def result(self, page_size):
+        return self._get_rows(page_size)
+
+
+@mock.patch('main.STREAMING_PAGE_SIZE', 2)
+@mock.patch('main.export_nd_json_to_blob')
+@mock.patch('main.prepare_bucket')
+def testExportSplitCountyTables_StreamingSameAsQuery(
+        mock_prepare_bucket: mock.MagicMock,
+        mock_export: mock.MagicMock,
+):
+    table = TEST_TABLES[3]
+    mock_bq_client = Mock()
+    mock_bq_client.query.return_value = _FakeQueryJob()
+    files = {}
+    mock_bucket = mock_prepare_bucket.return_value
+
+    _fake_blob_files(mock_bucket, files)
+
+    export_split_county_tables(mock_bq_client, table, 'my-bucket')
+    per_query_files = {call[0][0].name: call[0][1].encode()
+                       for call in mock_export.call_args_list}
+
+    response = export_split_county_tables(mock_bq_client, table, 'my-bucket',
+                                          split_mode='streaming')
+
+    assert response is None
+    assert len(files) == NUM_STATES_AND_TERRITORIES
+    assert files == per_query_files
+    # floats are rounded, slashes escaped and dates written as epoch
+    # milliseconds, like DataFrame.to_json does
+    assert files[f'{table.dataset_id}-{table.table_id}-01.json'].splitlines()[0] == (
+        b'{"county_fips":"01001","county_name":"Autauga\\/Elmore","population":55869,'
+        b'"some_condition_per_100k":0.3,"is_estimate":true,"updated_at":1600000000123,'
+        b'"time_period":1609459200000}')
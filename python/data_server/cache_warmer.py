@@ -0,0 +1,124 @@
+import json
+import logging
+import threading
+
+
+class CacheWarmer():
+    """CacheWarmer keeps a DatasetCache warm from a background thread.
+
+    On start, it preloads a list of datasets so the first requests to a new
+    instance are served from memory. After that, it periodically refreshes
+    datasets that are being served and are about to expire, so requests don't
+    have to wait for them to be revalidated or downloaded again."""
+
+    def __init__(self, cache, gcs_bucket: str, refresh_ahead=5 * 60,
+                 interval=60, max_fill_fraction=0.8):
+        """cache: DatasetCache to keep warm.
+        gcs_bucket: Name of GCS bucket where the datasets are stored.
+        refresh_ahead: How many seconds before a dataset expires to refresh
+                       it. Default 5 minutes.
+        interval: Seconds between checks for datasets to refresh. Default 1
+                  minute.
+        max_fill_fraction: Preloading stops once the cache is this full, so
+                           it doesn't evict datasets that are in use."""
+        self.cache = cache
+        self.gcs_bucket = gcs_bucket
+        self.refresh_ahead = refresh_ahead
+        self.interval = interval
+        self.max_fill_fraction = max_fill_fraction
+        self.stopped = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.counters = {
+            'preloaded': 0,
+            'preload_skipped': 0,
+            'preload_failures': 0,
+            'refreshed': 0,
+            'refresh_failures': 0,
+        }
+
+    def _count(self, counter: str):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def stats(self):
+        """Returns a dict of counters describing what the warmer has done."""
+        with self.lock:
+            return dict(self.counters)
+
+    def _is_full(self) -> bool:
+        stats = self.cache.stats()
+        return (stats['size_bytes'] >=
+                stats['max_size_bytes'] * self.max_fill_fraction)
+
+    def preload(self, table_ids):
+        """Loads each of the given datasets into the cache, stopping once the
+        cache is max_fill_fraction full. Failures are logged and skipped."""
+        table_ids = list(table_ids)
+        for i, table_id in enumerate(table_ids):
+            if self.stopped.is_set():
+                return
+            if self._is_full():
+                skipped = len(table_ids) - i
+                logging.warning(f'Cache is full, skipped preloading {skipped} '
+                                f'datasets.')
+                with self.lock:
+                    self.counters['preload_skipped'] += skipped
+                return
+            try:
+                self.cache.getDataset(self.gcs_bucket, table_id)
+                self._count('preloaded')
+            except Exception as err:
+                logging.error(f'Error preloading {table_id}: {err}')
+                self._count('preload_failures')
+        logging.info(f'Preloaded datasets: {self.stats()}')
+
+    def refresh_expiring(self):
+        """Refreshes the datasets that have been served since they were last
+        refreshed and expire within refresh_ahead seconds."""
+        for table_id in self.cache.expiring_datasets(self.refresh_ahead):
+            if self.stopped.is_set():
+                return
+            try:
+                self.cache.refresh_dataset(self.gcs_bucket, table_id)
+                self._count('refreshed')
+            except Exception as err:
+                logging.error(f'Error refreshing {table_id}: {err}')
+                self._count('refresh_failures')
+
+    def _run(self, get_table_ids):
+        try:
+            table_ids = get_table_ids()
+        except Exception as err:
+            logging.error(f'Error listing datasets to preload: {err}')
+            table_ids = []
+        self.preload(table_ids)
+        while not self.stopped.wait(self.interval):
+            self.refresh_expiring()
+
+    def start(self, get_table_ids=list):
+        """Starts the background thread, which preloads the datasets returned
+        by get_table_ids and then refreshes expiring datasets until stop is
+        called.
+
+        get_table_ids: Function returning the table_ids to preload. It is
+                       called from the background thread, so it may fetch
+                       them from GCS without delaying startup."""
+        self.thread = threading.Thread(target=self._run, args=(get_table_ids,),
+                                       name='CacheWarmer', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stops the background thread and waits for it to exit."""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+def get_metadata_table_ids(metadata) -> list:
+    """Returns the names of the dataset files listed in the metadata file, as
+    the ids of its rows with a .json extension.
+
+    metadata: Dataset built from the metadata file."""
+    return [f'{row["id"]}.json' for row in json.loads(metadata.body)
+            if 'id' in row]
@@ -0,0 +1,69 @@
+import io
+import logging
+
+try:
+    import pyarrow as pa  # type: ignore
+    import pyarrow.json as pa_json  # type: ignore
+except ImportError:
+    pa = None
+
+ARROW_MIMETYPE = 'application/vnd.apache.arrow.stream'
+
+# String columns with at most this fraction of distinct values are dictionary
+# encoded, e.g. race_category_id, state_fips and age.
+MAX_DICTIONARY_FRACTION = 0.5
+
+
+def is_available() -> bool:
+    """Returns whether pyarrow is installed, which is needed to build the
+    Arrow format of datasets."""
+    return pa is not None
+
+
+def _dictionary_encode(table):
+    """Dictionary encodes the string columns of table that repeat values."""
+    for i, field in enumerate(table.schema):
+        if not pa.types.is_string(field.type) or table.num_rows == 0:
+            continue
+        column = table.column(i)
+        encoded = column.dictionary_encode()
+        num_values = sum(len(chunk.dictionary) for chunk in encoded.chunks)
+        if num_values <= table.num_rows * MAX_DICTIONARY_FRACTION:
+            table = table.set_column(i, field.name, encoded)
+    return table
+
+
+def _to_ipc_stream(table) -> bytes:
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def ndjson_to_arrow(data: bytes):
+    """Converts newline delimited JSON into an Arrow IPC stream.
+
+    Returns: The stream as bytes, or None if pyarrow is not installed or the
+    data could not be converted."""
+    if pa is None or not data.strip():
+        return None
+    try:
+        table = pa_json.read_json(io.BytesIO(data))
+    except pa.ArrowInvalid as err:
+        logging.warning(f'Could not convert dataset to Arrow: {err}')
+        return None
+    return _to_ipc_stream(_dictionary_encode(table))
+
+
+def slice_arrow(arrow: bytes, rows, columns=None) -> bytes:
+    """Returns an Arrow IPC stream with the given rows of the arrow stream.
+
+    rows: Indices of the rows to include.
+    columns: If given, only these columns are included."""
+    table = pa.ipc.open_stream(pa.py_buffer(arrow)).read_all()
+    if columns is not None:
+        table = table.select([column for column in columns
+                              if column in table.column_names])
+    if not isinstance(rows, range) or len(rows) != table.num_rows:
+        table = table.take(pa.array(rows, type=pa.int64()))
+    return _to_ipc_stream(table)
@@ -0,0 +1,108 @@
+import gzip
+import hashlib
+
+from data_server import columnar
+from data_server.dataset_index import DatasetIndex
+
+try:
+    import brotli  # type: ignore
+except ImportError:
+    brotli = None
+
+# Bodies smaller than this are only served uncompressed, since compression
+# would save little or nothing.
+MIN_COMPRESS_BYTES = 1024
+GZIP_LEVEL = 6
+# Brotli's default quality of 11 is too slow for our largest files.
+BROTLI_QUALITY = 5
+
+
+class Dataset():
+    """Dataset holds the response body for a file stored in GCS, built once
+    when the file is added to the DatasetCache so requests served from the
+    cache don't need to do any per-row work. Compressed copies of the body
+    are built at the same time, so compression is paid for once per cache
+    fill rather than once per request."""
+
+    def __init__(self, body: bytes, mimetype: str, md5: str, index=None,
+                 arrow=None):
+        """body: Bytes to return to clients requesting the dataset.
+        mimetype: Mimetype of body.
+        md5: Hex encoded MD5 hash of the file in GCS the dataset was built
+             from, used to tell whether the file has changed.
+        index: DatasetIndex of the rows in body, for JSON datasets.
+        arrow: The same rows as an Arrow IPC stream, for JSON datasets."""
+        self.body = body
+        self.mimetype = mimetype
+        self.md5 = md5
+        self.index = index
+        self.arrow = arrow
+        # Time after which the DatasetCache must revalidate the dataset
+        # against GCS before serving it, and the number of times it was served
+        # from the cache since. Set by the DatasetCache.
+        self.expires_at = 0.0
+        self.hits = 0
+        # Maps content coding -> body encoded with it, in order of preference.
+        self.encodings = {}
+        if len(body) >= MIN_COMPRESS_BYTES:
+            if brotli is not None:
+                self.encodings['br'] = brotli.compress(
+                    body, quality=BROTLI_QUALITY)
+            self.encodings['gzip'] = gzip.compress(
+                body, compresslevel=GZIP_LEVEL, mtime=0)
+        self.encodings['identity'] = body
+
+    @classmethod
+    def from_blob(cls, table_id: str, blob: bytes) -> 'Dataset':
+        """Builds a Dataset from the contents of a file in GCS.
+
+        CSV files are returned as is. All other files are expected to be
+        newline delimited JSON, and are converted into a single JSON array.
+
+        table_id: Name of the file in GCS.
+        blob: Contents of the file."""
+        md5 = hashlib.md5(blob).hexdigest()
+        if table_id.endswith('.csv'):
+            return cls(blob, 'text/csv', md5)
+        body, index = ndjson_to_indexed_json_array(blob)
+        return cls(body, 'application/json', md5, index,
+                   columnar.ndjson_to_arrow(blob))
+
+    def etag(self, encoding: str) -> str:
+        """Returns a strong entity tag for the body encoded with encoding.
+
+        Each encoding gets its own tag, since they are different
+        representations of the same data."""
+        if encoding == 'identity':
+            return self.md5
+        return f'{self.md5}-{encoding}'
+
+    @property
+    def nbytes(self) -> int:
+        """Number of bytes held by the dataset, including compressed
+        copies, the index and the Arrow stream."""
+        nbytes = sum(len(encoded) for encoded in self.encodings.values())
+        if self.index is not None:
+            nbytes += self.index.nbytes
+        if self.arrow is not None:
+            nbytes += len(self.arrow)
+        return nbytes
+
+
+def ndjson_to_json_array(data: bytes) -> bytes:
+    """Converts newline delimited JSON into a JSON array of its rows."""
+    return b'[' + b','.join(data.splitlines()) + b']'
+
+
+def ndjson_to_indexed_json_array(data: bytes):
+    """Converts newline delimited JSON into a JSON array of its rows.
+
+    Returns: Tuple of the JSON array and a DatasetIndex of its rows."""
+    rows = data.splitlines()
+    index = DatasetIndex()
+    # Skip the opening bracket, and the comma after each row.
+    start = 1
+    for row in rows:
+        index.add_row(row, start)
+        start += len(row) + 1
+    return b'[' + b','.join(rows) + b']', index
@@ -1,47 +1,277 @@
 import threading
+import time
 
 import cachetools
 
-from data_server import gcs_utils
+from data_server import gcs_utils, metrics
+from data_server.dataset import Dataset
+from data_server.disk_cache import DiskCache
+
+DEFAULT_MAX_CACHE_BYTES = 2 * 1024 * 1024 * 1024
+
+
+class _SizedLRUCache(cachetools.LRUCache):
+    """LRUCache weighted by the size of each Dataset, which reports the
+    entries it evicts to make room for new ones."""
+
+    def __init__(self, maxsize, on_evict):
+        super().__init__(maxsize=maxsize,
+                         getsizeof=lambda dataset: dataset.nbytes)
+        self.on_evict = on_evict
+
+    def popitem(self):
+        key, value = super().popitem()
+        self.on_evict(key, value)
+        return key, value
+
+    def peek_items(self):
+        """Returns the (key, value) pairs in the cache without marking them
+        as recently used."""
+        return [(key, cachetools.Cache.__getitem__(self, key)) for key in self]
+
+
+class _PendingFetch():
+    """Result of a fetch that other threads requesting the same dataset wait
+    on instead of fetching it themselves."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
 
 
 class DatasetCache():
     """DatasetCache manages and stores datasets accessed through GCS.
-    DatasetCache is a thin, thread-safe wrapper around cachetools.TTLCache."""
+    DatasetCache is a thin, thread-safe wrapper around cachetools.LRUCache,
+    bounded by the total size of the datasets it holds rather than their
+    number. It can optionally be backed by a DiskCache, which is filled
+    whenever a dataset is downloaded and consulted before going to GCS.
 
-    def __init__(self, max_cache_size=8, cache_ttl=2 * 3600):
-        """max_cache_size: Max number of cache elements. Default 8.
-        cache_ttl: TTL per object in seconds. Default 2 hours."""
-        self.cache = cachetools.TTLCache(maxsize=max_cache_size, ttl=cache_ttl)
+    Datasets older than the TTL are kept until they are evicted, and are
+    revalidated against the MD5 hash of the file in GCS before being served
+    again, so unchanged files are not downloaded again."""
+
+    def __init__(self, max_cache_bytes=DEFAULT_MAX_CACHE_BYTES,
+                 cache_ttl=2 * 3600, disk_cache_dir=None,
+                 max_disk_cache_bytes=DEFAULT_MAX_CACHE_BYTES,
+                 timer=time.monotonic):
+        """max_cache_bytes: Max total size of the datasets kept in memory.
+                            Default 2GiB.
+        cache_ttl: TTL per object in seconds. Default 2 hours.
+        disk_cache_dir: Local directory used as a second cache tier. Disabled
+                        by default.
+        max_disk_cache_bytes: Max total size of the datasets kept in
+                              disk_cache_dir. Default 2GiB.
+        timer: Clock used to compute expiry. Mostly useful for tests."""
+        self.cache = _SizedLRUCache(max_cache_bytes, self._on_evict)
+        self.cache_ttl = cache_ttl
+        self.timer = timer
         self.cache_lock = threading.Lock()
+        # Maps table_id -> _PendingFetch for datasets currently being fetched.
+        self.pending = {}
+        self.disk_cache = None
+        if disk_cache_dir is not None:
+            self.disk_cache = DiskCache(disk_cache_dir, max_disk_cache_bytes,
+                                        cache_ttl, timer)
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.revalidations = 0
+        self.evictions = 0
+        self.disk_hits = 0
+        self.disk_evictions = 0
+
+    def _on_evict(self, table_id, dataset):
+        # Called with cache_lock held.
+        self.evictions += 1
 
     def clear(self):
-        """Clears entries from the cache. Mostly useful for tests."""
+        """Clears entries from the cache and resets its counters. Mostly
+        useful for tests."""
         with self.cache_lock:
             self.cache.clear()
+            self._reset_stats()
+        if self.disk_cache is not None:
+            self.disk_cache.clear()
+
+    def stats(self):
+        """Returns a dict of counters describing how the cache has been used
+        since it was created or last cleared."""
+        with self.cache_lock:
+            stats = {
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'revalidations': self.revalidations,
+                'evictions': self.evictions,
+                'entries': len(self.cache),
+                'size_bytes': self.cache.currsize,
+                'max_size_bytes': self.cache.maxsize,
+            }
+            if self.disk_cache is not None:
+                stats['disk_hits'] = self.disk_hits
+                stats['disk_evictions'] = self.disk_evictions
+                stats['disk_entries'] = len(self.disk_cache.entries)
+                stats['disk_size_bytes'] = self.disk_cache.currsize
+            return stats
+
+    def _put(self, table_id, dataset, expires_at=None):
+        # Datasets larger than the whole budget are returned without being
+        # cached rather than flushing every other entry.
+        if dataset.nbytes > self.cache.maxsize:
+            return
+        if expires_at is None:
+            expires_at = self.timer() + self.cache_ttl
+        dataset.expires_at = expires_at
+        dataset.hits = 0
+        self.cache[table_id] = dataset
 
     def getDataset(self, gcs_bucket: str, table_id: str):
-        """Returns the given dataset identified by table_id as bytes.
+        """Returns the given dataset identified by table_id as a Dataset.
 
         getDataset will return the dataset from memory if it exists in the
-        cache. Otherwise, it will request the file from GCS and update the
-        cache on success.
+        cache and has not expired. Expired datasets are returned from memory
+        if the file in GCS has not changed since they were fetched. Otherwise,
+        it will read it from the disk cache if one is configured, and as a
+        last resort request the file from GCS and update the cache on
+        success.
 
         gcs_bucket: Name of GCS bucket where the dataset is stored.
         table_id: Name of the data set file to access.
 
-        Returns: Bytes object containing the dataset if successful. Throws
-        NotFoundError on failure."""
+        Returns: Dataset containing the response body for the file if
+        successful. Throws NotFoundError on failure."""
+        return self._get(gcs_bucket, table_id, refresh=False)
+
+    def refresh_dataset(self, gcs_bucket: str, table_id: str):
+        """Revalidates the given dataset against GCS, or fetches it if it is
+        not cached or has changed, even if it has not expired yet. Restarts
+        its TTL on success.
+
+        Returns: The refreshed Dataset. Throws NotFoundError on failure."""
+        return self._get(gcs_bucket, table_id, refresh=True)
+
+    def expiring_datasets(self, within: float, min_hits=1):
+        """Returns the table_ids of cached datasets that expire within the
+        given number of seconds, and have been served from the cache at least
+        min_hits times since they were fetched or last revalidated."""
+        deadline = self.timer() + within
         with self.cache_lock:
-            item = self.cache.get(table_id)
-            if item is not None:
-                return item
+            return [table_id for table_id, dataset in self.cache.peek_items()
+                    if dataset.expires_at <= deadline and
+                    dataset.hits >= min_hits]
 
-        # Release the lock while performing IO.
-        blob_str = gcs_utils.download_blob_as_bytes(gcs_bucket, table_id)
+    def get_fresh_dataset(self, table_id: str):
+        """Returns the given dataset if it is cached and has not expired, and
+        None otherwise. Unlike getDataset, this never blocks on GCS, so it
+        can be called from an event loop before falling back to getDataset
+        in a thread."""
+        with self.cache_lock:
+            return self._get_fresh(table_id)
 
-        # If this has been updated since we last checked, it's still okay to
-        # overwrite since it will only affect freshness.
+    def _get_fresh(self, table_id: str):
+        # Called with cache_lock held.
+        dataset = self.cache.get(table_id)
+        if dataset is not None and dataset.expires_at > self.timer():
+            self.hits += 1
+            dataset.hits += 1
+            return dataset
+        return None
+
+    def _get(self, gcs_bucket: str, table_id: str, refresh: bool):
         with self.cache_lock:
-            self.cache[table_id] = blob_str
-            return blob_str
+            if not refresh:
+                fresh = self._get_fresh(table_id)
+                if fresh is not None:
+                    return fresh
+                self.misses += 1
+            stale = self.cache.get(table_id)
+
+            # Only one thread fetches a given dataset at a time. Others wait
+            # for its result rather than downloading the same blob again.
+            pending = self.pending.get(table_id)
+            is_leader = pending is None
+            if is_leader:
+                pending = self.pending[table_id] = _PendingFetch()
+            else:
+                self.coalesced += 1
+        if not is_leader:
+            return pending.wait()
+
+        # Datasets read from the disk cache keep the expiry of their entry
+        # there, rather than starting a new TTL for data that old.
+        expires_at = None
+        try:
+            changed = False
+            if stale is not None:
+                changed = not self._is_unchanged(gcs_bucket, table_id, stale)
+            if stale is not None and not changed:
+                with self.cache_lock:
+                    self.revalidations += 1
+                if self.disk_cache is not None:
+                    # Keeps the disk entry from expiring before the memory
+                    # one, which was built from the same download.
+                    self.disk_cache.touch(table_id)
+                pending.result = stale
+            else:
+                # If the file changed, the disk cache is likely to still hold
+                # an unexpired copy of the old version, so it's skipped.
+                blob_str, expires_at = self._fetch(gcs_bucket, table_id,
+                                                   use_disk_cache=not changed)
+                start = time.perf_counter()
+                pending.result = Dataset.from_blob(table_id, blob_str)
+                metrics.DATASET_BUILD_SECONDS.observe(
+                    time.perf_counter() - start)
+        except Exception as err:
+            pending.error = err
+            raise
+        finally:
+            with self.cache_lock:
+                if pending.result is not None:
+                    self._put(table_id, pending.result, expires_at)
+                del self.pending[table_id]
+            pending.done.set()
+        return pending.result
+
+    def _is_unchanged(self, gcs_bucket: str, table_id: str, stale) -> bool:
+        start = time.perf_counter()
+        md5 = gcs_utils.get_blob_md5(gcs_bucket, table_id)
+        metrics.GCS_REVALIDATION_SECONDS.observe(time.perf_counter() - start)
+        return md5 == stale.md5
+
+    def _fetch(self, gcs_bucket: str, table_id: str, use_disk_cache=True):
+        """Reads the dataset from the disk cache if possible, otherwise
+        downloads it from GCS and stores it in the disk cache. Called without
+        cache_lock held.
+
+        use_disk_cache: Whether to read from the disk cache. Downloads are
+                        stored in it either way, replacing the old entry.
+
+        Returns: The bytes of the dataset, and the time at which its disk
+        cache entry expires if it was read from disk, or None if it was
+        downloaded."""
+        if self.disk_cache is not None and use_disk_cache:
+            entry = self.disk_cache.get(table_id)
+            if entry is not None:
+                with self.cache_lock:
+                    self.disk_hits += 1
+                return entry
+
+        start = time.perf_counter()
+        blob_str = gcs_utils.download_blob_as_bytes(gcs_bucket, table_id)
+        metrics.GCS_DOWNLOAD_SECONDS.observe(time.perf_counter() - start)
+        metrics.GCS_DOWNLOAD_BYTES.inc(amount=len(blob_str))
+        if self.disk_cache is not None:
+            disk_evictions = self.disk_cache.put(table_id, blob_str)
+            with self.cache_lock:
+                self.disk_evictions += disk_evictions
+        return blob_str, None
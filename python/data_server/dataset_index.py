@@ -0,0 +1,119 @@
+import array
+import json
+import re
+from typing import List, Union
+
+# Columns that rows can be filtered on. County level tables have both fips
+# columns, in which case county_fips is indexed.
+FIPS_COLUMNS = (b'county_fips', b'state_fips')
+TIME_PERIOD_COLUMN = b'time_period'
+
+
+def _column_pattern(column: bytes):
+    return re.compile(b'"' + column + rb'"\s*:\s*"([^"]*)"')
+
+
+_FIPS_PATTERNS = [_column_pattern(column) for column in FIPS_COLUMNS]
+_TIME_PERIOD_PATTERN = _column_pattern(TIME_PERIOD_COLUMN)
+
+
+def _add_row(index: dict, key: str, row: int):
+    rows = index.get(key)
+    if rows is None:
+        rows = index[key] = array.array('i')
+    rows.append(row)
+
+
+class DatasetIndex():
+    """DatasetIndex records where each row of a JSON array body starts and
+    ends, along with the rows for each FIPS code and time period, so subsets
+    of the rows can be sliced out of the body without parsing it."""
+
+    def __init__(self):
+        self.starts = array.array('q')
+        self.ends = array.array('q')
+        # Maps the first two digits of a FIPS code -> the full FIPS code ->
+        # indices of the rows with that code.
+        self.fips = {}
+        # Maps time period -> indices of the rows for that period.
+        self.time_periods = {}
+
+    def add_row(self, row: bytes, start: int):
+        """Adds row, which starts at the given offset of the body."""
+        i = len(self.starts)
+        self.starts.append(start)
+        self.ends.append(start + len(row))
+
+        for pattern in _FIPS_PATTERNS:
+            match = pattern.search(row)
+            if match is not None:
+                fips = match.group(1).decode()
+                _add_row(self.fips.setdefault(fips[:2], {}), fips, i)
+                break
+
+        match = _TIME_PERIOD_PATTERN.search(row)
+        if match is not None:
+            _add_row(self.time_periods, match.group(1).decode(), i)
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate number of bytes held by the index."""
+        rows = [rows for by_fips in self.fips.values()
+                for rows in by_fips.values()]
+        rows.extend(self.time_periods.values())
+        return (self.starts.itemsize * len(self.starts) * 2 +
+                sum(r.itemsize * len(r) for r in rows))
+
+    def select(self, fips=None, fips_prefix=None, time_period=None):
+        """Returns the indices of the rows matching all of the given filters,
+        in the order they appear in the body.
+
+        fips: FIPS code the rows must have.
+        fips_prefix: Prefix of the FIPS code the rows must have, e.g. a state
+                     FIPS code to select all counties in that state.
+        time_period: Time period the rows must have. A year also matches any
+                     month in that year, e.g. 2022 matches 2022-01."""
+        selected = None
+
+        if fips is not None:
+            selected = set(self.fips.get(fips[:2], {}).get(fips, ()))
+
+        if fips_prefix is not None:
+            rows = set()
+            for prefix, codes in self.fips.items():
+                if not (prefix.startswith(fips_prefix) or
+                        fips_prefix.startswith(prefix)):
+                    continue
+                for code, code_rows in codes.items():
+                    if code.startswith(fips_prefix):
+                        rows.update(code_rows)
+            selected = rows if selected is None else selected & rows
+
+        if time_period is not None:
+            rows = set()
+            for period, period_rows in self.time_periods.items():
+                if (period == time_period or
+                        period.startswith(time_period + '-')):
+                    rows.update(period_rows)
+            selected = rows if selected is None else selected & rows
+
+        if selected is None:
+            return range(len(self.starts))
+        return sorted(selected)
+
+    def slice_rows(self, body: bytes, rows, columns=None) -> bytes:
+        """Returns a JSON array of the given rows of body.
+
+        columns: If given, only these columns are included in each row."""
+        starts, ends = self.starts, self.ends
+        view = memoryview(body)
+        parts: List[Union[bytes, memoryview]]
+        if columns is None:
+            parts = [view[starts[i]:ends[i]] for i in rows]
+        else:
+            parts = [json.dumps({column: row[column] for column in columns
+                                 if column in row},
+                                separators=(',', ':')).encode()
+                     for row in (json.loads(body[starts[i]:ends[i]])
+                                 for i in rows)]
+        return b'[' + b','.join(parts) + b']'
@@ -0,0 +1,168 @@
+import collections
+import hashlib
+import os
+import re
+import threading
+import time
+from typing import Optional, Tuple
+
+# Names of the files entries are stored in, the SHA-256 hex digest of their
+# key.
+_ENTRY_FILE_NAME = re.compile('[0-9a-f]{64}')
+# Suffix of the files entries are written to before being renamed.
+_TMP_SUFFIX = '.tmp'
+
+
+class DiskCache():
+    """DiskCache stores dataset bytes as files in a local directory.
+
+    It is meant to be used as a second tier behind the in-memory DatasetCache,
+    so datasets that have been evicted from memory can be read back from local
+    disk instead of being downloaded from GCS again. Entries are evicted in
+    least recently used order once the total size of the stored files exceeds
+    max_size_bytes, and expire after ttl seconds like the memory tier.
+
+    Files left in the directory by an earlier process are indexed when it is
+    created, and expire ttl seconds after they were written or last
+    revalidated."""
+
+    def __init__(self, cache_dir: str, max_size_bytes: int, ttl: float,
+                 timer=time.monotonic):
+        """cache_dir: Directory in which to store the files. Created if it
+                      does not exist.
+        max_size_bytes: Max total size of the files stored in cache_dir.
+        ttl: TTL per object in seconds.
+        timer: Clock used to compute expiry. Mostly useful for tests."""
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self.ttl = ttl
+        self.timer = timer
+        self.currsize = 0
+        # Maps the file name of each key -> (path, size, expires_at), oldest
+        # access first.
+        self.entries: 'collections.OrderedDict[str, Tuple[str, int, float]]' = \
+            collections.OrderedDict()
+        self.lock = threading.Lock()
+        self._load_entries()
+
+    def _load_entries(self):
+        """Indexes the files written by an earlier process, oldest first,
+        removing those that have expired or don't fit in max_size_bytes.
+        Their age is measured with the wall clock, since timer may not be
+        comparable across processes."""
+        now = self.timer()
+        wall_now = time.time()
+        files = []
+        with os.scandir(self.cache_dir) as dir_entries:
+            for entry in dir_entries:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                age = max(wall_now - stat.st_mtime, 0)
+                if _ENTRY_FILE_NAME.fullmatch(entry.name):
+                    files.append((stat.st_mtime, entry.name, entry.path,
+                                  stat.st_size, now + self.ttl - age))
+                elif entry.name.endswith(_TMP_SUFFIX) and age > self.ttl:
+                    # Left by a process that stopped while writing it. Nothing
+                    # takes a whole TTL to write a file, so it isn't in
+                    # progress.
+                    _remove_file(entry.path)
+
+        for _, name, path, size, expires_at in sorted(files):
+            if expires_at <= now:
+                _remove_file(path)
+                continue
+            self.entries[name] = (path, size, expires_at)
+            self.currsize += size
+        while self.currsize > self.max_size_bytes:
+            self._remove(next(iter(self.entries)))
+
+    def _name(self, key: str) -> str:
+        # Keys are GCS object names, which may contain characters that are not
+        # valid in file names.
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def _remove(self, name: str):
+        path, size, _ = self.entries.pop(name)
+        self.currsize -= size
+        _remove_file(path)
+
+    def get(self, key: str) -> Optional[Tuple[bytes, float]]:
+        """Returns the bytes stored for key and the time at which they expire,
+        or None if there is no unexpired entry for it."""
+        name = self._name(key)
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None:
+                return None
+            path, _, expires_at = entry
+            if expires_at <= self.timer():
+                self._remove(name)
+                return None
+            self.entries.move_to_end(name)
+
+        try:
+            with open(path, 'rb') as f:
+                return f.read(), expires_at
+        except FileNotFoundError:
+            return None
+
+    def touch(self, key: str):
+        """Restarts the TTL of the entry for key, if there is one. The file's
+        modification time is updated too, so the TTL also restarts for the
+        processes that index it later."""
+        name = self._name(key)
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is not None:
+                path, size, _ = entry
+                self.entries[name] = (path, size, self.timer() + self.ttl)
+                try:
+                    os.utime(path)
+                except FileNotFoundError:
+                    pass
+
+    def put(self, key: str, data: bytes) -> int:
+        """Stores data for key, evicting least recently used entries to stay
+        within max_size_bytes. Data larger than max_size_bytes is not stored.
+
+        Returns: The number of entries that were evicted."""
+        size = len(data)
+        if size > self.max_size_bytes:
+            return 0
+
+        name = self._name(key)
+        path = os.path.join(self.cache_dir, name)
+        # Write to a temporary file first so concurrent readers never see a
+        # partially written file.
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}{_TMP_SUFFIX}'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+
+        evicted = 0
+        with self.lock:
+            if name in self.entries:
+                _, old_size, _ = self.entries.pop(name)
+                self.currsize -= old_size
+            while self.entries and self.currsize + size > self.max_size_bytes:
+                self._remove(next(iter(self.entries)))
+                evicted += 1
+            os.replace(tmp_path, path)
+            self.entries[name] = (path, size, self.timer() + self.ttl)
+            self.currsize += size
+        return evicted
+
+    def clear(self):
+        """Removes all entries and their files."""
+        with self.lock:
+            for name in list(self.entries):
+                self._remove(name)
+
+
+def _remove_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
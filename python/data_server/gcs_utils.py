@@ -1,8 +1,63 @@
+import base64
+import os
+import threading
+from typing import Dict
+
 from google.cloud import storage
 
+# A storage.Client is expensive to create: it discovers credentials and opens
+# its own pool of keep-alive connections. It is thread-safe, so one client
+# and one handle per bucket are shared by every request in a process.
+_client_lock = threading.Lock()
+_client = None
+_client_pid = None
+_buckets: Dict[str, storage.Bucket] = {}
+
+
+def get_client() -> storage.Client:
+    """Returns the storage.Client shared by this process, creating it on first
+    use. A process forked after the client was created gets its own client,
+    since connections can't be shared across processes."""
+    global _client, _client_pid
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            _client = storage.Client()
+            _client_pid = os.getpid()
+            _buckets.clear()
+        return _client
+
+
+def get_bucket(gcs_bucket: str) -> storage.Bucket:
+    """Returns a handle to the given bucket, using the shared client. Unlike
+    storage.Client.get_bucket, this doesn't make a request to GCS."""
+    client = get_client()
+    with _client_lock:
+        bucket = _buckets.get(gcs_bucket)
+        if bucket is None:
+            bucket = _buckets[gcs_bucket] = client.bucket(gcs_bucket)
+        return bucket
+
+
+def reset_client():
+    """Drops the shared client and bucket handles. Mostly useful for tests."""
+    global _client, _client_pid
+    with _client_lock:
+        _client = None
+        _client_pid = None
+        _buckets.clear()
+
 
 def download_blob_as_bytes(gcs_bucket: str, filename: str) -> bytes:
-    client = storage.Client()
-    bucket = client.get_bucket(gcs_bucket)
-    blob = bucket.blob(filename)
+    blob = get_bucket(gcs_bucket).blob(filename)
     return blob.download_as_bytes()
+
+
+def get_blob_md5(gcs_bucket: str, filename: str):
+    """Returns the hex encoded MD5 hash of the given blob's contents, using a
+    metadata request that doesn't download the blob. Returns None if the blob
+    doesn't exist or has no MD5 hash, which is the case for composite
+    objects."""
+    blob = get_bucket(gcs_bucket).get_blob(filename)
+    if blob is None or blob.md5_hash is None:
+        return None
+    return base64.b64decode(blob.md5_hash).hex()
@@ -0,0 +1,299 @@
+"""Minimal thread-safe metrics rendered in the Prometheus text format.
+
+Each metric holds one value (or one set of histogram buckets) per combination
+of label values. Recording a value takes a single lock and a dict lookup, so
+metrics can be recorded on the hot path of every request.
+"""
+import bisect
+import threading
+import time
+from typing import Any, Dict
+
+# Latency buckets in seconds, from a cache hit to a slow download from GCS.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value) -> str:
+    return (str(value).replace('\\', r'\\').replace('"', r'\"')
+            .replace('\n', r'\n'))
+
+
+def _format_labels(labelnames, labels, extra='') -> str:
+    pairs = [f'{name}="{_escape(value)}"'
+             for name, value in zip(labelnames, labels)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class _Metric():
+    type = ''
+
+    def __init__(self, name: str, help: str, labelnames=()):
+        """name: Name of the metric.
+        help: Description of the metric.
+        labelnames: Names of the labels that values are recorded under."""
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        # Maps a tuple of label values to the value recorded under them.
+        self.values: Dict[tuple, Any] = {}
+
+    def _header(self):
+        return [f'# HELP {self.name} {self.help}',
+                f'# TYPE {self.name} {self.type}']
+
+    def render(self):
+        """Returns the lines of the Prometheus text format for the metric."""
+        with self.lock:
+            values = sorted(self.values.items())
+        return self._header() + [
+            f'{self.name}{_format_labels(self.labelnames, labels)} '
+            f'{_format_value(value)}' for labels, value in values]
+
+    def clear(self):
+        """Drops all recorded values. Mostly useful for tests."""
+        with self.lock:
+            self.values.clear()
+
+
+class Counter(_Metric):
+    """A value that only goes up, such as a number of requests."""
+    type = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        """Adds amount to the value for the given label values."""
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, labels=()):
+        with self.lock:
+            return self.values.get(labels, 0)
+
+
+class Gauge(Counter):
+    """A value that can go up and down, such as a number of requests in
+    progress."""
+    type = 'gauge'
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+
+class Histogram(_Metric):
+    """Counts observed values, such as latencies, in buckets."""
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        """buckets: Sorted upper bounds of the buckets."""
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, labels=()):
+        """Records value for the given label values."""
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                # One count per bucket plus +Inf, then the sum.
+                counts = self.values[labels] = [0] * (len(self.buckets) + 1)
+                counts.append(0.0)
+            counts[i] += 1
+            counts[-1] += value
+
+    def get_count(self, labels=()):
+        with self.lock:
+            counts = self.values.get(labels)
+            return sum(counts[:-1]) if counts is not None else 0
+
+    def render(self):
+        with self.lock:
+            values = sorted((labels, list(counts))
+                            for labels, counts in self.values.items())
+        lines = self._header()
+        for labels, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = _format_labels(self.labelnames, labels,
+                                    f'le="{bound}"')
+                lines.append(f'{self.name}_bucket{le} {cumulative}')
+            label_str = _format_labels(self.labelnames, labels)
+            lines.append(f'{self.name}_sum{label_str} {counts[-1]}')
+            lines.append(f'{self.name}_count{label_str} {cumulative}')
+        return lines
+
+
+class Callback(_Metric):
+    """A metric whose values are read from a function when rendered, such as
+    counters kept by another object."""
+
+    def __init__(self, name: str, help: str, type: str, get_values,
+                 labelnames=()):
+        """type: Prometheus type of the metric, e.g. counter or gauge.
+        get_values: Function returning a dict of label values -> value, or
+                    a single value if there are no labels."""
+        super().__init__(name, help, labelnames)
+        self.type = type
+        self.get_values = get_values
+
+    def render(self):
+        values = self.get_values()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return self._header() + [
+            f'{self.name}{_format_labels(self.labelnames, labels)} '
+            f'{_format_value(value)}' for labels, value in values.items()]
+
+
+class Registry():
+    """A set of metrics that are rendered together."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Returns all metrics in the Prometheus text format."""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        """Drops the values of all metrics. Mostly useful for tests."""
+        for metric in self.metrics:
+            metric.clear()
+
+
+REGISTRY = Registry()
+
+GCS_DOWNLOAD_SECONDS = REGISTRY.register(Histogram(
+    'data_server_gcs_download_seconds',
+    'Time spent downloading datasets from GCS.'))
+GCS_DOWNLOAD_BYTES = REGISTRY.register(Counter(
+    'data_server_gcs_download_bytes_total',
+    'Bytes downloaded from GCS.'))
+GCS_REVALIDATION_SECONDS = REGISTRY.register(Histogram(
+    'data_server_gcs_revalidation_seconds',
+    'Time spent checking whether expired datasets changed in GCS.'))
+DATASET_BUILD_SECONDS = REGISTRY.register(Histogram(
+    'data_server_dataset_build_seconds',
+    'Time spent building the cached representations of a dataset.'))
+
+# Key of the WSGI environ under which handlers store the name of the dataset
+# a request served, to label its metrics.
+DATASET_ENVIRON_KEY = 'data_server.dataset'
+
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'data_server_request_seconds',
+    'Time from receiving a request until its response body was sent.',
+    labelnames=('route', 'dataset')))
+REQUESTS = REGISTRY.register(Counter(
+    'data_server_requests_total', 'Requests handled, by response status.',
+    labelnames=('route', 'status')))
+RESPONSE_BYTES = REGISTRY.register(Counter(
+    'data_server_response_bytes_total', 'Bytes of response bodies sent.',
+    labelnames=('route', 'dataset')))
+IN_FLIGHT_REQUESTS = REGISTRY.register(Gauge(
+    'data_server_in_flight_requests', 'Requests currently being handled.'))
+
+
+def record_request(route: str, status: str, dataset: str, nbytes: int,
+                   start: float):
+    """Records a finished request that was counted in IN_FLIGHT_REQUESTS.
+
+    route: Label of the path of the request.
+    status: Response status code, as a string.
+    dataset: Name of the dataset served, or an empty string.
+    nbytes: Size of the response body sent.
+    start: time.perf_counter() when the request was received."""
+    IN_FLIGHT_REQUESTS.dec()
+    REQUESTS.inc((route, status))
+    RESPONSE_BYTES.inc((route, dataset), nbytes)
+    REQUEST_SECONDS.observe(time.perf_counter() - start, (route, dataset))
+
+
+class _InstrumentedBody():
+    """Wraps the body of a WSGI response to count the bytes sent and to
+    record the request once all of it has been sent, or once the server
+    closes it if the client went away first."""
+
+    def __init__(self, body, on_done):
+        self.body = body
+        self.on_done = on_done
+        self.nbytes = 0
+        self.done = False
+
+    def _finish(self):
+        if not self.done:
+            self.done = True
+            self.on_done(self.nbytes)
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.nbytes += len(chunk)
+            yield chunk
+        self._finish()
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self._finish()
+
+
+class RequestMetricsMiddleware():
+    """WSGI middleware recording REQUESTS, REQUEST_SECONDS, RESPONSE_BYTES
+    and IN_FLIGHT_REQUESTS for every request, including the time spent
+    streaming the response body.
+
+    Handlers label a request with the dataset it served by storing the name
+    of the dataset in the WSGI environ under DATASET_ENVIRON_KEY. Only names
+    of datasets that were found should be stored, since anyone can request
+    arbitrary names."""
+
+    def __init__(self, app, routes):
+        """app: WSGI app to instrument.
+        routes: Paths recorded as their own route label. Other paths are
+                recorded as "other", to bound the number of labels."""
+        self.app = app
+        self.routes = set(routes)
+
+    def __call__(self, environ, start_response):
+        start = time.perf_counter()
+        route = environ.get('PATH_INFO', '')
+        if route not in self.routes:
+            route = 'other'
+        status = ['']
+
+        def instrumented_start_response(status_line, headers, exc_info=None):
+            status[0] = status_line.split(' ', 1)[0]
+            return start_response(status_line, headers, exc_info)
+
+        def on_done(nbytes):
+            record_request(route, status[0],
+                           environ.get(DATASET_ENVIRON_KEY, ''), nbytes,
+                           start)
+
+        IN_FLIGHT_REQUESTS.inc()
+        try:
+            body = self.app(environ, instrumented_start_response)
+        except BaseException:
+            status[0] = '500'
+            on_done(0)
+            raise
+        return _InstrumentedBody(body, on_done)
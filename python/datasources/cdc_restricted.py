@@ -95,7 +95,8 @@ class CDCRestrictedData(DataSource):
             filename = f'cdc_restricted_by_{demo}_{geo_to_pull}.csv'
 
             df = gcs_to_bq_util.load_csv_as_df(
-                gcs_bucket, filename, dtype={'county_fips': str})
+                gcs_bucket, filename, dtype={'county_fips': str},
+                usecols=get_breakdown_input_columns(demo, geo_to_pull))
 
             df = self.generate_breakdown(df, demo, geo, time_series)
 
@@ -358,6 +359,30 @@ def generate_national_dataset(state_df, demo_col, time_series):
     return df[needed_cols].reset_index(drop=True)
 
 
+def get_breakdown_input_columns(demographic, geo):
+    """Returns the columns of the restricted data files that
+    `generate_breakdown` uses. The others, such as the counts of negative
+    hospitalizations and deaths, don't need to be loaded.
+
+    demographic: Demographic breakdown. Must be "race", "age", or "sex".
+    geo: Geographic level of the file. Must be "state" or "county"."""
+    columns = [
+        std_col.STATE_POSTAL_COL,
+        std_col.TIME_PERIOD_COL,
+        DEMO_COL_MAPPING[demographic][0],
+        std_col.COVID_CASES,
+        std_col.COVID_HOSP_Y,
+        std_col.COVID_HOSP_UNKNOWN,
+        std_col.COVID_DEATH_Y,
+        std_col.COVID_DEATH_UNKNOWN,
+    ]
+
+    if geo == COUNTY_LEVEL:
+        columns.extend([std_col.COUNTY_FIPS_COL, std_col.COUNTY_NAME_COL])
+
+    return columns
+
+
 def add_missing_demographic_values(df, geo, demographic):
     """Adds in missing demographic values for each geo in the df. For example,
     if a given county only has WHITE, adds in empty data rows for all other
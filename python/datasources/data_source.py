@@ -64,16 +64,25 @@ class DataSource(ABC):
                                self.get_table_name())
 
     def write_to_bq_table(self, dataset: str, gcs_bucket: str,
-                          filename: str, table_name: str, project=None):
+                          filename: str, table_name: str, project=None,
+                          streaming=True):
         """Writes source data from GCS bucket to BigQuery
 
         dataset: The BigQuery dataset to write to
         gcs_bucket: The name of the gcs bucket to read the data from
         filename: The name of the file in the gcs bucket to read from
-        table_name: The name of the BigQuery table to write to"""
+        table_name: The name of the BigQuery table to write to
+        streaming: Whether to write all the chunks of the file with a single
+                   load job, instead of one load job per chunk"""
         chunked_frame = gcs_to_bq_util.load_csv_as_df(
             gcs_bucket, filename, chunksize=1000)
 
+        if streaming:
+            gcs_to_bq_util.add_dfs_to_bq(
+                self.clean_chunk_column_names(chunked_frame), dataset,
+                table_name, project=project)
+            return
+
         # For the very first chunk, we set the mode to overwrite to clear the
         # previous table. For subsequent chunks we append.
         overwrite = True
@@ -84,6 +93,22 @@ class DataSource(ABC):
                 overwrite=overwrite)
             overwrite = False
 
+    def clean_chunk_column_names(self, chunks):
+        """ Yields each of the given chunks of a file, with the column names
+        of the first cleaned like clean_frame_column_names does, and given to
+        the others.
+
+        chunks: Iterable of pandas dataframes with the same columns
+        """
+        columns = None
+        for chunk in chunks:
+            if columns is None:
+                self.clean_frame_column_names(chunk)
+                columns = chunk.columns
+            else:
+                chunk.columns = columns
+            yield chunk
+
     def clean_frame_column_names(self, frame):
         """ Replaces unfitting BigQuery characters and
         makes all column names lower case.
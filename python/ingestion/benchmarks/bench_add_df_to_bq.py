@@ -0,0 +1,140 @@
+"""Compares loading a DataFrame into BigQuery as json and as Parquet with
+add_df_to_bq, against a local stand-in for the BigQuery client that
+serializes the rows of a json load the way the real client does and reads
+the whole Parquet file.
+
+The json mode converts the frame to json, parses it back into a dict per row,
+and serializes those again. The parquet mode writes the frame once as Parquet.
+Each mode runs in its own process, so its peak RSS isn't affected by the
+other. The peak RSS is reported above the RSS of the process once the frame
+was built.
+
+Usage, from the python directory:
+    python ingestion/benchmarks/bench_add_df_to_bq.py [--counties 3200]
+                                                      [--periods 36]
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+from ingestion import gcs_to_bq_util  # noqa: E402
+
+MODES = ['json', 'parquet']
+
+
+def make_county_frame(num_counties: int, num_periods: int) -> pd.DataFrame:
+    """Returns a county-level, by race time series frame, like the ones
+    cdc_restricted writes."""
+    rng = np.random.default_rng(0)
+    county_fips = [f'{rng.integers(1, 57):02d}{i % 1000:03d}' for i in range(num_counties)]
+    races = ['AIAN_NH', 'ASIAN_NH', 'BLACK_NH', 'HISP', 'NHPI_NH',
+             'MULTI_OR_OTHER_STANDARD_NH', 'WHITE_NH', 'ALL']
+    periods = [f'{2020 + i // 12}-{i % 12 + 1:02d}' for i in range(num_periods)]
+    index = pd.MultiIndex.from_product([county_fips, periods, races],
+                                       names=['county_fips', 'time_period',
+                                              'race_category_id'])
+    frame = index.to_frame(index=False)
+    frame.insert(0, 'state_fips', frame['county_fips'].str[:2])
+    frame['county_name'] = 'County ' + frame['county_fips']
+    num_rows = len(frame)
+    for col in ['covid_cases_per_100k', 'covid_deaths_per_100k',
+                'covid_hosp_per_100k', 'covid_cases_pct_share',
+                'covid_deaths_pct_share', 'covid_population_pct']:
+        frame[col] = rng.uniform(0, 5000, num_rows).round(1)
+        # Some suppressed values, which are loaded as null.
+        frame.loc[rng.random(num_rows) < 0.2, col] = None
+    return frame
+
+
+class FakeLoadJob():
+    def result(self):
+        pass
+
+
+class FakeBigQueryClient():
+    """Serializes the rows of a json load, like
+    bigquery.Client.load_table_from_json, and reads the whole file of a
+    Parquet load, like the upload of bigquery.Client.load_table_from_file."""
+
+    def __init__(self, project=None):
+        self.loaded_bytes = 0
+
+    def dataset(self, dataset):
+        return mock.Mock()
+
+    def load_table_from_json(self, json_rows, table_id, job_config):
+        data = '\n'.join(json.dumps(row, ensure_ascii=False) for row in json_rows)
+        self.loaded_bytes = len(data.encode())
+        return FakeLoadJob()
+
+    def load_table_from_file(self, file_obj, table_id, job_config):
+        self.loaded_bytes = len(file_obj.read())
+        return FakeLoadJob()
+
+
+def get_rss_bytes() -> int:
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def run(mode: str, args):
+    """Loads the frame with add_df_to_bq in the given mode, and returns its
+    wall and CPU time, peak RSS and number of bytes loaded."""
+    frame = make_county_frame(args.counties, args.periods)
+    column_types = gcs_to_bq_util.get_bq_column_types(
+        frame, [col for col in frame.columns if col.startswith('covid_')])
+    client = FakeBigQueryClient()
+    rss_before = get_rss_bytes()
+
+    with mock.patch('ingestion.gcs_to_bq_util.bigquery.Client', return_value=client), \
+            mock.patch('ingestion.gcs_to_bq_util.pa', None if mode == 'json' else gcs_to_bq_util.pa):
+        start, cpu_start = time.perf_counter(), time.process_time()
+        gcs_to_bq_util.add_df_to_bq(frame, 'my-dataset', 'my-table',
+                                    column_types=column_types)
+        elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+
+    # ru_maxrss is in KiB on Linux.
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return {'rows': len(frame), 'elapsed': elapsed, 'cpu': cpu,
+            'peak_rss_above_frame': peak_rss - rss_before,
+            'loaded_bytes': client.loaded_bytes}
+
+
+def benchmark():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--counties', type=int, default=3200)
+    parser.add_argument('--periods', type=int, default=36)
+    parser.add_argument('--mode', choices=MODES,
+                        help='run only this mode in this process, and print '
+                             'its results as json')
+    args = parser.parse_args()
+
+    if args.mode is not None:
+        print(json.dumps(run(args.mode, args)))
+        return
+
+    for mode in MODES:
+        output = subprocess.run(
+            [sys.executable, __file__, '--counties', str(args.counties),
+             '--periods', str(args.periods), '--mode', mode],
+            check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.splitlines()[-1])
+        print(f'{mode}: {result["rows"]} rows, {result["elapsed"]:.2f}s, '
+              f'{result["cpu"]:.2f}s CPU, peak RSS '
+              f'+{result["peak_rss_above_frame"] / 2**20:.0f}MiB, '
+              f'{result["loaded_bytes"] / 2**20:.1f}MiB loaded')
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,136 @@
+import contextlib
+import os
+import threading
+from typing import Dict, Optional
+
+from google.cloud import bigquery, storage
+
+# Creating a bigquery.Client or storage.Client discovers credentials and opens
+# a new pool of keep-alive connections. Both are thread-safe, so one client
+# per project, and one handle per bucket, are shared by every ingestion
+# workflow in a process.
+_lock = threading.Lock()
+_pid: Optional[int] = None
+_bigquery_clients: Dict[Optional[str], bigquery.Client] = {}
+_storage_client: Optional[storage.Client] = None
+_buckets: Dict[str, storage.Bucket] = {}
+
+# Counters of client creations and of API requests made through the shared
+# clients, over the life of the process and for the workflows being tracked
+# on each thread.
+STAT_NAMES = ['bigquery_clients_created', 'storage_clients_created',
+              'bigquery_requests', 'storage_requests']
+_stats = dict.fromkeys(STAT_NAMES, 0)
+_local = threading.local()
+
+
+def _count(stat: str):
+    with _lock:
+        _stats[stat] += 1
+    for tracked in getattr(_local, 'tracked', []):
+        tracked[stat] += 1
+
+
+def _count_requests(client, stat: str):
+    """Counts every response the client's HTTP session receives as a round
+    trip, including the chunks of resumable uploads and downloads. The
+    session is private to the client libraries, so requests go uncounted if
+    a client doesn't have one."""
+    session = getattr(client, '_http', None)
+    if session is not None:
+        session.hooks['response'].append(lambda response, *args, **kwargs: _count(stat))
+
+
+def _reset_if_forked():
+    """Drops the clients created by a parent process, since connections can't
+    be shared across processes. Must be called with _lock held."""
+    global _pid, _storage_client
+    if _pid != os.getpid():
+        _bigquery_clients.clear()
+        _storage_client = None
+        _buckets.clear()
+        _pid = os.getpid()
+
+
+def get_bigquery_client(project=None) -> bigquery.Client:
+    """Returns the bigquery.Client shared by this process for the given
+    project, or the default project, creating it on first use."""
+    with _lock:
+        _reset_if_forked()
+        client = _bigquery_clients.get(project)
+    if client is not None:
+        return client
+
+    client = bigquery.Client(project)
+    _count('bigquery_clients_created')
+    _count_requests(client, 'bigquery_requests')
+    with _lock:
+        # Another thread may have created one in the meantime.
+        return _bigquery_clients.setdefault(project, client)
+
+
+def get_storage_client() -> storage.Client:
+    """Returns the storage.Client shared by this process, creating it on first
+    use."""
+    global _storage_client
+    with _lock:
+        _reset_if_forked()
+        client = _storage_client
+    if client is not None:
+        return client
+
+    client = storage.Client()
+    _count('storage_clients_created')
+    _count_requests(client, 'storage_requests')
+    with _lock:
+        if _storage_client is None:
+            _storage_client = client
+        return _storage_client
+
+
+def get_bucket(gcs_bucket: str) -> storage.Bucket:
+    """Returns a handle to the given bucket, using the shared client. The
+    bucket is fetched the first time, which raises
+    google.cloud.exceptions.NotFound if it doesn't exist, and its handle is
+    reused after that."""
+    client = get_storage_client()
+    with _lock:
+        bucket = _buckets.get(gcs_bucket)
+    if bucket is not None:
+        return bucket
+
+    bucket = client.get_bucket(gcs_bucket)
+    with _lock:
+        return _buckets.setdefault(gcs_bucket, bucket)
+
+
+def stats() -> dict:
+    """Returns the number of clients created and API requests made by this
+    process."""
+    with _lock:
+        return dict(_stats)
+
+
+@contextlib.contextmanager
+def track_stats():
+    """Counts the clients created and API requests made on this thread while
+    the context is active, such as during one workflow. Yields a dict of
+    STAT_NAMES to counts, updated as they happen."""
+    tracked = dict.fromkeys(STAT_NAMES, 0)
+    if not hasattr(_local, 'tracked'):
+        _local.tracked = []
+    _local.tracked.append(tracked)
+    try:
+        yield tracked
+    finally:
+        _local.tracked.pop()
+
+
+def reset_clients():
+    """Drops the shared clients and bucket handles. Mostly useful for tests."""
+    global _pid, _storage_client
+    with _lock:
+        _bigquery_clients.clear()
+        _storage_client = None
+        _buckets.clear()
+        _pid = None
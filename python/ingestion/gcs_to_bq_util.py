@@ -1,15 +1,29 @@
 import requests  # type: ignore
 import json
+import logging
 import os
+import tempfile
+import numpy as np
 import pandas as pd
-from google.cloud import bigquery, storage
+from google.cloud import bigquery
 from zipfile import ZipFile
 from io import BytesIO
 from typing import List
+from ingestion import gcp_clients
+
+try:
+    import pyarrow as pa  # type: ignore
+    import pyarrow.parquet as pq  # type: ignore
+except ImportError:
+    pa = None
 
 
 DATA_DIR = os.path.join(os.sep, 'app', 'data')
 
+# Files in GCS are read by streaming them into the parser, fetching this many
+# bytes per request.
+GCS_READ_CHUNK_SIZE = 10 * 1024 * 1024
+
 
 def __convert_frame_to_json(frame):
     """Returns the serialized version of the given dataframe in json."""
@@ -21,6 +35,89 @@ def __convert_frame_to_json(frame):
     return json_data
 
 
+def __convert_column_to_json_str_values(column):
+    """Returns the values of the given column as the strings that calling
+       str() on them gives after a round trip through json, one column at a
+       time instead of one row at a time. Nulls become 'None'."""
+    if pd.api.types.infer_dtype(column, skipna=True) in ('string', 'empty'):
+        return column.where(column.notna(), 'None')
+    if column.dtype == object:
+        # Objects of mixed types can't be deduplicated, since 1 == 1.0 == True.
+        return pd.Series([str(value) for value in json.loads(column.to_json(orient='values'))],
+                         index=column.index, dtype=object)
+    # Only the distinct values of numeric, bool and date columns are
+    # converted. Nulls get the code -1, which picks the last string.
+    codes, uniques = pd.factorize(column)
+    strs = [str(value) for value in json.loads(pd.Series(uniques).to_json(orient='values'))]
+    return pd.Series(np.array(strs + ['None'], dtype=object)[codes],
+                     index=column.index, dtype=object)
+
+
+def __get_arrow_type(bq_type):
+    """Returns the pyarrow type of a column loaded into the given BigQuery
+       type, or None to let pyarrow infer it from the column."""
+    return {
+        'STRING': pa.string(),
+        'FLOAT': pa.float64(),
+        'FLOAT64': pa.float64(),
+        'INTEGER': pa.int64(),
+        'INT64': pa.int64(),
+        'BOOLEAN': pa.bool_(),
+        'BOOL': pa.bool_(),
+    }.get(bq_type)
+
+
+def __convert_column_to_str(column):
+    """Converts the values of a numeric or bool column to the strings they
+       become when they are loaded into a STRING column from json, keeping
+       nulls. Other columns are returned as they are."""
+    if pd.api.types.is_bool_dtype(column):
+        return column.map({True: 'true', False: 'false'})
+    if pd.api.types.is_numeric_dtype(column):
+        # Floats are rounded the way to_json rounds them for the json load.
+        return __convert_column_to_json_str_values(column).where(column.notna(), None)
+    return column
+
+
+def __convert_frame_to_parquet(frame, column_types, col_modes):
+    """Returns the given dataframe serialized as Parquet in a file object,
+       with its columns converted to the BigQuery types in column_types.
+       Returns None if pyarrow isn't installed, a column has the REPEATED
+       mode, or a column can't be converted, in which case the frame has to be
+       loaded as json."""
+    if pa is None:
+        return None
+    if column_types is None:
+        col_modes = None
+    if col_modes is None:
+        col_modes = {}
+    if 'REPEATED' in col_modes.values():
+        return None
+
+    arrays, fields = [], []
+    try:
+        for col in frame.columns:
+            bq_type = column_types.get(col) if column_types is not None else None
+            column = frame[col]
+            if bq_type == 'STRING':
+                column = __convert_column_to_str(column)
+            array = pa.array(column, type=__get_arrow_type(bq_type), from_pandas=True)
+            arrays.append(array)
+            fields.append(pa.field(str(col), array.type,
+                                   nullable=col_modes.get(col) != 'REQUIRED'))
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError) as err:
+        logging.info('Loading frame as json, column %s can\'t be converted to Parquet: %s',
+                     col, err)
+        return None
+
+    parquet_file = BytesIO()
+    # BigQuery doesn't load nanosecond timestamps.
+    pq.write_table(pa.Table.from_arrays(arrays, schema=pa.schema(fields)), parquet_file,
+                   coerce_timestamps='us', allow_truncated_timestamps=True)
+    parquet_file.seek(0)
+    return parquet_file
+
+
 def __create_bq_load_job_config(frame, column_types, col_modes, overwrite):
     """
     Creates a job to write the given data frame into BigQuery.
@@ -48,15 +145,22 @@ def __create_bq_load_job_config(frame, column_types, col_modes, overwrite):
 
 
 def __dataframe_to_bq(frame, dataset, table_name, column_types, col_modes,
-                      project, json_data, overwrite):
+                      project, json_data, overwrite, parquet_file=None):
+    """Loads the given frame into `dataset.table_name`, from parquet_file if
+       it is given and from json_data otherwise."""
     job_config = __create_bq_load_job_config(
         frame, column_types, col_modes, overwrite)
 
-    client = bigquery.Client(project)
+    client = gcp_clients.get_bigquery_client(project)
     table_id = client.dataset(dataset).table(table_name)
 
-    load_job = client.load_table_from_json(
-        json_data, table_id, job_config=job_config)
+    if parquet_file is not None:
+        job_config.source_format = bigquery.SourceFormat.PARQUET
+        load_job = client.load_table_from_file(
+            parquet_file, table_id, job_config=job_config)
+    else:
+        load_job = client.load_table_from_json(
+            json_data, table_id, job_config=job_config)
     load_job.result()  # Wait for table load to complete.
 
 
@@ -76,13 +180,18 @@ def add_df_to_bq_as_str_values(frame, dataset: str, table_name: str,
                   NULLABLE, REQUIRED, and REPEATED. Must also specify
                   column_types to specify col_modes.
        overwrite: Whether to overwrite or append to the BigQuery table."""
-    json_data = __convert_frame_to_json(frame)
-    for sub in json_data:
-        for key in sub:
-            sub[key] = str(sub[key])
+    str_frame = pd.DataFrame(
+        {str(col): __convert_column_to_json_str_values(frame[col]) for col in frame.columns},
+        index=frame.index)
+
+    parquet_file = __convert_frame_to_parquet(str_frame, column_types, col_modes)
+    if parquet_file is not None:
+        __dataframe_to_bq(frame, dataset, table_name, column_types, col_modes,
+                          project, None, overwrite, parquet_file=parquet_file)
+        return
 
     __dataframe_to_bq(frame, dataset, table_name, column_types, col_modes,
-                      project, json_data, overwrite)
+                      project, str_frame.to_dict('records'), overwrite)
 
 
 def add_df_to_bq(frame, dataset, table_name, column_types=None,
@@ -99,12 +208,66 @@ def add_df_to_bq(frame, dataset, table_name, column_types=None,
        col_modes: Optional dict of modes for each field. Possible values include
                   NULLABLE, REQUIRED, and REPEATED. Must also specify
                   column_types to specify col_modes.
-       overwrite: Whether to overwrite or append to the BigQuery table."""
+       overwrite: Whether to overwrite or append to the BigQuery table.
+
+       The frame is loaded as Parquet, and only loaded as json if it has
+       REPEATED columns, or columns that can't be converted to their
+       column_types, or if pyarrow isn't installed."""
+    parquet_file = __convert_frame_to_parquet(frame, column_types, col_modes)
+    if parquet_file is not None:
+        __dataframe_to_bq(frame, dataset, table_name, column_types, col_modes,
+                          project, None, overwrite, parquet_file=parquet_file)
+        return
+
     json_data = __convert_frame_to_json(frame)
     __dataframe_to_bq(frame, dataset, table_name, column_types, col_modes,
                       project, json_data, overwrite)
 
 
+def add_dfs_to_bq(frames, dataset, table_name, column_types=None,
+                  col_modes=None, project=None, overwrite=True):
+    """Adds (either overwrites or appends) the rows of each of the provided
+       DataFrames to the table specified by `dataset.table_name`, with a
+       single load job. The frames are written to a temporary file as newline
+       delimited json one at a time, so only one of them is in memory at once.
+       Unlike Parquet, json doesn't need every frame to have the same column
+       dtypes, which chunks read from the same file may not. Nothing is
+       loaded if there are no frames.
+
+       frames: Iterable of pd.DataFrames with the same columns, such as the
+               chunks of a csv file.
+       dataset: The BigQuery dataset to write to.
+       table_name: The BigQuery table to write to.
+       column_types: Optional dict of column name to BigQuery data type. If
+                     present, the column names must match the columns in the
+                     DataFrames. Otherwise, table schema is inferred.
+       col_modes: Optional dict of modes for each field. Possible values include
+                  NULLABLE, REQUIRED, and REPEATED. Must also specify
+                  column_types to specify col_modes.
+       overwrite: Whether to overwrite or append to the BigQuery table."""
+    with tempfile.TemporaryFile() as json_file:
+        first_frame = None
+        for frame in frames:
+            if first_frame is None:
+                first_frame = frame.iloc[0:0]
+            nd_json = frame.to_json(orient='records', lines=True).rstrip('\n')
+            if nd_json:
+                json_file.write(nd_json.encode() + b'\n')
+        if first_frame is None:
+            return
+        json_file.seek(0)
+
+        job_config = __create_bq_load_job_config(
+            first_frame, column_types, col_modes, overwrite)
+        job_config.source_format = bigquery.SourceFormat.NEWLINE_DELIMITED_JSON
+
+        client = gcp_clients.get_bigquery_client(project)
+        table_id = client.dataset(dataset).table(table_name)
+        load_job = client.load_table_from_file(
+            json_file, table_id, job_config=job_config)
+        load_job.result()  # Wait for table load to complete.
+
+
 def get_schema(frame, column_types, col_modes):
     """Generates the BigQuery table schema from the column types and modes.
 
@@ -133,8 +296,7 @@ def load_values_as_df(gcs_bucket, filename):
 
        gcs_bucket: The name of the gcs bucket to read the data from
        filename: The name of the file in the gcs bucket to read from"""
-    client = storage.Client()
-    bucket = client.get_bucket(gcs_bucket)
+    bucket = gcp_clients.get_bucket(gcs_bucket)
     blob = bucket.blob(filename)
     return load_values_blob_as_df(blob)
 
@@ -158,10 +320,11 @@ def load_values_blob_as_df(blob):
 
 
 def load_csv_as_df(gcs_bucket, filename, dtype=None, chunksize=None,
-                   parse_dates=False, thousands=None):
+                   parse_dates=False, thousands=None, usecols=None):
     """Loads csv data from the provided gcs_bucket and filename to a DataFrame.
        Expects the data to be in csv format, with the first row as the column
-       names.
+       names. The file is streamed from GCS into the parser, rather than
+       downloaded first.
 
        gcs_bucket: The name of the gcs bucket to read the data from
        filename: The name of the file in the gcs bucket to read from
@@ -169,28 +332,36 @@ def load_csv_as_df(gcs_bucket, filename, dtype=None, chunksize=None,
               specified by the pd API. Not all column types need to be
               specified; column type is auto-detected. This is useful, for
               example, to force integer-like ids to be treated as strings
+       chunksize: If given, returns an iterator of DataFrames of this many
+                  rows, which reads the file as it is iterated and closes it
+                  when the iteration finishes
        parse_dates: Column(s) that should be parsed and interpreted as dates.
-       thousands: str to be used as a thousands separator for parsing numbers"""
-    client = storage.Client()
-    bucket = client.get_bucket(gcs_bucket)
-    blob = bucket.blob(filename)
-    local_path = local_file_path(filename)
-    blob.download_to_filename(local_path)
-    frame = pd.read_csv(local_path, dtype=dtype, chunksize=chunksize,
-                        parse_dates=parse_dates, thousands=thousands)
-
-    # Warning: os.remove() will remove the directory entry but will not release
-    # the file's storage until the file is no longer being used by |frame|.
-    # Double warning: This will cause an exception on Windows. See
-    # https://docs.python.org/3/library/os.html#os.remove for details.
-    os.remove(local_path)
-    return frame
+       thousands: str to be used as a thousands separator for parsing numbers
+       usecols: Optional list of the columns to load. The other columns are
+                skipped by the parser, which is faster and uses less memory"""
+    if chunksize is not None:
+        return __read_csv_chunks(gcs_bucket, filename, dtype=dtype,
+                                 chunksize=chunksize, parse_dates=parse_dates,
+                                 thousands=thousands, usecols=usecols)
+
+    with __open_blob(gcs_bucket, filename) as blob_file:
+        return pd.read_csv(blob_file, dtype=dtype, parse_dates=parse_dates,
+                           thousands=thousands, usecols=usecols)
+
+
+def __read_csv_chunks(gcs_bucket, filename, **kwargs):
+    """Yields the chunks of a csv file in GCS as they are read. The file is
+       opened when the first chunk is requested, and closed once the last one
+       has been read or the generator is closed."""
+    with __open_blob(gcs_bucket, filename) as blob_file:
+        yield from pd.read_csv(blob_file, **kwargs)
 
 
 def load_json_as_df(gcs_bucket, filename, dtype=None):
     """Loads json data from the provided gcs_bucket and filename to a DataFrame.
        Expects the data to be in csv format, with the first row as the column
-       names.
+       names. The file is streamed from GCS into the parser, rather than
+       downloaded first.
 
        gcs_bucket: The name of the gcs bucket to read the data from
        filename: The name of the file in the gcs bucket to read from
@@ -198,19 +369,15 @@ def load_json_as_df(gcs_bucket, filename, dtype=None):
               specified by the pd API. Not all column types need to be
               specified; column type is auto-detected. This is useful, for
               example, to force integer-like ids to be treated as strings"""
-    client = storage.Client()
-    bucket = client.get_bucket(gcs_bucket)
-    blob = bucket.blob(filename)
-    local_path = local_file_path(filename)
-    blob.download_to_filename(local_path)
-    frame = pd.read_json(local_path, dtype=dtype)
-
-    # Warning: os.remove() will remove the directory entry but will not release
-    # the file's storage until the file is no longer being used by |frame|.
-    # Double warning: This will cause an exception on Windows. See
-    # https://docs.python.org/3/library/os.html#os.remove for details.
-    os.remove(local_path)
-    return frame
+    with __open_blob(gcs_bucket, filename) as blob_file:
+        return pd.read_json(blob_file, dtype=dtype)
+
+
+def __open_blob(gcs_bucket, filename):
+    """Returns a binary file object that reads the given file from GCS, one
+       chunk of GCS_READ_CHUNK_SIZE bytes at a time."""
+    bucket = gcp_clients.get_bucket(gcs_bucket)
+    return bucket.blob(filename).open('rb', chunk_size=GCS_READ_CHUNK_SIZE)
 
 
 def load_csv_as_df_from_web(url, dtype=None, params=None, encoding=None) -> pd.DataFrame:
@@ -342,7 +509,7 @@ def load_public_dataset_from_bigquery_as_df(dataset, table_name, dtype=None) ->
 
        dataset: The BigQuery dataset to write to.
        table_name: The BigQuery table to write to."""
-    client = bigquery.Client()
+    client = gcp_clients.get_bigquery_client()
     table_id = 'bigquery-public-data.%s.%s' % (dataset, table_name)
 
     return client.list_rows(table_id).to_dataframe(dtypes=dtype)
@@ -353,7 +520,7 @@ def load_df_from_bigquery(dataset, table_name, dtype=None) -> pd.DataFrame:
 
        dataset: The BigQuery dataset to write to.
        table_name: The BigQuery table to write to."""
-    client = bigquery.Client()
+    client = gcp_clients.get_bigquery_client()
     table_id = client.dataset(dataset).table(table_name)
     table = client.get_table(table_id)
 
@@ -367,22 +534,16 @@ def load_values_as_json(gcs_bucket, filename):
 
        gcs_bucket: The name of the gcs bucket to read the data from
        filename: The name of the file in the gcs bucket to read from"""
-    client = storage.Client()
-    bucket = client.get_bucket(gcs_bucket)
+    bucket = gcp_clients.get_bucket(gcs_bucket)
     blob = bucket.blob(filename)
     return json.loads(blob.download_as_bytes().decode('utf-8'))
 
 
-def local_file_path(filename):
-    return '/tmp/{}'.format(filename)
-
-
 def list_bucket_files(bucket_name: str) -> list:
     """Returns a list of file names contained in the provided bucket.
 
        bucket_name: The name of the gcs bucket containing files"""
-    gcs_client = storage.Client()
-    bucket = gcs_client.get_bucket(bucket_name)
+    bucket = gcp_clients.get_bucket(bucket_name)
     blobs = bucket.list_blobs()
 
     return list(map(lambda blob: blob.name, blobs))
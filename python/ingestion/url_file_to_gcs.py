@@ -3,10 +3,10 @@
 
 import logging
 import os
-from google.cloud import storage
 import google.cloud.exceptions
 import requests
 import filecmp
+from ingestion import gcp_clients
 
 
 def local_file_path(filename):
@@ -62,8 +62,7 @@ def download_first_url_to_gcs(url_list, gcs_bucket, dest_filename,
 
     # Establish connection to valid GCS bucket
     try:
-        storage_client = storage.Client()
-        bucket = storage_client.get_bucket(gcs_bucket)
+        bucket = gcp_clients.get_bucket(gcs_bucket)
     except google.cloud.exceptions.NotFound:
         logging.error("GCS Bucket %s not found", gcs_bucket)
         return
@@ -0,0 +1,12 @@
+import pytest
+
+from ingestion import gcp_clients
+
+
+@pytest.fixture(autouse=True)
+def reset_gcp_clients():
+    """Makes every test start without shared BigQuery and Storage clients, so
+    the clients it mocks are the ones used."""
+    gcp_clients.reset_clients()
+    yield
+    gcp_clients.reset_clients()
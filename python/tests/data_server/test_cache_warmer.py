@@ -0,0 +1,110 @@
+import hashlib
+import time
+from unittest import mock
+
+import google.cloud.exceptions
+
+from data_server.cache_warmer import CacheWarmer, get_metadata_table_ids
+from data_server.dataset import Dataset
+from data_server.dataset_cache import DatasetCache
+
+test_data = b'{"state_fips":"01","population":1}\n'
+
+
+def get_test_data(gcs_bucket: str, filename: str):
+    """Returns test_data for every file except missing.json. Meant to be used
+    to patch gcs_utils.download_blob_as_bytes."""
+    if filename == 'missing.json':
+        raise google.cloud.exceptions.NotFound('File not found')
+    return test_data
+
+
+def dataset_size():
+    return Dataset.from_blob('test.json', test_data).nbytes
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data)
+def testPreload(mock_func: mock.MagicMock):
+    cache = DatasetCache()
+    warmer = CacheWarmer(cache, 'test_bucket')
+    warmer.preload(['a.json', 'missing.json', 'b.json'])
+
+    assert warmer.stats()['preloaded'] == 2
+    assert warmer.stats()['preload_failures'] == 1
+
+    cache.getDataset('test_bucket', 'a.json')
+    cache.getDataset('test_bucket', 'b.json')
+    assert mock_func.call_count == 3
+    assert cache.stats()['hits'] == 2
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data)
+def testPreload_StopsWhenCacheFull(mock_func: mock.MagicMock):
+    cache = DatasetCache(max_cache_bytes=dataset_size() * 4)
+    warmer = CacheWarmer(cache, 'test_bucket', max_fill_fraction=0.5)
+    warmer.preload(['a.json', 'b.json', 'c.json', 'd.json'])
+
+    assert warmer.stats()['preloaded'] == 2
+    assert warmer.stats()['preload_skipped'] == 2
+    assert cache.stats()['evictions'] == 0
+
+
+@mock.patch('data_server.gcs_utils.get_blob_md5',
+            return_value=hashlib.md5(test_data).hexdigest())
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data)
+def testRefreshExpiring(mock_func: mock.MagicMock, mock_md5: mock.MagicMock):
+    now = 0.0
+    cache = DatasetCache(cache_ttl=100, timer=lambda: now)
+    warmer = CacheWarmer(cache, 'test_bucket', refresh_ahead=10)
+    cache.getDataset('test_bucket', 'hot.json')
+    cache.getDataset('test_bucket', 'hot.json')
+    cache.getDataset('test_bucket', 'cold.json')
+
+    # Nothing expires soon.
+    now = 50.0
+    warmer.refresh_expiring()
+    mock_md5.assert_not_called()
+
+    # Only the dataset that was served from the cache is refreshed.
+    now = 95.0
+    warmer.refresh_expiring()
+    mock_md5.assert_called_once_with('test_bucket', 'hot.json')
+    assert warmer.stats()['refreshed'] == 1
+    assert mock_func.call_count == 2
+
+    # The refreshed dataset is still served from memory after its original
+    # expiry, while the other one is revalidated.
+    now = 150.0
+    cache.getDataset('test_bucket', 'hot.json')
+    assert mock_md5.call_count == 1
+    cache.getDataset('test_bucket', 'cold.json')
+    assert mock_md5.call_count == 2
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data)
+def testStart(mock_func: mock.MagicMock):
+    cache = DatasetCache()
+    warmer = CacheWarmer(cache, 'test_bucket', interval=0.01)
+    refresh_expiring = mock.MagicMock()
+    with mock.patch.object(warmer, 'refresh_expiring', refresh_expiring):
+        warmer.start(lambda: ['a.json'])
+        while refresh_expiring.call_count < 2:
+            time.sleep(0.01)
+        warmer.stop()
+
+    assert warmer.stats()['preloaded'] == 1
+    mock_func.assert_called_once_with('test_bucket', 'a.json')
+
+
+def testGetMetadataTableIds():
+    metadata = Dataset.from_blob('metadata.json', (
+        b'{"id":"acs_population-by_race_state","name":"Population"}\n'
+        b'{"name":"No id"}\n'
+        b'{"id":"cdc_restricted_data-by_age_county_processed"}\n'))
+    assert get_metadata_table_ids(metadata) == [
+        'acs_population-by_race_state.json',
+        'cdc_restricted_data-by_age_county_processed.json']
@@ -0,0 +1,49 @@
+import pytest
+
+from data_server import columnar
+
+pa = pytest.importorskip('pyarrow')
+
+test_data = (
+    b'{"state_fips":"01","race_category_id":"ALL","population":10}\n'
+    b'{"state_fips":"01","race_category_id":"BLACK_NH","population":4}\n'
+    b'{"state_fips":"02","race_category_id":"ALL","population":20}\n'
+    b'{"state_fips":"02","race_category_id":"BLACK_NH","population":null}\n')
+
+
+def read_arrow(arrow: bytes):
+    return pa.ipc.open_stream(pa.py_buffer(arrow)).read_all()
+
+
+def testNdjsonToArrow():
+    table = read_arrow(columnar.ndjson_to_arrow(test_data))
+    assert table.to_pylist() == [
+        {'state_fips': '01', 'race_category_id': 'ALL', 'population': 10},
+        {'state_fips': '01', 'race_category_id': 'BLACK_NH', 'population': 4},
+        {'state_fips': '02', 'race_category_id': 'ALL', 'population': 20},
+        {'state_fips': '02', 'race_category_id': 'BLACK_NH',
+         'population': None}]
+    assert pa.types.is_dictionary(table.schema.field('state_fips').type)
+    assert pa.types.is_dictionary(table.schema.field('race_category_id').type)
+    assert pa.types.is_integer(table.schema.field('population').type)
+
+
+def testNdjsonToArrow_UniqueStringsNotDictionaryEncoded():
+    data = b'{"county_name":"A"}\n{"county_name":"B"}\n{"county_name":"C"}\n'
+    table = read_arrow(columnar.ndjson_to_arrow(data))
+    assert pa.types.is_string(table.schema.field('county_name').type)
+
+
+def testNdjsonToArrow_Invalid():
+    assert columnar.ndjson_to_arrow(b'') is None
+    assert columnar.ndjson_to_arrow(b'not json\n') is None
+
+
+def testSliceArrow():
+    arrow = columnar.ndjson_to_arrow(test_data)
+    table = read_arrow(columnar.slice_arrow(arrow, [1, 3],
+                                            ['population', 'missing']))
+    assert table.to_pylist() == [{'population': 4}, {'population': None}]
+
+    table = read_arrow(columnar.slice_arrow(arrow, range(4)))
+    assert table.num_rows == 4
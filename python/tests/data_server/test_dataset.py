@@ -0,0 +1,36 @@
+import gzip
+
+from data_server.dataset import Dataset, ndjson_to_json_array
+
+
+def testNdjsonToJsonArray():
+    assert ndjson_to_json_array(b'{"a":1}\n{"a":2}\n') == b'[{"a":1},{"a":2}]'
+    assert ndjson_to_json_array(b'{"a":1}') == b'[{"a":1}]'
+    assert ndjson_to_json_array(b'') == b'[]'
+
+
+def testFromBlob_SmallNotCompressed():
+    dataset = Dataset.from_blob('table.json', b'{"a":1}\n')
+    assert dataset.mimetype == 'application/json'
+    assert dataset.encodings == {'identity': b'[{"a":1}]'}
+    assert dataset.nbytes == (len(b'[{"a":1}]') + dataset.index.nbytes +
+                              len(dataset.arrow or b''))
+
+
+def testFromBlob_LargeCompressed():
+    blob = b'{"state_fips":"01","population":1234}\n' * 100
+    dataset = Dataset.from_blob('table.json', blob)
+    assert gzip.decompress(dataset.encodings['gzip']) == dataset.body
+    assert list(dataset.encodings)[-1] == 'identity'
+    assert dataset.nbytes == (
+        dataset.index.nbytes + len(dataset.arrow or b'') +
+        sum(len(encoded) for encoded in dataset.encodings.values()))
+
+
+def testFromBlob_Csv():
+    blob = b'label1,label2\nvalueA,valueB\n'
+    dataset = Dataset.from_blob('table.csv', blob)
+    assert dataset.mimetype == 'text/csv'
+    assert dataset.body == blob
+    assert dataset.index is None
+    assert dataset.arrow is None
@@ -1,8 +1,16 @@
+import hashlib
+import os
+import threading
+import time
 from unittest import mock
 from unittest.mock import call
 
+import google.cloud.exceptions
+import pytest
+
 from textwrap import dedent
 
+from data_server.dataset import Dataset, ndjson_to_json_array
 from data_server.dataset_cache import DatasetCache
 
 
@@ -13,7 +21,7 @@ test_data = dedent("""
 {"label1":"value4","label2":["value5a","value2b","value2c"],"label3":"value12"}
 {"label1":"value5","label2":["value6a","value2b","value2c"],"label3":"value15"}
 {"label1":"value6","label2":["value7a","value2b","value2c"],"label3":"value18"}
-""").strip()
+""").strip().encode()
 
 test_data2 = dedent("""
     {"county_geoid":"78020","neighbor_geoids":["78020","78030"]}
@@ -22,7 +30,12 @@ test_data2 = dedent("""
     {"county_geoid":"78030","neighbor_geoids":["78020","78030"]}
     {"county_geoid":"78030","neighbor_geoids":["78020","78030"]}
     {"county_geoid":"78030","neighbor_geoids":["78020","78030"]}
-""").strip()
+""").strip().encode()
+
+
+def json_size(data: bytes):
+    """Returns the number of bytes data takes up in the cache."""
+    return Dataset.from_blob('test_data', data).nbytes
 
 
 def get_test_data(gcs_bucket: str, filename: str):
@@ -32,7 +45,7 @@ def get_test_data(gcs_bucket: str, filename: str):
         return test_data
     elif filename == 'test_data2':
         return test_data2
-    return ''
+    return b''
 
 
 @mock.patch('data_server.gcs_utils.download_blob_as_bytes',
@@ -41,7 +54,7 @@ def testGetDataset(mock_func: mock.MagicMock):
     cache = DatasetCache()
     data = cache.getDataset('test_bucket', 'test_data')
     mock_func.assert_called_once_with('test_bucket', 'test_data')
-    assert data == test_data.strip()
+    assert data.body == ndjson_to_json_array(test_data)
 
 
 @mock.patch('data_server.gcs_utils.download_blob_as_bytes',
@@ -60,30 +73,32 @@ def testGetDataset_FromCache(mock_func: mock.MagicMock):
 @mock.patch('data_server.gcs_utils.download_blob_as_bytes',
             side_effect=get_test_data)
 def testGetDataset_CacheEviction(mock_func: mock.MagicMock):
-    cache = DatasetCache(max_cache_size=1)
+    # Only one of the datasets fits in the cache at a time.
+    cache = DatasetCache(max_cache_bytes=max(json_size(test_data), json_size(test_data2)))
 
     data = cache.getDataset('test_bucket', 'test_data')
-    assert data == test_data
+    assert data.body == ndjson_to_json_array(test_data)
 
     # Make a second call which doesn't make an API call.
     data = cache.getDataset('test_bucket', 'test_data')
-    assert data == test_data
+    assert data.body == ndjson_to_json_array(test_data)
 
     # Now request a file that is not in the cache. It should replace the
     # existing data.
     data = cache.getDataset('test_bucket', 'test_data2')
-    assert data == test_data2
+    assert data.body == ndjson_to_json_array(test_data2)
 
     data = cache.getDataset('test_bucket', 'test_data2')
-    assert data == test_data2
+    assert data.body == ndjson_to_json_array(test_data2)
 
     data = cache.getDataset('test_bucket', 'test_data')
-    assert data == test_data
+    assert data.body == ndjson_to_json_array(test_data)
 
     assert mock_func.call_count == 3
     mock_func.assert_has_calls([call('test_bucket', 'test_data'),
                                 call('test_bucket', 'test_data2'),
                                 call('test_bucket', 'test_data')])
+    assert cache.stats()['evictions'] == 2
 
 
 @mock.patch('data_server.gcs_utils.download_blob_as_bytes',
@@ -91,14 +106,389 @@ def testGetDataset_CacheEviction(mock_func: mock.MagicMock):
 def testGetDataset_MultipleEntries(mock_func: mock.MagicMock):
     cache = DatasetCache()
     data = cache.getDataset('test_bucket', 'test_data')
-    assert data == test_data
+    assert data.body == ndjson_to_json_array(test_data)
 
     data = cache.getDataset('test_bucket', 'test_data2')
-    assert data == test_data2
+    assert data.body == ndjson_to_json_array(test_data2)
 
     data = cache.getDataset('test_bucket', 'test_data')
-    assert data == test_data
+    assert data.body == ndjson_to_json_array(test_data)
 
     assert mock_func.call_count == 2
     mock_func.assert_has_calls([call('test_bucket', 'test_data'),
                                 call('test_bucket', 'test_data2')])
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data)
+def testGetDataset_EvictsLeastRecentlyUsed(mock_func: mock.MagicMock):
+    # Room for either two small datasets or one small and one large one.
+    small_data = test_data.splitlines()[0]
+    cache = DatasetCache(max_cache_bytes=json_size(test_data2) + json_size(small_data))
+
+    def get_small_data(gcs_bucket: str, filename: str):
+        return small_data if filename.startswith('small') else get_test_data(
+            gcs_bucket, filename)
+    mock_func.side_effect = get_small_data
+
+    cache.getDataset('test_bucket', 'small1')
+    cache.getDataset('test_bucket', 'small2')
+    cache.getDataset('test_bucket', 'small1')
+    # small2 is now the least recently used entry.
+    cache.getDataset('test_bucket', 'test_data2')
+    assert mock_func.call_count == 3
+
+    cache.getDataset('test_bucket', 'small1')
+    assert mock_func.call_count == 3
+    cache.getDataset('test_bucket', 'small2')
+    assert mock_func.call_count == 4
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data)
+def testGetDataset_LargerThanCache(mock_func: mock.MagicMock):
+    cache = DatasetCache(max_cache_bytes=json_size(test_data2))
+    cache.getDataset('test_bucket', 'test_data2')
+
+    # A dataset that doesn't fit is returned but doesn't evict anything.
+    data = cache.getDataset('test_bucket', 'test_data')
+    assert data.body == ndjson_to_json_array(test_data)
+    cache.getDataset('test_bucket', 'test_data')
+    cache.getDataset('test_bucket', 'test_data2')
+
+    assert mock_func.call_count == 3
+    stats = cache.stats()
+    assert stats['evictions'] == 0
+    assert stats['entries'] == 1
+    assert stats['size_bytes'] == json_size(test_data2)
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data)
+def testGetDataset_Stats(mock_func: mock.MagicMock):
+    cache = DatasetCache()
+    cache.getDataset('test_bucket', 'test_data')
+    cache.getDataset('test_bucket', 'test_data')
+    cache.getDataset('test_bucket', 'test_data2')
+
+    stats = cache.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 2
+    assert stats['evictions'] == 0
+    assert stats['entries'] == 2
+    assert stats['size_bytes'] == json_size(test_data) + json_size(test_data2)
+
+    cache.clear()
+    assert cache.stats()['misses'] == 0
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data)
+def testGetDataset_DiskCache(mock_func: mock.MagicMock, tmp_path):
+    cache = DatasetCache(max_cache_bytes=max(json_size(test_data), json_size(test_data2)),
+                         disk_cache_dir=str(tmp_path))
+
+    cache.getDataset('test_bucket', 'test_data')
+    cache.getDataset('test_bucket', 'test_data2')
+
+    # test_data was evicted from memory, so it is read back from disk.
+    data = cache.getDataset('test_bucket', 'test_data')
+    assert data.body == ndjson_to_json_array(test_data)
+    assert mock_func.call_count == 2
+
+    stats = cache.stats()
+    assert stats['evictions'] == 2
+    assert stats['disk_hits'] == 1
+    assert stats['disk_entries'] == 2
+
+    cache.clear()
+    assert not list(tmp_path.iterdir())
+
+
+@mock.patch('data_server.gcs_utils.get_blob_md5', return_value=None)
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data)
+def testGetDataset_DiskCacheExpiry(mock_func: mock.MagicMock,
+                                   mock_md5: mock.MagicMock, tmp_path):
+    now = 0.0
+    cache = DatasetCache(max_cache_bytes=json_size(test_data2), cache_ttl=10,
+                         disk_cache_dir=str(tmp_path), timer=lambda: now)
+
+    cache.getDataset('test_bucket', 'test_data')
+    now = 20.0
+
+    # Expired entries are downloaded again rather than read from disk.
+    cache.getDataset('test_bucket', 'test_data')
+    assert mock_func.call_count == 2
+    assert cache.stats()['disk_hits'] == 0
+
+
+@mock.patch('data_server.gcs_utils.get_blob_md5',
+            return_value=hashlib.md5(test_data).hexdigest())
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data)
+def testGetDataset_DiskCacheHitKeepsExpiry(mock_func: mock.MagicMock,
+                                           mock_md5: mock.MagicMock,
+                                           tmp_path):
+    now = 0.0
+    cache = DatasetCache(cache_ttl=10, disk_cache_dir=str(tmp_path),
+                         timer=lambda: now)
+    cache.getDataset('test_bucket', 'test_data')
+
+    now = 6.0
+    cache.cache.clear()
+    cache.getDataset('test_bucket', 'test_data')
+    assert cache.stats()['disk_hits'] == 1
+
+    # The dataset read from disk expires with its disk entry, at 10, rather
+    # than a whole TTL after it was read.
+    now = 12.0
+    cache.getDataset('test_bucket', 'test_data')
+    mock_md5.assert_called_once_with('test_bucket', 'test_data')
+    mock_func.assert_called_once()
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data)
+def testGetDataset_DiskCacheFromEarlierProcess(mock_func: mock.MagicMock,
+                                               tmp_path):
+    cache = DatasetCache(cache_ttl=10, disk_cache_dir=str(tmp_path))
+    cache.getDataset('test_bucket', 'test_data')
+    cache.getDataset('test_bucket', 'test_data2')
+
+    # test_data2 was written too long ago, and so was a file the process was
+    # writing when it stopped.
+    written_at = time.time() - 20
+    expired_path = tmp_path / hashlib.sha256(b'test_data2').hexdigest()
+    os.utime(expired_path, (written_at, written_at))
+    abandoned_path = tmp_path / 'abandoned.tmp'
+    abandoned_path.write_bytes(test_data)
+    os.utime(abandoned_path, (written_at, written_at))
+
+    cache = DatasetCache(cache_ttl=10, disk_cache_dir=str(tmp_path))
+    stats = cache.stats()
+    assert stats['disk_entries'] == 1
+    assert stats['disk_size_bytes'] == len(test_data)
+    assert not expired_path.exists()
+    assert not abandoned_path.exists()
+
+    data = cache.getDataset('test_bucket', 'test_data')
+    assert data.body == ndjson_to_json_array(test_data)
+    assert mock_func.call_count == 2
+    assert cache.stats()['disk_hits'] == 1
+
+    # Files that don't fit in the new size limit are removed.
+    cache = DatasetCache(cache_ttl=10, disk_cache_dir=str(tmp_path),
+                         max_disk_cache_bytes=len(test_data) - 1)
+    assert cache.stats()['disk_entries'] == 0
+    assert not list(tmp_path.iterdir())
+
+
+@mock.patch('data_server.gcs_utils.get_blob_md5',
+            return_value=hashlib.md5(test_data).hexdigest())
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data)
+def testGetDataset_RevalidatesUnchanged(mock_func: mock.MagicMock,
+                                        mock_md5: mock.MagicMock):
+    now = 0.0
+    cache = DatasetCache(cache_ttl=10, timer=lambda: now)
+    data = cache.getDataset('test_bucket', 'test_data')
+
+    # Still fresh, so GCS isn't contacted at all.
+    now = 5.0
+    assert cache.getDataset('test_bucket', 'test_data') is data
+    mock_md5.assert_not_called()
+
+    # Expired, but the file hasn't changed, so it's not downloaded again.
+    now = 15.0
+    assert cache.getDataset('test_bucket', 'test_data') is data
+    mock_md5.assert_called_once_with('test_bucket', 'test_data')
+    mock_func.assert_called_once()
+    assert cache.stats()['revalidations'] == 1
+
+    # Revalidation restarts the TTL.
+    now = 20.0
+    assert cache.getDataset('test_bucket', 'test_data') is data
+    mock_md5.assert_called_once()
+
+
+@mock.patch('data_server.gcs_utils.get_blob_md5',
+            return_value=hashlib.md5(test_data2).hexdigest())
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes')
+def testGetDataset_RevalidatesChanged(mock_func: mock.MagicMock,
+                                      mock_md5: mock.MagicMock):
+    now = 0.0
+    cache = DatasetCache(cache_ttl=10, timer=lambda: now)
+    mock_func.return_value = test_data
+    cache.getDataset('test_bucket', 'test_data')
+
+    # The file was rewritten since it was cached, so it's downloaded again.
+    now = 15.0
+    mock_func.return_value = test_data2
+    data = cache.getDataset('test_bucket', 'test_data')
+    assert data.body == ndjson_to_json_array(test_data2)
+    assert data.md5 == hashlib.md5(test_data2).hexdigest()
+    assert mock_func.call_count == 2
+    assert cache.stats()['revalidations'] == 0
+
+
+@mock.patch('data_server.gcs_utils.get_blob_md5')
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes')
+def testRefreshDataset_ChangedSkipsDiskCache(mock_func: mock.MagicMock,
+                                             mock_md5: mock.MagicMock,
+                                             tmp_path):
+    now = 0.0
+    cache = DatasetCache(cache_ttl=10, disk_cache_dir=str(tmp_path),
+                         timer=lambda: now)
+    mock_func.return_value = test_data
+    cache.getDataset('test_bucket', 'test_data')
+
+    # The file is rewritten while the disk entry for the old version is still
+    # unexpired, so the new version is downloaded instead of read from disk.
+    now = 6.0
+    mock_func.return_value = test_data2
+    mock_md5.return_value = hashlib.md5(test_data2).hexdigest()
+    data = cache.refresh_dataset('test_bucket', 'test_data')
+    assert data.body == ndjson_to_json_array(test_data2)
+    assert data.md5 == hashlib.md5(test_data2).hexdigest()
+    assert mock_func.call_count == 2
+    assert cache.stats()['disk_hits'] == 0
+
+    # The disk entry was replaced with the new version.
+    cache.cache.clear()
+    data = cache.getDataset('test_bucket', 'test_data')
+    assert data.body == ndjson_to_json_array(test_data2)
+    assert mock_func.call_count == 2
+    assert cache.stats()['disk_hits'] == 1
+
+
+@mock.patch('data_server.gcs_utils.get_blob_md5',
+            return_value=hashlib.md5(test_data).hexdigest())
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data)
+def testGetDataset_RevalidationRestartsDiskCacheTtl(mock_func: mock.MagicMock,
+                                                    mock_md5: mock.MagicMock,
+                                                    tmp_path):
+    now = 0.0
+    cache = DatasetCache(cache_ttl=10, disk_cache_dir=str(tmp_path),
+                         timer=lambda: now)
+    cache.getDataset('test_bucket', 'test_data')
+
+    now = 15.0
+    cache.getDataset('test_bucket', 'test_data')
+    assert cache.stats()['revalidations'] == 1
+
+    # The disk entry would have expired at 10 without the revalidation.
+    now = 20.0
+    cache.cache.clear()
+    cache.getDataset('test_bucket', 'test_data')
+    mock_func.assert_called_once()
+    assert cache.stats()['disk_hits'] == 1
+
+
+def testGetDataset_ConcurrentMissesCoalesced():
+    num_threads = 8
+    download_started = threading.Event()
+    release_download = threading.Event()
+    download_count = 0
+
+    def slow_download(gcs_bucket: str, filename: str):
+        nonlocal download_count
+        download_count += 1
+        download_started.set()
+        release_download.wait()
+        return get_test_data(gcs_bucket, filename)
+
+    cache = DatasetCache()
+    results = []
+    with mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+                    side_effect=slow_download):
+        threads = [threading.Thread(
+            target=lambda: results.append(
+                cache.getDataset('test_bucket', 'test_data')))
+            for _ in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        download_started.wait()
+        # Give the other threads a chance to queue up behind the download.
+        while cache.stats()['coalesced'] < num_threads - 1:
+            time.sleep(0.01)
+        release_download.set()
+        for thread in threads:
+            thread.join()
+
+    assert download_count == 1
+    assert [data.body for data in results] == (
+        [ndjson_to_json_array(test_data)] * num_threads)
+    assert 'test_data' not in cache.pending
+
+
+def testGetDataset_ConcurrentMissesShareError():
+    num_threads = 4
+    release_download = threading.Event()
+    download_count = 0
+
+    def failing_download(gcs_bucket: str, filename: str):
+        nonlocal download_count
+        download_count += 1
+        release_download.wait()
+        raise google.cloud.exceptions.NotFound('File not found')
+
+    cache = DatasetCache()
+    errors = []
+
+    def get_dataset():
+        try:
+            cache.getDataset('test_bucket', 'test_data')
+        except google.cloud.exceptions.NotFound as err:
+            errors.append(err)
+
+    with mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+                    side_effect=failing_download):
+        threads = [threading.Thread(target=get_dataset)
+                   for _ in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        while cache.stats()['coalesced'] < num_threads - 1:
+            time.sleep(0.01)
+        release_download.set()
+        for thread in threads:
+            thread.join()
+
+        assert download_count == 1
+        assert len(errors) == num_threads
+
+        # The failure is not cached, so the next request retries.
+        release_download.set()
+        with pytest.raises(google.cloud.exceptions.NotFound):
+            cache.getDataset('test_bucket', 'test_data')
+        assert download_count == 2
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes')
+def testGetDataset_Csv(mock_func: mock.MagicMock):
+    csv_data = b'label1,label2\nvalueA,valueB\n'
+    mock_func.return_value = csv_data
+    cache = DatasetCache()
+
+    data = cache.getDataset('test_bucket', 'test_data.csv')
+    assert data.body == csv_data
+    assert data.mimetype == 'text/csv'
+
+
+@mock.patch('data_server.gcs_utils.download_blob_as_bytes',
+            side_effect=get_test_data)
+def testGetFreshDataset(mock_func: mock.MagicMock):
+    now = 0.0
+    cache = DatasetCache(cache_ttl=10, timer=lambda: now)
+    assert cache.get_fresh_dataset('test_data') is None
+    mock_func.assert_not_called()
+
+    data = cache.getDataset('test_bucket', 'test_data')
+    assert cache.get_fresh_dataset('test_data') is data
+    assert cache.stats()['hits'] == 1
+
+    # Expired datasets are left for getDataset to revalidate.
+    now = 15.0
+    assert cache.get_fresh_dataset('test_data') is None
+    assert cache.stats()['misses'] == 1
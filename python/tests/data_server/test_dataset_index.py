@@ -0,0 +1,74 @@
+import json
+from textwrap import dedent
+
+from data_server.dataset import ndjson_to_indexed_json_array
+
+test_data = dedent("""
+{"county_fips":"06001","state_fips":"06","time_period":"2021-12","cases":1}
+{"county_fips":"06001","state_fips":"06","time_period":"2022-01","cases":2}
+{"county_fips":"06003","state_fips":"06","time_period":"2022-01","cases":3}
+{"county_fips":"01001","state_fips":"01","time_period":"2022-01","cases":4}
+{"county_fips":"01001","state_fips":"01","time_period":"2022-02","cases":5}
+""").strip().encode()
+
+test_state_data = dedent("""
+{"state_fips":"06","race_category_id":"ALL","population":10}
+{"state_fips":"01","race_category_id":"ALL","population":20}
+""").strip().encode()
+
+
+def select_cases(data: bytes, **filters):
+    body, index = ndjson_to_indexed_json_array(data)
+    rows = index.select(**filters)
+    return [row['cases'] for row in json.loads(index.slice_rows(body, rows))]
+
+
+def testIndex_RowOffsets():
+    body, index = ndjson_to_indexed_json_array(test_data)
+    assert body == b'[' + b','.join(test_data.splitlines()) + b']'
+    for i, row in enumerate(test_data.splitlines()):
+        assert body[index.starts[i]:index.ends[i]] == row
+
+
+def testSelect_NoFilters():
+    assert select_cases(test_data) == [1, 2, 3, 4, 5]
+
+
+def testSelect_Fips():
+    assert select_cases(test_data, fips='06001') == [1, 2]
+    assert select_cases(test_data, fips='06') == []
+    assert select_cases(test_data, fips='99999') == []
+
+
+def testSelect_FipsPrefix():
+    assert select_cases(test_data, fips_prefix='06') == [1, 2, 3]
+    assert select_cases(test_data, fips_prefix='0600') == [1, 2, 3]
+    assert select_cases(test_data, fips_prefix='06003') == [3]
+    assert select_cases(test_data, fips_prefix='0') == [1, 2, 3, 4, 5]
+
+
+def testSelect_TimePeriod():
+    assert select_cases(test_data, time_period='2022') == [2, 3, 4, 5]
+    assert select_cases(test_data, time_period='2022-01') == [2, 3, 4]
+    assert select_cases(test_data, time_period='202') == []
+
+
+def testSelect_Combined():
+    assert select_cases(test_data, fips_prefix='06',
+                        time_period='2022') == [2, 3]
+    assert select_cases(test_data, fips='01001',
+                        time_period='2022-02') == [5]
+
+
+def testSelect_StateFips():
+    body, index = ndjson_to_indexed_json_array(test_state_data)
+    rows = index.select(fips='01')
+    assert json.loads(index.slice_rows(body, rows)) == [
+        {'state_fips': '01', 'race_category_id': 'ALL', 'population': 20}]
+
+
+def testSliceRows_Columns():
+    body, index = ndjson_to_indexed_json_array(test_data)
+    rows = index.select(fips='06003')
+    sliced = index.slice_rows(body, rows, ['county_fips', 'cases', 'missing'])
+    assert sliced == b'[{"county_fips":"06003","cases":3}]'
@@ -0,0 +1,71 @@
+import base64
+import hashlib
+from unittest import mock
+
+import pytest
+
+from data_server import gcs_utils
+
+
+@pytest.fixture(autouse=True)
+def reset_client():
+    """Makes every test start without a shared client."""
+    gcs_utils.reset_client()
+    yield
+    gcs_utils.reset_client()
+
+
+@mock.patch('google.cloud.storage.Client')
+def testDownloadBlobAsBytes_SharesClient(mock_client: mock.MagicMock):
+    mock_bucket = mock_client.return_value.bucket.return_value
+    mock_bucket.blob.return_value.download_as_bytes.return_value = b'data'
+
+    assert gcs_utils.download_blob_as_bytes('bucket', 'file1') == b'data'
+    assert gcs_utils.download_blob_as_bytes('bucket', 'file2') == b'data'
+
+    mock_client.assert_called_once()
+    mock_client.return_value.bucket.assert_called_once_with('bucket')
+    mock_client.return_value.get_bucket.assert_not_called()
+    mock_bucket.blob.assert_has_calls([mock.call('file1'),
+                                       mock.call('file2')], any_order=True)
+
+
+@mock.patch('google.cloud.storage.Client')
+def testGetBucket_PerBucketHandle(mock_client: mock.MagicMock):
+    mock_client.return_value.bucket.side_effect = lambda name: name
+
+    assert gcs_utils.get_bucket('bucket1') == 'bucket1'
+    assert gcs_utils.get_bucket('bucket2') == 'bucket2'
+    assert gcs_utils.get_bucket('bucket1') == 'bucket1'
+
+    mock_client.assert_called_once()
+    assert mock_client.return_value.bucket.call_count == 2
+
+
+@mock.patch('os.getpid')
+@mock.patch('google.cloud.storage.Client')
+def testGetClient_NewClientAfterFork(mock_client: mock.MagicMock,
+                                     mock_getpid: mock.MagicMock):
+    mock_client.side_effect = lambda: mock.MagicMock()
+    mock_getpid.return_value = 100
+    parent_client = gcs_utils.get_client()
+    assert gcs_utils.get_client() is parent_client
+
+    mock_getpid.return_value = 101
+    child_client = gcs_utils.get_client()
+    assert child_client is not parent_client
+    assert gcs_utils.get_client() is child_client
+    assert mock_client.call_count == 2
+
+
+@mock.patch('google.cloud.storage.Client')
+def testGetBlobMd5(mock_client: mock.MagicMock):
+    mock_bucket = mock_client.return_value.bucket.return_value
+    digest = hashlib.md5(b'data').digest()
+    mock_bucket.get_blob.return_value.md5_hash = base64.b64encode(digest)
+
+    assert gcs_utils.get_blob_md5('bucket', 'file') == digest.hex()
+    mock_bucket.get_blob.assert_called_once_with('file')
+
+    mock_bucket.get_blob.return_value = None
+    assert gcs_utils.get_blob_md5('bucket', 'file') is None
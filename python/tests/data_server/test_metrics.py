@@ -0,0 +1,161 @@
+import threading
+
+import pytest
+
+from data_server import metrics
+
+
+def testCounter():
+    counter = metrics.Counter('test_total', 'Test counter.',
+                              labelnames=('route',))
+    counter.inc(('/a',))
+    counter.inc(('/a',), 2)
+    counter.inc(('/b',))
+
+    assert counter.get(('/a',)) == 3
+    assert counter.render() == [
+        '# HELP test_total Test counter.',
+        '# TYPE test_total counter',
+        'test_total{route="/a"} 3',
+        'test_total{route="/b"} 1',
+    ]
+
+
+def testCounter_EscapesLabels():
+    counter = metrics.Counter('test_total', 'Test counter.',
+                              labelnames=('name',))
+    counter.inc(('a"b\\c\n',))
+    assert counter.render()[-1] == 'test_total{name="a\\"b\\\\c\\n"} 1'
+
+
+def testCounter_ThreadSafe():
+    counter = metrics.Counter('test_total', 'Test counter.')
+
+    def inc():
+        for _ in range(1000):
+            counter.inc()
+
+    threads = [threading.Thread(target=inc) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert counter.get() == 8000
+
+
+def testGauge():
+    gauge = metrics.Gauge('test', 'Test gauge.')
+    gauge.inc()
+    gauge.inc()
+    gauge.dec()
+    assert gauge.render()[-1] == 'test 1'
+
+
+def testHistogram():
+    histogram = metrics.Histogram('test_seconds', 'Test histogram.',
+                                  labelnames=('route',), buckets=(0.1, 1))
+    histogram.observe(0.05, ('/a',))
+    histogram.observe(0.1, ('/a',))
+    histogram.observe(0.5, ('/a',))
+    histogram.observe(5, ('/a',))
+
+    assert histogram.get_count(('/a',)) == 4
+    assert histogram.get_count(('/b',)) == 0
+    assert histogram.render()[2:] == [
+        'test_seconds_bucket{route="/a",le="0.1"} 2',
+        'test_seconds_bucket{route="/a",le="1"} 3',
+        'test_seconds_bucket{route="/a",le="+Inf"} 4',
+        'test_seconds_sum{route="/a"} 5.65',
+        'test_seconds_count{route="/a"} 4',
+    ]
+
+
+def testCallback():
+    stats = {'hits': 3}
+    callback = metrics.Callback('test_hits_total', 'Test hits.', 'counter',
+                                lambda: stats['hits'])
+    stats['hits'] = 4
+    assert callback.render() == [
+        '# HELP test_hits_total Test hits.',
+        '# TYPE test_hits_total counter',
+        'test_hits_total 4',
+    ]
+
+
+def testRegistry():
+    registry = metrics.Registry()
+    counter = registry.register(metrics.Counter('a_total', 'A.'))
+    gauge = registry.register(metrics.Gauge('b', 'B.'))
+    counter.inc()
+    gauge.inc(amount=2)
+
+    assert registry.render() == ('# HELP a_total A.\n# TYPE a_total counter\n'
+                                 'a_total 1\n# HELP b B.\n# TYPE b gauge\n'
+                                 'b 2\n')
+    registry.clear()
+    assert counter.get() == 0
+
+
+def app(environ, start_response):
+    if environ['PATH_INFO'] == '/error':
+        raise ValueError('Error')
+    if environ['PATH_INFO'] == '/dataset':
+        environ[metrics.DATASET_ENVIRON_KEY] = environ['QUERY_STRING']
+    status = '404 NOT FOUND' if environ['PATH_INFO'] == '/missing' else '200 OK'
+    start_response(status, [('Content-Type', 'text/plain')])
+    return [b'abc', b'de']
+
+
+def call(middleware, path, query_string=''):
+    environ = {'PATH_INFO': path, 'QUERY_STRING': query_string}
+    body = middleware(environ, lambda status, headers, exc_info=None: None)
+    data = b''.join(body)
+    body.close()
+    return data
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    metrics.REGISTRY.clear()
+
+
+def testRequestMetricsMiddleware():
+    middleware = metrics.RequestMetricsMiddleware(
+        app, routes=['/dataset', '/missing', '/error'])
+
+    assert call(middleware, '/dataset', 'a.json') == b'abcde'
+    assert call(middleware, '/dataset', 'a.json') == b'abcde'
+    call(middleware, '/unknown')
+
+    assert metrics.REQUESTS.get(('/dataset', '200')) == 2
+    assert metrics.REQUESTS.get(('other', '200')) == 1
+    assert metrics.REQUEST_SECONDS.get_count(('/dataset', 'a.json')) == 2
+    assert metrics.RESPONSE_BYTES.get(('/dataset', 'a.json')) == 10
+    assert metrics.IN_FLIGHT_REQUESTS.get() == 0
+
+
+def testRequestMetricsMiddleware_Errors():
+    middleware = metrics.RequestMetricsMiddleware(
+        app, routes=['/missing', '/error'])
+
+    call(middleware, '/missing')
+    with pytest.raises(ValueError):
+        call(middleware, '/error')
+
+    assert metrics.REQUESTS.get(('/missing', '404')) == 1
+    assert metrics.REQUESTS.get(('/error', '500')) == 1
+    assert metrics.REQUEST_SECONDS.get_count(('/error', '')) == 1
+    assert metrics.IN_FLIGHT_REQUESTS.get() == 0
+
+
+def testRequestMetricsMiddleware_InFlight():
+    middleware = metrics.RequestMetricsMiddleware(app, routes=['/dataset'])
+
+    body = middleware({'PATH_INFO': '/dataset', 'QUERY_STRING': 'a.json'},
+                      lambda status, headers, exc_info=None: None)
+    assert metrics.IN_FLIGHT_REQUESTS.get() == 1
+    # Closing a body that was not fully sent still ends the request.
+    body.close()
+    assert metrics.IN_FLIGHT_REQUESTS.get() == 0
+    assert metrics.REQUEST_SECONDS.get_count(('/dataset', 'a.json')) == 1
+    assert metrics.RESPONSE_BYTES.get(('/dataset', 'a.json')) == 0
@@ -82,7 +82,7 @@ def get_cdc_numbers_as_df(*args, **kwargs):
     return pd.read_csv(os.path.join(TEST_DIR, args[1]), dtype={
         'state_fips': str,
         'county_fips': str,
-    })
+    }, usecols=kwargs.get('usecols'))
 
 
 def get_cdc_restricted_by_sex_state_as_df():
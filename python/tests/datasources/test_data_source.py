@@ -1,3 +1,7 @@
+import io
+import json
+from unittest import mock
+
 import pandas as pd
 
 from datasources.data_source import DataSource
@@ -15,3 +19,66 @@ def testCleanFrameColumnNames():
     ds.clean_frame_column_names(df)
     assert set(df.columns) == set(['upp3rcase', 'special_char', 'thiseqthat',
                                    'pctcount', 'with_spaces'])
+
+
+_test_csv = 'State FIPS,Race/Ethnicity,Count %\n' + ''.join(
+    f'{i % 56:02d},{["Black", "White", "Asian"][i % 3]},{"" if i % 5 == 0 else i / 4}\n'
+    for i in range(2500))
+
+
+class _FakeBigQueryClient():
+    """Keeps the rows loaded into each table in `tables`, replacing them on
+    WRITE_TRUNCATE and adding to them on WRITE_APPEND, and counts load jobs."""
+
+    tables: dict = {}
+    load_jobs = 0
+
+    def __init__(self, project=None):
+        pass
+
+    def dataset(self, dataset):
+        return mock.Mock(table=lambda table_name: f'{dataset}.{table_name}')
+
+    def _load(self, rows, table_id, job_config):
+        type(self).load_jobs += 1
+        if job_config.write_disposition == 'WRITE_TRUNCATE':
+            self.tables[table_id] = []
+        self.tables[table_id].extend(rows)
+        return mock.Mock()
+
+    def load_table_from_json(self, json_rows, table_id, job_config):
+        return self._load(json_rows, table_id, job_config)
+
+    def load_table_from_file(self, file_obj, table_id, job_config):
+        if job_config.source_format == 'PARQUET':
+            rows = pd.read_parquet(file_obj).to_dict('records')
+        else:
+            rows = [json.loads(line) for line in file_obj.read().decode().splitlines()]
+        return self._load(rows, table_id, job_config)
+
+
+@mock.patch('ingestion.gcs_to_bq_util.bigquery.Client', _FakeBigQueryClient)
+@mock.patch('ingestion.gcs_to_bq_util.load_csv_as_df',
+            side_effect=lambda gcs_bucket, filename, chunksize: pd.read_csv(
+                io.StringIO(_test_csv), chunksize=chunksize))
+def testWriteToBqTable_Streaming(mock_load_csv: mock.MagicMock):
+    ds = DataSource()
+
+    _FakeBigQueryClient.load_jobs = 0
+    ds.write_to_bq_table('my-dataset', 'my-bucket', 'file.csv', 'chunked', streaming=False)
+    assert _FakeBigQueryClient.load_jobs == 3
+
+    _FakeBigQueryClient.load_jobs = 0
+    ds.write_to_bq_table('my-dataset', 'my-bucket', 'file.csv', 'streaming')
+    # the whole file is loaded at once
+    assert _FakeBigQueryClient.load_jobs == 1
+
+    chunked_df = pd.DataFrame(_FakeBigQueryClient.tables['my-dataset.chunked'])
+    streaming_df = pd.DataFrame(_FakeBigQueryClient.tables['my-dataset.streaming'])
+    assert list(streaming_df.columns) == ['state_fips', 'race_ethnicity', 'count_pct']
+    assert len(streaming_df) == 2500
+    pd.testing.assert_frame_equal(streaming_df, chunked_df)
+
+    # writing the file again replaces the table
+    ds.write_to_bq_table('my-dataset', 'my-bucket', 'file.csv', 'streaming')
+    assert len(_FakeBigQueryClient.tables['my-dataset.streaming']) == 2500
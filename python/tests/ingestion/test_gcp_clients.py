@@ -0,0 +1,124 @@
+import threading
+from unittest import mock
+
+import google.cloud.exceptions
+import pytest
+import requests
+
+from ingestion import gcp_clients
+
+
+def _respond(client):
+    """Calls the response hooks of the client's session, like a request the
+    client made would."""
+    for hook in client._http.hooks['response']:
+        hook(mock.Mock())
+
+
+def _new_client(*args):
+    client = mock.MagicMock()
+    client._http = requests.Session()
+    return client
+
+
+@mock.patch('google.cloud.bigquery.Client')
+def testGetBigqueryClient_SharedPerProject(mock_client: mock.MagicMock):
+    mock_client.side_effect = _new_client
+
+    client = gcp_clients.get_bigquery_client()
+    assert gcp_clients.get_bigquery_client() is client
+    project_client = gcp_clients.get_bigquery_client('my-project')
+    assert project_client is not client
+    assert gcp_clients.get_bigquery_client('my-project') is project_client
+
+    assert mock_client.call_args_list == [mock.call(None), mock.call('my-project')]
+
+
+@mock.patch('google.cloud.storage.Client')
+def testGetBucket_FetchedOnce(mock_client: mock.MagicMock):
+    mock_client.return_value.get_bucket.side_effect = lambda name: f'bucket {name}'
+
+    assert gcp_clients.get_bucket('bucket1') == 'bucket bucket1'
+    assert gcp_clients.get_bucket('bucket2') == 'bucket bucket2'
+    assert gcp_clients.get_bucket('bucket1') == 'bucket bucket1'
+
+    mock_client.assert_called_once()
+    assert mock_client.return_value.get_bucket.call_count == 2
+
+
+@mock.patch('google.cloud.storage.Client')
+def testGetBucket_NotFoundIsNotCached(mock_client: mock.MagicMock):
+    mock_client.return_value.get_bucket.side_effect = [
+        google.cloud.exceptions.NotFound('not found'), 'bucket']
+
+    with pytest.raises(google.cloud.exceptions.NotFound):
+        gcp_clients.get_bucket('bucket')
+    assert gcp_clients.get_bucket('bucket') == 'bucket'
+
+
+@mock.patch('os.getpid')
+@mock.patch('google.cloud.storage.Client')
+def testGetStorageClient_NewClientAfterFork(mock_client: mock.MagicMock,
+                                            mock_getpid: mock.MagicMock):
+    mock_client.side_effect = _new_client
+    mock_getpid.return_value = 100
+    parent_client = gcp_clients.get_storage_client()
+    assert gcp_clients.get_storage_client() is parent_client
+
+    mock_getpid.return_value = 101
+    child_client = gcp_clients.get_storage_client()
+    assert child_client is not parent_client
+    assert gcp_clients.get_storage_client() is child_client
+    assert mock_client.call_count == 2
+
+
+@mock.patch('google.cloud.storage.Client')
+def testGetStorageClient_ConcurrentFirstUse(mock_client: mock.MagicMock):
+    mock_client.side_effect = _new_client
+    clients = []
+    threads = [threading.Thread(target=lambda: clients.append(gcp_clients.get_storage_client()))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert all(client is clients[0] for client in clients)
+
+
+@mock.patch('google.cloud.storage.Client')
+@mock.patch('google.cloud.bigquery.Client')
+def testTrackStats(mock_bq_client: mock.MagicMock, mock_storage_client: mock.MagicMock):
+    mock_bq_client.side_effect = _new_client
+    mock_storage_client.side_effect = _new_client
+    before = gcp_clients.stats()
+
+    with gcp_clients.track_stats() as workflow_stats:
+        bq_client = gcp_clients.get_bigquery_client()
+        storage_client = gcp_clients.get_storage_client()
+        _respond(bq_client)
+        _respond(storage_client)
+        _respond(storage_client)
+        # requests made on other threads belong to other workflows
+        other_thread = threading.Thread(target=lambda: _respond(bq_client))
+        other_thread.start()
+        other_thread.join()
+
+    # the shared clients are reused by the next workflow
+    with gcp_clients.track_stats() as next_workflow_stats:
+        _respond(gcp_clients.get_storage_client())
+
+    assert workflow_stats == {'bigquery_clients_created': 1,
+                              'storage_clients_created': 1,
+                              'bigquery_requests': 1,
+                              'storage_requests': 2}
+    assert next_workflow_stats == {'bigquery_clients_created': 0,
+                                   'storage_clients_created': 0,
+                                   'bigquery_requests': 0,
+                                   'storage_requests': 1}
+    after = gcp_clients.stats()
+    assert {stat: after[stat] - before[stat] for stat in after} == {
+        'bigquery_clients_created': 1,
+        'storage_clients_created': 1,
+        'bigquery_requests': 2,
+        'storage_requests': 3}
@@ -1,4 +1,5 @@
 import json
+from io import BytesIO
 from textwrap import dedent
 from unittest import TestCase
 from unittest.mock import MagicMock, Mock, patch
@@ -60,12 +61,13 @@ class GcsToBqTest(TestCase):
             gcs_to_bq_util.add_df_to_bq(
                 test_frame.copy(deep=True), "test-dataset", "table")
 
-            mock_instance.load_table_from_json.assert_called()
-            call_args = mock_instance.load_table_from_json.call_args
-            self.assertEqual(call_args.args[0],
-                             json.loads(test_frame.to_json(orient='records')))
+            mock_instance.load_table_from_json.assert_not_called()
+            call_args = mock_instance.load_table_from_file.call_args
+            assert_frame_equal(pd.read_parquet(call_args.args[0]),
+                               test_frame.reset_index(drop=True))
             job_config = call_args.kwargs['job_config']
             self.assertTrue(job_config.autodetect)
+            self.assertEqual(job_config.source_format, 'PARQUET')
 
     @freeze_time("2020-01-01")
     def testAddDataframeToBq_IgnoreColModes(self):
@@ -85,10 +87,11 @@ class GcsToBqTest(TestCase):
                 test_frame.copy(deep=True), "test-dataset", "table",
                 col_modes={'label1': 'REPEATED', 'label2': 'REQUIRED'})
 
-            mock_instance.load_table_from_json.assert_called()
-            call_args = mock_instance.load_table_from_json.call_args
-            self.assertEqual(call_args.args[0],
-                             json.loads(test_frame.to_json(orient='records')))
+            # without column_types, the REPEATED mode doesn't need json
+            mock_instance.load_table_from_json.assert_not_called()
+            call_args = mock_instance.load_table_from_file.call_args
+            assert_frame_equal(pd.read_parquet(call_args.args[0]),
+                               test_frame.reset_index(drop=True))
             job_config = call_args.kwargs['job_config']
             self.assertTrue(job_config.autodetect)
 
@@ -113,6 +116,8 @@ class GcsToBqTest(TestCase):
                 test_frame.copy(deep=True), 'test-dataset', 'table',
                 column_types=column_types, col_modes=col_modes)
 
+            # REPEATED fields can only be loaded from json
+            mock_instance.load_table_from_file.assert_not_called()
             mock_instance.load_table_from_json.assert_called()
             call_args = mock_instance.load_table_from_json.call_args
             self.assertEqual(call_args.args[0],
@@ -131,21 +136,134 @@ class GcsToBqTest(TestCase):
             self.assertListEqual([field.mode for field in job_config.schema],
                                  expected_modes)
 
-    @patch('ingestion.gcs_to_bq_util.storage.Client')
-    def testLoadCsvAsDataFrame_ParseTypes(self, mock_bq: MagicMock):
-        # Write data to an temporary file
-        test_file_path = '/tmp/test_file.csv'
+    @freeze_time("2020-01-01")
+    def testAddDataframeToBq_ParquetColumnTypes(self):
+        """Tests that columns are converted to their column_types when the
+           frame is loaded as Parquet."""
+        test_frame = DataFrame({
+            'state_fips': ['01', '02', None],
+            'population': [100, 200, 300],
+            'rate': [1.5, np.nan, 0.1 + 0.2],
+            'count': [1, 2, 3],
+        })
+
+        with patch('ingestion.gcs_to_bq_util.bigquery.Client') as mock_client:
+            mock_instance = mock_client.return_value
+
+            column_types = {'state_fips': 'STRING', 'population': 'STRING',
+                            'rate': 'STRING', 'count': 'FLOAT'}
+            gcs_to_bq_util.add_df_to_bq(
+                test_frame, 'test-dataset', 'table',
+                column_types=column_types, col_modes={'population': 'REQUIRED'})
+
+            mock_instance.load_table_from_json.assert_not_called()
+            call_args = mock_instance.load_table_from_file.call_args
+            job_config = call_args.kwargs['job_config']
+            self.assertFalse(job_config.autodetect)
+            self.assertEqual(job_config.source_format, 'PARQUET')
+
+            expected_frame = DataFrame({
+                'state_fips': ['01', '02', None],
+                'population': ['100', '200', '300'],
+                # Rounded like the json written for load_table_from_json.
+                'rate': ['1.5', None, '0.3'],
+                'count': [1.0, 2.0, 3.0],
+            })
+            assert_frame_equal(pd.read_parquet(call_args.args[0]), expected_frame)
+
+    @freeze_time("2020-01-01")
+    def testAddDataframeToBq_MixedTypesFallBackToJson(self):
+        """Tests that a frame whose columns can't be converted to Parquet is
+           loaded as json."""
+        test_frame = DataFrame({'label1': ['value_a', 1.5, None]})
+
+        with patch('ingestion.gcs_to_bq_util.bigquery.Client') as mock_client:
+            mock_instance = mock_client.return_value
+
+            gcs_to_bq_util.add_df_to_bq(
+                test_frame, 'test-dataset', 'table',
+                column_types={'label1': 'FLOAT'})
+
+            mock_instance.load_table_from_file.assert_not_called()
+            call_args = mock_instance.load_table_from_json.call_args
+            self.assertEqual(call_args.args[0],
+                             json.loads(test_frame.to_json(orient='records')))
+
+    _mixed_type_frame = DataFrame({
+        'state_fips': ['01', None, '02'],
+        'rate': [1.5, np.nan, 0.1234567890123],
+        'population': [100, 200, 300],
+        'is_total': [True, False, True],
+        'date': pd.to_datetime(['2020-01-01', None, '2021-06-30']),
+        'mixed': ['a', 1, 2.5],
+    })
+
+    def _get_json_str_values(self, frame):
+        """Returns the strings that str() gives for each value of the frame
+           after a round trip through json."""
+        return [{key: str(value) for key, value in record.items()}
+                for record in json.loads(frame.to_json(orient='records'))]
+
+    @freeze_time("2020-01-01")
+    def testAddDataframeToBqAsStrValues(self):
+        """Tests that every value is loaded as the string str() gives for it
+           after a round trip through json."""
+        with patch('ingestion.gcs_to_bq_util.bigquery.Client') as mock_client:
+            mock_instance = mock_client.return_value
+
+            column_types = {col: 'STRING' for col in self._mixed_type_frame.columns}
+            gcs_to_bq_util.add_df_to_bq_as_str_values(
+                self._mixed_type_frame, 'test-dataset', 'table',
+                column_types=column_types)
+
+            mock_instance.load_table_from_json.assert_not_called()
+            call_args = mock_instance.load_table_from_file.call_args
+            self.assertEqual(call_args.kwargs['job_config'].source_format, 'PARQUET')
+            loaded_frame = pd.read_parquet(call_args.args[0])
+            self.assertEqual(loaded_frame.to_dict('records'),
+                             self._get_json_str_values(self._mixed_type_frame))
+            self.assertEqual(loaded_frame['rate'].tolist(),
+                             ['1.5', 'None', '0.123456789'])
+
+    @freeze_time("2020-01-01")
+    def testAddDataframeToBqAsStrValues_Repeated(self):
+        """Tests that frames with REPEATED fields are loaded as json with the
+           same string values."""
+        with patch('ingestion.gcs_to_bq_util.bigquery.Client') as mock_client:
+            mock_instance = mock_client.return_value
+
+            column_types = {col: 'STRING' for col in self._mixed_type_frame.columns}
+            gcs_to_bq_util.add_df_to_bq_as_str_values(
+                self._mixed_type_frame, 'test-dataset', 'table',
+                column_types=column_types, col_modes={'mixed': 'REPEATED'})
+
+            mock_instance.load_table_from_file.assert_not_called()
+            call_args = mock_instance.load_table_from_json.call_args
+            self.assertEqual(call_args.args[0],
+                             self._get_json_str_values(self._mixed_type_frame))
+
+    def _mock_blob_data(self, mock_storage: MagicMock, data: str) -> MagicMock:
+        """Makes the blobs of the mocked storage client read `data`, and returns
+        the mocked blob."""
+        blob = mock_storage.return_value.get_bucket.return_value.blob.return_value
+        blob.open.side_effect = lambda *args, **kwargs: BytesIO(data.encode())
+        return blob
+
+    @patch('google.cloud.storage.Client')
+    def testLoadCsvAsDataFrame_ParseTypes(self, mock_storage: MagicMock):
         test_data = dedent(
             """
             col1,col2,col3,col4
             20201209,13,text,"2,937"
             20210105,"1,400",string,
             """)
-        with open(test_file_path, 'w') as f:
-            f.write(test_data)
+        blob = self._mock_blob_data(mock_storage, test_data)
 
         df = gcs_to_bq_util.load_csv_as_df(
             'gcs_bucket', 'test_file.csv', parse_dates=['col1'], thousands=',')
+        mock_storage.return_value.get_bucket.return_value.blob.assert_called_with(
+            'test_file.csv')
+        blob.open.assert_called_with('rb', chunk_size=gcs_to_bq_util.GCS_READ_CHUNK_SIZE)
         # With parse_dates, col1 should be interpreted as numpy datetime. With
         # thousands=',', numeric columns should be interpreted correctly even if
         # they are written as strings with commas. Numeric cols with null values
@@ -155,9 +273,6 @@ class GcsToBqTest(TestCase):
         for col in df.columns:
             self.assertEqual(df[col].dtype, expected_types[col])
 
-        # Re-write the test data since load_csv_as_df removes the file.
-        with open(test_file_path, 'w') as f:
-            f.write(test_data)
         df = gcs_to_bq_util.load_csv_as_df('gcs_bucket', 'test_file.csv')
         # Without the additional read_csv args, the data are inferred to the
         # default object type.
@@ -165,3 +280,50 @@ class GcsToBqTest(TestCase):
                           'col3': object, 'col4': object}
         for col in df.columns:
             self.assertEqual(df[col].dtype, expected_types[col])
+
+    @patch('google.cloud.storage.Client')
+    def testLoadCsvAsDataFrame_UseColsAndChunks(self, mock_storage: MagicMock):
+        test_data = 'county_fips,hosp_n,cases\n' + ''.join(
+            f'{i:05d},{i % 3},{i}\n' for i in range(250))
+        self._mock_blob_data(mock_storage, test_data)
+
+        df = gcs_to_bq_util.load_csv_as_df(
+            'gcs_bucket', 'test_file.csv', dtype={'county_fips': str},
+            usecols=['county_fips', 'cases'])
+        self.assertEqual(list(df.columns), ['county_fips', 'cases'])
+        self.assertEqual(df['county_fips'][7], '00007')
+        self.assertEqual(len(df), 250)
+
+        blob_files = []
+
+        def open_blob(*args, **kwargs):
+            blob_files.append(BytesIO(test_data.encode()))
+            return blob_files[-1]
+        blob = mock_storage.return_value.get_bucket.return_value.blob.return_value
+        blob.open.side_effect = open_blob
+        chunks = list(gcs_to_bq_util.load_csv_as_df(
+            'gcs_bucket', 'test_file.csv', dtype={'county_fips': str},
+            chunksize=100, usecols=['county_fips', 'cases']))
+        self.assertEqual([len(chunk) for chunk in chunks], [100, 100, 50])
+        assert_frame_equal(pd.concat(chunks, ignore_index=True), df)
+        # The blob is closed once all the chunks have been read.
+        self.assertEqual(len(blob_files), 1)
+        self.assertTrue(blob_files[0].closed)
+
+        chunked_frame = gcs_to_bq_util.load_csv_as_df(
+            'gcs_bucket', 'test_file.csv', chunksize=100)
+        next(chunked_frame)
+        chunked_frame.close()
+        # And when the iteration is abandoned part way through.
+        self.assertEqual(len(blob_files), 2)
+        self.assertTrue(blob_files[1].closed)
+
+    @patch('google.cloud.storage.Client')
+    def testLoadJsonAsDataFrame(self, mock_storage: MagicMock):
+        self._mock_blob_data(
+            mock_storage, '[{"state_fips": "01", "population": 10}]')
+
+        df = gcs_to_bq_util.load_json_as_df(
+            'gcs_bucket', 'test_file.json', dtype={'state_fips': str})
+        assert_frame_equal(
+            df, pd.DataFrame({'state_fips': ['01'], 'population': [10]}))
@@ -40,7 +40,7 @@ def initialize_mocks(mock_storage_client, mock_requests_get, response_data, gcs_
 class URLFileToGCSTest(unittest.TestCase):
     def testDownloadFirstUrlToGcs_SameFile(self):
         test_data = b'fake data'
-        with patch('ingestion.url_file_to_gcs.storage.Client') as mock_storage_client, \
+        with patch('google.cloud.storage.Client') as mock_storage_client, \
                 patch('requests.get') as mock_requests_get:
             initialize_mocks(mock_storage_client,
                              mock_requests_get, test_data, test_data)
@@ -51,7 +51,7 @@ class URLFileToGCSTest(unittest.TestCase):
             self.assertFalse(result)
 
     def testDownloadFirstUrlToGcs_DiffFile(self):
-        with patch('ingestion.url_file_to_gcs.storage.Client') as mock_storage_client, \
+        with patch('google.cloud.storage.Client') as mock_storage_client, \
                 patch('requests.get') as mock_requests_get:
             initialize_mocks(mock_storage_client,
                              mock_requests_get, b'data from url', b'gcs data')
@@ -62,7 +62,7 @@ class URLFileToGCSTest(unittest.TestCase):
             self.assertTrue(result)
 
     def testDownloadFirstUrlToGcs_NoGCSFile(self):
-        with patch('ingestion.url_file_to_gcs.storage.Client') as mock_storage_client, \
+        with patch('google.cloud.storage.Client') as mock_storage_client, \
                 patch('requests.get') as mock_requests_get:
             initialize_mocks(mock_storage_client,
                              mock_requests_get, b'data from url', b'gcs data',
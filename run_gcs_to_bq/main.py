@@ -2,6 +2,7 @@ import logging
 import os
 
 from datasources.data_sources import DATA_SOURCES_DICT
+from ingestion import gcp_clients
 from flask import Flask, request
 app = Flask(__name__)
 
@@ -61,7 +62,14 @@ def do_ingestion(event):
         raise RuntimeError("ID: {}, is not a valid id".format(workflow_id))
 
     data_source = DATA_SOURCES_DICT[workflow_id]
-    data_source.write_to_bq(dataset, gcs_bucket, **attrs)
+    # Counts the clients created and API requests made by the workflow, which
+    # share the clients of this process with other workflows.
+    with gcp_clients.track_stats() as client_stats:
+        try:
+            data_source.write_to_bq(dataset, gcs_bucket, **attrs)
+        finally:
+            logging.info("GCP clients and API requests for workflow %s: %s",
+                         workflow_id, client_stats)
 
     logging.info(
         "Successfully uploaded to BigQuery for workflow %s", workflow_id)
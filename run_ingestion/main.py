@@ -5,6 +5,7 @@ import json
 import logging
 import os
 from datasources.data_sources import DATA_SOURCES_DICT
+from ingestion import gcp_clients
 from flask import Flask, request
 app = Flask(__name__)
 
@@ -66,7 +67,14 @@ def ingest_data_to_gcs(event):
         raise RuntimeError("ID: {}, is not a valid id".format(workflow_id))
 
     data_source = DATA_SOURCES_DICT[workflow_id]
-    data_source.upload_to_gcs(gcs_bucket, **attrs)
+    # Counts the clients created and API requests made by the workflow, which
+    # share the clients of this process with other workflows.
+    with gcp_clients.track_stats() as client_stats:
+        try:
+            data_source.upload_to_gcs(gcs_bucket, **attrs)
+        finally:
+            logging.info("GCP clients and API requests for workflow %s: %s",
+                         workflow_id, client_stats)
 
     logging.info(
         "Successfully uploaded data to GCS for workflow %s", workflow_id)